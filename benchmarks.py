@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Kyle Fitzsimmons, 2018
+#
+# Benchmarks for coordinate ingest:
+#
+#   payloads: each /update coordinate format is encoded once and then timed
+#             from the raw request body to a CoordinateBatch ready for insert
+#   ingest:   COPY throughput and index sizes of an unpartitioned scratch copy
+#             of mobile_coordinates against a monthly partitioned one, using
+#             the database of the CONFIG environment
+#
+#   $ python benchmarks.py payloads [--sizes 1000,10000,100000] [--repeat 5]
+#   $ python benchmarks.py ingest [--rows 1000000] [--months 12] [--devices 500]
+import argparse
+from datetime import datetime, timedelta
+import io
+import json
+import random
+import time
+
+from mobile.batch import CoordinateBatch
+from mobile.db.coordinates import COLUMNS
+from mobile.db.partitions import add_months, month_start
+from mobile.payloads import decode_packed_coordinates, encode_packed_coordinates
+from utils.data import camelcase_to_underscore, rename_json_keys
+
+START = datetime(2018, 4, 24, 4, 25, 13)
+
+
+def generate_points(n):
+    lat, lng = 45.5088872, -73.6289835
+    points = []
+    for i in range(n):
+        lat += random.uniform(-1e-4, 1e-4)
+        lng += random.uniform(-1e-4, 1e-4)
+        points.append({
+            'latitude': round(lat, 7),
+            'longitude': round(lng, 7),
+            'altitude': round(random.uniform(10, 60), 6),
+            'speed': round(random.uniform(0, 20), 6),
+            'hAccuracy': random.choice([5, 10, 16, 65]),
+            'vAccuracy': random.choice([3, 10, 25]),
+            'modeDetected': random.randint(0, 3),
+            'pointType': random.randint(0, 8),
+            'timestamp': (START + timedelta(seconds=i)).isoformat() + 'Z'
+        })
+    return points
+
+
+def to_columns(points):
+    keys = sorted(set(k for p in points for k in p))
+    return {k: [p.get(k) for p in points] for k in keys}
+
+
+def best_of(repeat, func, *args):
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        func(*args)
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+# the previous row-oriented path: decode, rename keys for every point, then
+# build the batch
+def decode_rows_legacy(body):
+    points = json.loads(body)['coordinates']
+    return CoordinateBatch.from_points(rename_json_keys(points, camelcase_to_underscore))
+
+
+def decode_rows(body):
+    return CoordinateBatch.from_points(json.loads(body)['coordinates'])
+
+
+def decode_columns(body):
+    return CoordinateBatch.from_columns(json.loads(body)['coordinates'])
+
+
+def decode_packed(body):
+    return decode_packed_coordinates(body)[1]
+
+
+def benchmark_payloads(sizes, repeat):
+    uuid = '00000000-0000-0000-0000-000000000000'
+    print('{:>8}  {:<14} {:>12} {:>10} {:>14}'.format('points', 'format', 'body bytes', 'seconds', 'points/s'))
+    for n in sizes:
+        points = generate_points(n)
+        rows_body = json.dumps({'uuid': uuid, 'coordinates': points}).encode('utf-8')
+        columns_body = json.dumps({'uuid': uuid, 'coordinates': to_columns(points)}).encode('utf-8')
+        packed_body = encode_packed_coordinates(uuid, CoordinateBatch.from_points(points))
+        formats = [
+            ('rows+rename', decode_rows_legacy, rows_body),
+            ('rows', decode_rows, rows_body),
+            ('columns', decode_columns, columns_body),
+            ('packed', decode_packed, packed_body)
+        ]
+        for name, decode, body in formats:
+            seconds = best_of(repeat, decode, body)
+            print('{:>8}  {:<14} {:>12} {:>10.4f} {:>14.0f}'.format(n, name, len(body), seconds, n / seconds))
+
+
+INDEXES = [('timestamp',), ('survey_id', 'timestamp'), ('mobile_id', 'timestamp')]
+
+
+def create_scratch_table(db, name, months=None):
+    partition_by = ' PARTITION BY RANGE (timestamp)' if months else ''
+    db.session.execute('CREATE TABLE {name} (LIKE mobile_coordinates INCLUDING DEFAULTS){partition_by}'.format(
+        name=name, partition_by=partition_by))
+    for month in months or []:
+        db.session.execute("CREATE TABLE {name}_{month:%Y%m} PARTITION OF {name} "
+                           "FOR VALUES FROM ('{month}') TO ('{upper}')".format(name=name, month=month,
+                                                                               upper=add_months(month, 1)))
+    for columns in INDEXES:
+        db.session.execute('CREATE INDEX ON {name} ({columns})'.format(name=name, columns=', '.join(columns)))
+    db.session.commit()
+
+
+# total index size and the size of the largest partition's indexes
+def index_sizes(db, name):
+    sizes = [r[0] for r in db.session.execute('SELECT pg_indexes_size(relid) FROM pg_partition_tree(:name) '
+                                              'WHERE isleaf', {'name': name})]
+    if not sizes:
+        sizes = [db.session.execute('SELECT pg_indexes_size(:name ::regclass)', {'name': name}).scalar()]
+    return sum(sizes), max(sizes)
+
+
+# points are uploaded in time order by many devices, as in production
+def generate_uploads(rows, months, devices, chunk_size=5000):
+    start = month_start(datetime.utcnow())
+    start = datetime(start.year, start.month, 1) - timedelta(days=months * 30)
+    step = months * 30 * 86400. / rows
+    points = ({'latitude': 45.5 + random.uniform(-0.1, 0.1),
+               'longitude': -73.6 + random.uniform(-0.1, 0.1),
+               'speed': random.uniform(0, 20),
+               'timestamp': (start + timedelta(seconds=i * step)).isoformat() + 'Z'} for i in range(rows))
+    while True:
+        chunk = [p for _, p in zip(range(chunk_size), points)]
+        if not chunk:
+            return
+        mobile_id = random.randint(1, devices)
+        yield CoordinateBatch.from_points(chunk).copy_text(mobile_id % 20 + 1, mobile_id)
+
+
+def benchmark_ingest(rows, months, devices):
+    from mobile.server import create_app
+    from models import db
+
+    first_month = month_start(datetime.utcnow() - timedelta(days=months * 30 + 31))
+    tables = [('unpartitioned', 'benchmark_coordinates_plain', None),
+              ('monthly', 'benchmark_coordinates_monthly', [add_months(first_month, n) for n in range(months + 2)])]
+    app = create_app()
+    with app.app_context():
+        print('{:<14} {:>10} {:>10} {:>12} {:>18} {:>18}'.format(
+            'layout', 'rows', 'seconds', 'rows/s', 'index bytes', 'largest partition'))
+        for layout, name, partition_months in tables:
+            db.session.execute('DROP TABLE IF EXISTS {} CASCADE'.format(name))
+            create_scratch_table(db, name, partition_months)
+            copy_sql = 'COPY {name} ({columns}) FROM STDIN'.format(name=name, columns=', '.join(COLUMNS))
+            try:
+                random.seed(0)
+                elapsed = 0.
+                for text in generate_uploads(rows, months, devices):
+                    cursor = db.session.connection().connection.cursor()
+                    start = time.time()
+                    cursor.copy_expert(copy_sql, io.StringIO(text))
+                    db.session.commit()
+                    elapsed += time.time() - start
+                total, largest = index_sizes(db, name)
+                print('{:<14} {:>10} {:>10.2f} {:>12.0f} {:>18,} {:>18,}'.format(
+                    layout, rows, elapsed, rows / elapsed, total, largest))
+            finally:
+                db.session.rollback()
+                db.session.execute('DROP TABLE IF EXISTS {} CASCADE'.format(name))
+                db.session.commit()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest='benchmark')
+    payloads = subparsers.add_parser('payloads', help='Decode time of each /update coordinate format')
+    payloads.add_argument('--sizes', default='1000,10000,100000')
+    payloads.add_argument('--repeat', type=int, default=5)
+    ingest = subparsers.add_parser('ingest', help='COPY throughput and index size with and without partitions')
+    ingest.add_argument('--rows', type=int, default=1000000)
+    ingest.add_argument('--months', type=int, default=12)
+    ingest.add_argument('--devices', type=int, default=500)
+    args = parser.parse_args()
+
+    if args.benchmark == 'payloads':
+        benchmark_payloads([int(n) for n in args.sizes.split(',')], args.repeat)
+    elif args.benchmark == 'ingest':
+        benchmark_ingest(args.rows, args.months, args.devices)
+    else:
+        parser.print_help()
@@ -13,6 +13,13 @@ DEFAULT_TEST_DB = 'postgresql://127.0.0.1/itinerum_test'
 DEFAULT_PRODUCTION_DB = 'postgresql://127.0.0.1/itinerum'
 
 
+def env_flag(name, default=False):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
 class Config(object):
     CONF = 'base'
     APP_HOST = '0.0.0.0'
@@ -23,6 +30,95 @@ class Config(object):
     ASSETS_ROUTE = '/assets'
     DEFAULT_AVATAR_FILENAME = 'defaultAvatar.png'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # largest gzip/deflate request body accepted once decompressed (bytes)
+    REQUEST_MAX_DECOMPRESSED_BYTES = int(os.environ.get('IT_REQUEST_MAX_DECOMPRESSED_BYTES', 64 * 1024 * 1024))
+    # 'copy' streams coordinates with PostgreSQL COPY, 'orm' uses bulk_save_objects
+    COORDINATES_INGEST_ENGINE = os.environ.get('IT_COORDINATES_INGEST_ENGINE', 'copy')
+    # number of points normalized, converted and flushed at a time during ingest
+    COORDINATES_CHUNK_SIZE = int(os.environ.get('IT_COORDINATES_CHUNK_SIZE', 5000))
+    # skip coordinates already stored for a device's (mobile_id, timestamp)
+    COORDINATES_SKIP_DUPLICATES = env_flag('IT_COORDINATES_SKIP_DUPLICATES', True)
+    # ingest filter for points above the survey's gps_accuracy_threshold or implying
+    # speeds above COORDINATES_FILTER_MAX_SPEED (m/s, 0 disables the speed test): 'off',
+    # 'report' (count only) or 'drop'; defaults for surveys without their own
+    # coordinates_filter(_max_speed)
+    COORDINATES_FILTER = os.environ.get('IT_COORDINATES_FILTER', 'off')
+    COORDINATES_FILTER_MAX_SPEED = float(os.environ.get('IT_COORDINATES_FILTER_MAX_SPEED', 90))
+    # opt-in group commit of coordinate uploads from many requests; a request is
+    # acknowledged once the flusher has committed its batch
+    COORDINATES_WRITE_BEHIND = env_flag('IT_COORDINATES_WRITE_BEHIND')
+    COORDINATES_WRITE_BEHIND_INTERVAL = float(os.environ.get('IT_COORDINATES_WRITE_BEHIND_INTERVAL', 0.05))
+    COORDINATES_WRITE_BEHIND_MAX_ROWS = int(os.environ.get('IT_COORDINATES_WRITE_BEHIND_MAX_ROWS', 50000))
+    COORDINATES_WRITE_BEHIND_QUEUE_SIZE = int(os.environ.get('IT_COORDINATES_WRITE_BEHIND_QUEUE_SIZE', 1000))
+    COORDINATES_WRITE_BEHIND_TIMEOUT = float(os.environ.get('IT_COORDINATES_WRITE_BEHIND_TIMEOUT', 30))
+    # local append-only spool for /update payloads: 'off', 'fallback' (spool when the
+    # database errors or times out) or 'always' (spool and acknowledge every update)
+    UPDATE_SPOOL_MODE = os.environ.get('IT_UPDATE_SPOOL_MODE', 'off')
+    UPDATE_SPOOL_DIR = os.environ.get('IT_UPDATE_SPOOL_DIR', '/var/spool/itinerum-mobile-api')
+    UPDATE_SPOOL_SEGMENT_BYTES = int(os.environ.get('IT_UPDATE_SPOOL_SEGMENT_BYTES', 64 * 1024 * 1024))
+    # 'always' fsyncs each payload, 'interval' at most every UPDATE_SPOOL_FSYNC_INTERVAL
+    # seconds and 'never' leaves flushing to the operating system
+    UPDATE_SPOOL_FSYNC = os.environ.get('IT_UPDATE_SPOOL_FSYNC', 'always')
+    UPDATE_SPOOL_FSYNC_INTERVAL = float(os.environ.get('IT_UPDATE_SPOOL_FSYNC_INTERVAL', 1.0))
+    # each worker replays spooled payloads every UPDATE_SPOOL_REPLAY_INTERVAL seconds,
+    # at most UPDATE_SPOOL_REPLAY_MAX_RATE per second (0 for no limit)
+    UPDATE_SPOOL_REPLAY = env_flag('IT_UPDATE_SPOOL_REPLAY', True)
+    UPDATE_SPOOL_REPLAY_INTERVAL = float(os.environ.get('IT_UPDATE_SPOOL_REPLAY_INTERVAL', 10))
+    UPDATE_SPOOL_REPLAY_MAX_RATE = float(os.environ.get('IT_UPDATE_SPOOL_REPLAY_MAX_RATE', 50))
+    # survey totals summed in memory by each worker and added to statistics_surveys
+    # every SURVEY_ROLLUPS_INTERVAL seconds
+    SURVEY_ROLLUPS = env_flag('IT_SURVEY_ROLLUPS', True)
+    SURVEY_ROLLUPS_INTERVAL = float(os.environ.get('IT_SURVEY_ROLLUPS_INTERVAL', 10))
+    # uuid -> user ids and survey settings for /update; entries are dropped when a
+    # device registers again through the same worker and otherwise expire
+    USER_CONTEXT_CACHE_SIZE = int(os.environ.get('IT_USER_CONTEXT_CACHE_SIZE', 50000))
+    USER_CONTEXT_CACHE_TTL = int(os.environ.get('IT_USER_CONTEXT_CACHE_TTL', 300))
+    # formatted survey definitions for /create, rebuilt after SURVEY_CACHE_TTL seconds;
+    # a survey name is revalidated against surveys.modified_at every SURVEY_NAME_CACHE_TTL
+    SURVEY_CACHE_SIZE = int(os.environ.get('IT_SURVEY_CACHE_SIZE', 256))
+    SURVEY_CACHE_TTL = int(os.environ.get('IT_SURVEY_CACHE_TTL', 600))
+    SURVEY_NAME_CACHE_TTL = int(os.environ.get('IT_SURVEY_NAME_CACHE_TTL', 30))
+    # names without a survey are answered with a 410 without a query for this long
+    SURVEY_UNKNOWN_CACHE_SIZE = int(os.environ.get('IT_SURVEY_UNKNOWN_CACHE_SIZE', 10000))
+    SURVEY_UNKNOWN_CACHE_TTL = int(os.environ.get('IT_SURVEY_UNKNOWN_CACHE_TTL', 60))
+    # per-device token buckets for /update requests and uploaded points, kept in each
+    # worker ('local') or shared by all workers in rate_limit_buckets ('database')
+    RATE_LIMIT = env_flag('IT_RATE_LIMIT', True)
+    RATE_LIMIT_BACKEND = os.environ.get('IT_RATE_LIMIT_BACKEND', 'local')
+    RATE_LIMIT_MAX_DEVICES = int(os.environ.get('IT_RATE_LIMIT_MAX_DEVICES', 100000))
+    RATE_LIMIT_REQUESTS_PER_MINUTE = float(os.environ.get('IT_RATE_LIMIT_REQUESTS_PER_MINUTE', 30))
+    RATE_LIMIT_REQUESTS_BURST = int(os.environ.get('IT_RATE_LIMIT_REQUESTS_BURST', 20))
+    RATE_LIMIT_POINTS_PER_MINUTE = float(os.environ.get('IT_RATE_LIMIT_POINTS_PER_MINUTE', 10000))
+    RATE_LIMIT_POINTS_BURST = int(os.environ.get('IT_RATE_LIMIT_POINTS_BURST', 250000))
+    # per-worker admission control: /update uploads larger than the small request
+    # limits get a 429 while in-flight uploads, their pending points or the average
+    # wait for a pooled database connection (seconds) exceed these thresholds
+    ADMISSION_CONTROL = env_flag('IT_ADMISSION_CONTROL', True)
+    ADMISSION_MAX_IN_FLIGHT = int(os.environ.get('IT_ADMISSION_MAX_IN_FLIGHT', 16))
+    ADMISSION_MAX_PENDING_POINTS = int(os.environ.get('IT_ADMISSION_MAX_PENDING_POINTS', 250000))
+    ADMISSION_MAX_CHECKOUT_WAIT = float(os.environ.get('IT_ADMISSION_MAX_CHECKOUT_WAIT', 0.5))
+    ADMISSION_SMALL_REQUEST_BYTES = int(os.environ.get('IT_ADMISSION_SMALL_REQUEST_BYTES', 32 * 1024))
+    ADMISSION_SMALL_REQUEST_POINTS = int(os.environ.get('IT_ADMISSION_SMALL_REQUEST_POINTS', 500))
+    ADMISSION_MAX_RETRY_AFTER = int(os.environ.get('IT_ADMISSION_MAX_RETRY_AFTER', 120))
+    # database connections pooled by each worker: DB_POOL_SIZE kept open plus up to
+    # DB_MAX_OVERFLOW more under load, a checkout waits DB_POOL_TIMEOUT seconds for one
+    # and connections are replaced after DB_POOL_RECYCLE seconds (0 disables pooling)
+    SQLALCHEMY_POOL_SIZE = int(os.environ.get('IT_DB_POOL_SIZE', 5))
+    SQLALCHEMY_MAX_OVERFLOW = int(os.environ.get('IT_DB_MAX_OVERFLOW', 10))
+    SQLALCHEMY_POOL_TIMEOUT = float(os.environ.get('IT_DB_POOL_TIMEOUT', 10))
+    SQLALCHEMY_POOL_RECYCLE = int(os.environ.get('IT_DB_POOL_RECYCLE', 1800))
+    # test each pooled connection with a round trip before handing it out
+    DB_POOL_PRE_PING = env_flag('IT_DB_POOL_PRE_PING', True)
+    # cancel statements running longer than this (milliseconds, 0 disables)
+    DB_STATEMENT_TIMEOUT = int(os.environ.get('IT_DB_STATEMENT_TIMEOUT', 0))
+    # connecting through pgbouncer in transaction pooling mode: no session state is
+    # set on connections, settings are applied to each transaction instead
+    DB_PGBOUNCER = env_flag('IT_DB_PGBOUNCER')
+    # recently processed /update requests kept to answer client retries (seconds)
+    IDEMPOTENCY_CACHE_SIZE = int(os.environ.get('IT_IDEMPOTENCY_CACHE_SIZE', 10000))
+    IDEMPOTENCY_CACHE_TTL = int(os.environ.get('IT_IDEMPOTENCY_CACHE_TTL', 3600))
+    # bearer token required by /health/pool and /metrics, which are not served without one
+    METRICS_TOKEN = os.environ.get('IT_METRICS_TOKEN')
 
 
 # Mobile API config ===========================================================
@@ -40,6 +136,10 @@ class MobileTestingConfig(MobileConfig):
     CONF = 'testing'
     TESTING = True
     SQLALCHEMY_DATABASE_URI = os.environ.get('IT_POSTGRES_URI', DEFAULT_TEST_DB)
+    # background flushes would commit outside of each test's transaction
+    SURVEY_ROLLUPS = False
+    UPDATE_SPOOL_REPLAY = False
+    METRICS_TOKEN = 'testing'
 
 
 class MobileProductionConfig(MobileConfig):
@@ -2,12 +2,21 @@
 # Kyle Fitzsimmons, 2017-2018
 #
 # Entry point to run API, migrations and helper scripts
-from flask_script import Manager, Server
+from datetime import datetime
+from flask_script import Command, Manager, Option, Server
+import json
 import logging
+import multiprocessing
 import pytest
+from sqlalchemy.exc import IntegrityError
 import sys
 
+from mobile.database import Database
+from mobile.db.partitions import add_months, month_start
+from mobile.routes.v1.mobile_update import replay_spooled_update
 from mobile.server import create_app
+from mobile.spool import spool, SpoolError
+from models import db, MobileUser
 
 
 logging.getLogger('itinerum.mobile').setLevel(logging.WARNING)
@@ -25,5 +34,296 @@ def test():
     sys.exit(result)
 
 
+# Statistics ==================================================================
+def rebuild_stats_range(bounds):
+    with app.app_context():
+        database = Database()
+        try:
+            written = database.stats.rebuild(*bounds)
+            database.commit()
+        finally:
+            db.session.remove()
+    return written
+
+
+class RebuildStats(Command):
+    'Recompute statistics_mobile_users from the stored rows, a range of users per transaction'
+
+    option_list = (
+        Option('-b', '--batch-size', dest='batch_size', type=int, default=500,
+               help='Number of users recomputed per transaction'),
+        Option('-w', '--workers', dest='workers', type=int, default=4,
+               help='Number of worker processes')
+    )
+
+    def run(self, batch_size, workers):
+        last_id = db.session.query(db.func.max(MobileUser.id)).scalar() or 0
+        ranges = [(first, first + batch_size) for first in range(0, last_id + 1, batch_size)]
+        # forked workers must open their own database connections
+        db.session.remove()
+        db.engine.dispose()
+
+        pool = multiprocessing.Pool(workers)
+        try:
+            written = 0
+            for n in pool.imap_unordered(rebuild_stats_range, ranges):
+                written += n
+            print('Rebuilt statistics for {} users.'.format(written))
+        finally:
+            pool.close()
+            pool.join()
+
+
+manager.add_command('rebuild-stats', RebuildStats())
+
+
+def reconcile_stats():
+    'Recompute the survey totals from statistics_mobile_users (run rebuild-stats first if those drifted)'
+    # the reconcile time read by the workers' rollup flushes is added to existing
+    # statistics tables on the first run
+    with db.engine.begin() as connection:
+        connection.execute('ALTER TABLE statistics ADD COLUMN IF NOT EXISTS last_survey_reconcile '
+                           'timestamp with time zone')
+    database = Database()
+    written = database.stats.reconcile()
+    database.commit()
+    print('Reconciled statistics for {} surveys.'.format(written))
+
+
+manager.add_command('reconcile-stats', Command(reconcile_stats))
+
+
+# Local /update spool =========================================================
+spool_manager = Manager(usage='Inspect, replay and compact the /update payload spool')
+
+
+@spool_manager.command
+def inspect():
+    print(json.dumps(spool.stats(), indent=2))
+
+
+@spool_manager.option('-l', '--limit', dest='limit', type=int, default=None,
+                      help='Maximum number of payloads to replay')
+@spool_manager.option('-r', '--max-rate', dest='max_rate', type=float, default=None,
+                      help='Maximum payloads replayed per second')
+def replay(limit=None, max_rate=None):
+    try:
+        replayed, rejected = spool.replay(lambda record: replay_spooled_update(app, record),
+                                          limit=limit,
+                                          max_rate=max_rate)
+    except SpoolError as e:
+        print(e)
+        return
+    print('Replayed {} spooled updates ({} rejected).'.format(replayed, rejected))
+
+
+@spool_manager.command
+def compact():
+    removed, rewritten = spool.compact()
+    print('Removed {} replayed segments, rewrote {} partially replayed segments.'.format(removed, rewritten))
+
+
+manager.add_command('spool', spool_manager)
+
+
+# Coordinates maintenance =====================================================
+coordinates_manager = Manager(usage='Maintenance tasks for stored mobile coordinates')
+
+
+# removes duplicate (mobile_id, timestamp) rows a few users at a time, committing
+# after each batch so row locks are short-lived and the API keeps ingesting
+@coordinates_manager.option('-b', '--batch-size', dest='batch_size', type=int, default=100,
+                            help='Number of users deduplicated per transaction')
+def dedupe(batch_size=100):
+    database = Database()
+    last_id = db.session.query(db.func.max(MobileUser.id)).scalar() or 0
+    removed = 0
+    for first in range(0, last_id + 1, batch_size):
+        removed += database.coordinates.delete_duplicates(first, first + batch_size)
+        database.commit()
+        print('Users {first}-{last}: {removed} duplicate coordinates removed'.format(
+            first=first, last=min(first + batch_size, last_id + 1) - 1, removed=removed))
+    print('Removed {} duplicate coordinates.'.format(removed))
+
+
+# replaces the existing (mobile_id, timestamp) index with the unique index expected
+# by duplicate-skipping ingest; built concurrently so inserts are not blocked. An
+# invalid index left by a failed run is rebuilt rather than swapped in. A
+# partitioned table is given its unique index by `partitions convert`.
+@coordinates_manager.command
+def unique_index():
+    database = Database()
+    if database.partitions.is_partitioned():
+        print('mobile_coordinates is partitioned and already has its unique index; '
+              'this command only applies before `partitions convert`.')
+        return
+    try:
+        database.indexes.create_unique_concurrently('mobile_coordinates_user_timestamp_uidx',
+                                                    'mobile_coordinates', ['mobile_id', 'timestamp'])
+    except (IntegrityError, RuntimeError) as e:
+        print('Unique index could not be built, run `coordinates dedupe` and retry: {}'.format(e))
+        return
+    with db.engine.begin() as connection:
+        connection.execute('DROP INDEX IF EXISTS mobile_coordinates_user_timestamp_idx')
+        connection.execute('ALTER INDEX mobile_coordinates_user_timestamp_uidx '
+                           'RENAME TO mobile_coordinates_user_timestamp_idx')
+    print('Unique index mobile_coordinates_user_timestamp_idx created.')
+
+
+manager.add_command('coordinates', coordinates_manager)
+
+
+# Stored prompt answers =======================================================
+prompts_manager = Manager(usage='Maintenance tasks for stored prompt answers')
+
+
+# adds the unique (prompt_uuid, prompt_num) constraint expected by the prompt
+# upsert to an existing table, keeping the latest row of any duplicates; the
+# index is built concurrently so answers keep being stored. Duplicates stored
+# again before the build completes fail it, and the dedupe and build are redone.
+@prompts_manager.option('-a', '--attempts', dest='attempts', type=int, default=3,
+                        help='Number of dedupe and index build attempts')
+def unique_constraint(attempts=3):
+    with db.engine.connect() as connection:
+        exists = connection.execute("SELECT EXISTS (SELECT 1 FROM pg_constraint "
+                                    "               WHERE conrelid = 'mobile_prompt_responses'::regclass "
+                                    "               AND conname = 'mobile_prompt_responses_uuid_num_key')").scalar()
+    if exists:
+        print('Unique constraint mobile_prompt_responses_uuid_num_key already exists.')
+        return
+
+    removed = 0
+    for attempt in range(1, attempts + 1):
+        with db.engine.begin() as connection:
+            removed += connection.execute(
+                'DELETE FROM mobile_prompt_responses WHERE id IN ('
+                '  SELECT id FROM ('
+                '    SELECT id, row_number() OVER (PARTITION BY prompt_uuid, prompt_num ORDER BY id DESC) AS n'
+                '    FROM mobile_prompt_responses) AS d'
+                '  WHERE d.n > 1)').rowcount
+        try:
+            Database().indexes.create_unique_concurrently('mobile_prompt_responses_uuid_num_key',
+                                                          'mobile_prompt_responses', ['prompt_uuid', 'prompt_num'])
+            break
+        except IntegrityError as e:
+            print('Attempt {}: unique index could not be built: {}'.format(attempt, e.orig))
+    else:
+        print('Removed {} duplicate prompt answers; the unique index was not built.'.format(removed))
+        return
+    print('Removed {} duplicate prompt answers.'.format(removed))
+
+    with db.engine.begin() as connection:
+        connection.execute('ALTER TABLE mobile_prompt_responses ADD CONSTRAINT mobile_prompt_responses_uuid_num_key '
+                           'UNIQUE USING INDEX mobile_prompt_responses_uuid_num_key')
+    print('Unique constraint mobile_prompt_responses_uuid_num_key created.')
+    if removed:
+        print('Run `manage.py rebuild-stats` so total_prompts no longer counts the removed duplicates.')
+
+
+manager.add_command('prompts', prompts_manager)
+
+
+# Survey settings =============================================================
+surveys_manager = Manager(usage='Maintenance tasks for survey settings')
+
+
+# adds the per-survey ingest filter settings to an existing surveys table; the
+# columns are nullable so existing surveys keep the API's defaults
+@surveys_manager.command
+def filter_columns():
+    with db.engine.begin() as connection:
+        connection.execute('ALTER TABLE surveys ADD COLUMN IF NOT EXISTS coordinates_filter varchar(8), '
+                           'ADD COLUMN IF NOT EXISTS coordinates_filter_max_speed double precision')
+    print('Columns coordinates_filter and coordinates_filter_max_speed added to surveys.')
+
+
+manager.add_command('surveys', surveys_manager)
+
+
+# Monthly mobile_coordinates partitions =======================================
+partitions_manager = Manager(usage='Create, detach and archive monthly mobile_coordinates partitions')
+
+
+def parse_month(value):
+    return datetime.strptime(value, '%Y-%m').date()
+
+
+@partitions_manager.command
+def status():
+    for partition in Database().partitions.list():
+        print('{name:<36} {state:<9} {size:>14,} bytes  {bounds}'.format(
+            name=partition['name'],
+            state='attached' if partition['attached'] else 'detached',
+            size=partition['bytes'],
+            bounds=partition['bounds'] or ''))
+
+
+# run periodically (e.g., daily from cron) so the coming months always exist
+@partitions_manager.option('-a', '--months-ahead', dest='months_ahead', type=int, default=3,
+                           help='Number of future months to pre-create')
+@partitions_manager.option('-s', '--start', dest='start', default=None,
+                           help='First month to create as YYYY-MM (default: current month)')
+def create(months_ahead=3, start=None):
+    database = Database()
+    created = database.partitions.ensure(months_ahead, parse_month(start) if start else None)
+    database.commit()
+    print('Created {} partitions: {}'.format(len(created), ', '.join(created) or '-'))
+
+
+@partitions_manager.option('-m', '--month', dest='month', required=True,
+                           help='Month to detach as YYYY-MM')
+def detach(month):
+    database = Database()
+    name = database.partitions.detach(parse_month(month))
+    database.commit()
+    print('Detached {}.'.format(name))
+
+
+@partitions_manager.option('-m', '--month', dest='month', required=True,
+                           help='Detached month to archive as YYYY-MM')
+@partitions_manager.option('-d', '--directory', dest='directory', required=True,
+                           help='Directory for the gzipped COPY archive')
+def archive(month, directory):
+    database = Database()
+    try:
+        path = database.partitions.archive(parse_month(month), directory)
+    except ValueError as e:
+        print(e)
+        return
+    database.commit()
+    print('Archived to {} and dropped the partition.'.format(path))
+
+
+# one-off conversion of an unpartitioned mobile_coordinates table; the CHECK
+# constraint is validated without blocking ingest before the short swap
+@partitions_manager.option('-a', '--months-ahead', dest='months_ahead', type=int, default=3,
+                           help='Number of future months to pre-create')
+@partitions_manager.option('--delete-null-timestamps', dest='delete_null_timestamps', action='store_true',
+                           default=False, help='Delete coordinates without a timestamp, which cannot be partitioned')
+def convert(months_ahead=3, delete_null_timestamps=False):
+    database = Database()
+    if database.partitions.is_partitioned():
+        print('mobile_coordinates is already partitioned.')
+        return
+    cutover = add_months(month_start(datetime.utcnow()), 1)
+    try:
+        deleted = database.partitions.prepare_conversion(cutover, delete_null_timestamps)
+    except ValueError as e:
+        print('{} Rerun with --delete-null-timestamps to delete them.'.format(e))
+        return
+    database.commit()
+    if deleted:
+        print('Deleted {} coordinates without a timestamp.'.format(deleted))
+    database.partitions.validate_conversion()
+    database.commit()
+    database.partitions.convert(cutover)
+    database.partitions.ensure(months_ahead, cutover)
+    database.commit()
+    print('mobile_coordinates is partitioned from {:%Y-%m}.'.format(cutover))
+
+
+manager.add_command('partitions', partitions_manager)
+
+
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Kyle Fitzsimmons, 2018
+#
+# Admission control for /update: each worker tracks its in-flight uploads, the
+# points they are still processing and the recent wait for a pooled database
+# connection. Once any of them is past its threshold, large uploads are refused
+# with a 429 and a Retry-After estimated from how long the backlog takes to
+# drain, before their bodies are read. Small requests are always admitted so
+# /create, survey answers and prompts keep flowing during a surge.
+from contextlib import contextmanager
+import math
+import random
+import threading
+import time
+
+from sqlalchemy.exc import TimeoutError as SQLAlchemyTimeoutError
+
+from utils.metrics import metrics
+
+# weight of the newest observation in the moving averages
+SMOOTHING = 0.2
+# the checkout wait average halves every CHECKOUT_WAIT_HALF_LIFE seconds without
+# new observations, so a worker that is shedding every upload still recovers
+CHECKOUT_WAIT_HALF_LIFE = 5.
+
+
+class AdmissionControl(object):
+    def __init__(self):
+        self.enabled = False
+        self.max_in_flight = 16
+        self.max_pending_points = 250000
+        self.max_checkout_wait = 0.5
+        self.small_request_bytes = 32 * 1024
+        self.small_request_points = 500
+        self.max_retry_after = 120
+        self.pool_timeout = 30.
+        self._lock = threading.Lock()
+        self.reset()
+
+    def init_app(self, app):
+        self.enabled = app.config['ADMISSION_CONTROL']
+        self.max_in_flight = app.config['ADMISSION_MAX_IN_FLIGHT']
+        self.max_pending_points = app.config['ADMISSION_MAX_PENDING_POINTS']
+        self.max_checkout_wait = app.config['ADMISSION_MAX_CHECKOUT_WAIT']
+        self.small_request_bytes = app.config['ADMISSION_SMALL_REQUEST_BYTES']
+        self.small_request_points = app.config['ADMISSION_SMALL_REQUEST_POINTS']
+        self.max_retry_after = app.config['ADMISSION_MAX_RETRY_AFTER']
+        self.pool_timeout = app.config['SQLALCHEMY_POOL_TIMEOUT'] or 30.
+        app.extensions['admission_control'] = self
+
+    def reset(self):
+        with self._lock:
+            self.in_flight = 0
+            self.pending_points = 0
+            self.request_seconds = None
+            self.points_per_second = None
+            self._checkout_wait = 0.
+            self._checkout_observed_at = time.time()
+
+    def _average(self, previous, value):
+        if previous is None:
+            return value
+        return (1 - SMOOTHING) * previous + SMOOTHING * value
+
+    def checkout_wait(self):
+        elapsed = time.time() - self._checkout_observed_at
+        return self._checkout_wait * 0.5 ** (elapsed / CHECKOUT_WAIT_HALF_LIFE)
+
+    def observe_checkout(self, seconds):
+        with self._lock:
+            self._checkout_wait = self._average(self.checkout_wait(), seconds)
+            self._checkout_observed_at = time.time()
+        metrics.observe('db.checkout', seconds)
+
+    # checks out the session's connection so the wait for a pooled connection is
+    # measured before the request does any work; a checkout that times out is
+    # observed as waiting at least the pool timeout
+    def checkout(self, session):
+        start = time.time()
+        wait = None
+        try:
+            session.connection()
+        except SQLAlchemyTimeoutError:
+            wait = max(time.time() - start, self.pool_timeout)
+            metrics.incr('admission.checkout_timeouts')
+            raise
+        finally:
+            self.observe_checkout(wait if wait is not None else time.time() - start)
+
+    # seconds a client should wait after its request timed out waiting for a
+    # pooled connection
+    def backoff(self):
+        seconds = 2 * self.checkout_wait() * random.uniform(1., 1.5)
+        return int(min(max(math.ceil(seconds), 1), self.max_retry_after))
+
+    def is_small(self, size=None, points=None):
+        return (size or 0) <= self.small_request_bytes and (points or 0) <= self.small_request_points
+
+    # returns the seconds a client should wait before retrying a request with a
+    # body of `size` bytes or `points` coordinates, or None to admit it
+    def retry_after(self, size=None, points=None):
+        if not self.enabled or self.is_small(size, points):
+            return None
+        with self._lock:
+            estimates = {}
+            if self.in_flight >= self.max_in_flight:
+                estimates['in_flight'] = self.in_flight * (self.request_seconds or 1.) / max(self.max_in_flight, 1)
+            excess = self.pending_points + (points or 0) - self.max_pending_points
+            if excess > 0 and self.pending_points:
+                estimates['pending_points'] = excess / (self.points_per_second or 1000.)
+            checkout_wait = self.checkout_wait()
+            if checkout_wait > self.max_checkout_wait:
+                estimates['checkout_wait'] = 2 * checkout_wait
+        if not estimates:
+            return None
+        reason = max(estimates, key=estimates.get)
+        metrics.incr('admission.rejected.' + reason)
+        # jitter spreads the retries of the clients turned away together
+        seconds = estimates[reason] * random.uniform(1., 1.5)
+        return int(min(max(math.ceil(seconds), 1), self.max_retry_after))
+
+    # counts an admitted request and its points as in flight until it completes
+    @contextmanager
+    def track(self, points=0):
+        with self._lock:
+            self.in_flight += 1
+            self.pending_points += points
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            with self._lock:
+                self.in_flight -= 1
+                self.pending_points -= points
+                self.request_seconds = self._average(self.request_seconds, elapsed)
+                if points and elapsed > 0:
+                    self.points_per_second = self._average(self.points_per_second, points / elapsed)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'in_flight': self.in_flight,
+                'pending_points': self.pending_points,
+                'checkout_wait': self.checkout_wait(),
+                'request_seconds': self.request_seconds,
+                'points_per_second': self.points_per_second
+            }
+
+
+admission = AdmissionControl()
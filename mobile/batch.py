@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Kyle Fitzsimmons, 2018
+#
+# Columnar container for the coordinates uploaded in a single request. Each
+# numeric column is an array of doubles where NaN marks a missing value and
+# timestamps are stored as UTC epoch seconds.
+from array import array
+import calendar
+import ciso8601
+from datetime import datetime
+import pytz
+
+from utils.data import underscore_to_camelcase
+
+FLOAT_COLUMNS = ('latitude', 'longitude', 'altitude', 'speed', 'direction',
+                 'h_accuracy', 'v_accuracy', 'acceleration_x', 'acceleration_y',
+                 'acceleration_z')
+INT_COLUMNS = ('mode_detected', 'point_type')
+NUMERIC_COLUMNS = FLOAT_COLUMNS + INT_COLUMNS
+REQUIRED_COLUMNS = ('latitude', 'longitude')
+NAN = float('nan')
+
+
+def _epoch(timestamp):
+    dt = ciso8601.parse_datetime(timestamp)
+    # naive timestamps are treated as UTC
+    return calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1e6
+
+
+def _doubles(values):
+    return array('d', [NAN if v is None else float(v) for v in values])
+
+
+class CoordinateBatch(object):
+    def __init__(self, columns, timestamps):
+        self.columns = columns
+        self.timestamps = timestamps
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __repr__(self):
+        return '<CoordinateBatch %d points>' % len(self)
+
+    @classmethod
+    def empty(cls):
+        return cls({c: array('d') for c in NUMERIC_COLUMNS}, array('d'))
+
+    # build the batch column by column from a list of JSON points; keys may be
+    # supplied as camelCase (current apps) or with underscores (legacy apps)
+    @classmethod
+    def from_points(cls, points):
+        if not isinstance(points, list) or not all(isinstance(p, dict) for p in points):
+            raise ValueError('Coordinates must be supplied as a list of points.')
+        present = set()
+        for point in points:
+            present.update(point)
+
+        size = len(points)
+        columns = {}
+        for column in NUMERIC_COLUMNS:
+            keys = [k for k in (column, underscore_to_camelcase(column)) if k in present]
+            if not keys:
+                columns[column] = array('d', [NAN]) * size
+                continue
+            if len(keys) == 1:
+                values = [p.get(keys[0]) for p in points]
+            else:
+                values = [p.get(keys[0], p.get(keys[1])) for p in points]
+            try:
+                columns[column] = _doubles(values)
+            except (TypeError, ValueError):
+                raise ValueError('Invalid value supplied for coordinate {}.'.format(column))
+
+        try:
+            timestamps = array('d', [_epoch(p['timestamp']) for p in points])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError('A valid timestamp must be supplied for each coordinate.')
+
+        batch = cls(columns, timestamps)
+        batch.validate()
+        return batch
+
+    # build the batch from a column-oriented JSON object of equal-length lists,
+    # e.g., {"latitude": [...], "longitude": [...], "timestamp": [...]}
+    @classmethod
+    def from_columns(cls, data):
+        if not isinstance(data, dict) or not all(isinstance(v, list) for v in data.values()):
+            raise ValueError('Columnar coordinates must be supplied as lists of values.')
+        timestamps = data.get('timestamp')
+        if timestamps is None:
+            raise ValueError('A valid timestamp must be supplied for each coordinate.')
+        size = len(timestamps)
+        if any(len(v) != size for v in data.values()):
+            raise ValueError('Columnar coordinates must all have the same length.')
+
+        columns = {}
+        for column in NUMERIC_COLUMNS:
+            values = data.get(column, data.get(underscore_to_camelcase(column)))
+            if values is None:
+                columns[column] = array('d', [NAN]) * size
+                continue
+            try:
+                columns[column] = _doubles(values)
+            except (TypeError, ValueError):
+                raise ValueError('Invalid value supplied for coordinate {}.'.format(column))
+
+        try:
+            timestamps = array('d', [_epoch(ts) for ts in timestamps])
+        except (TypeError, ValueError):
+            raise ValueError('A valid timestamp must be supplied for each coordinate.')
+
+        batch = cls(columns, timestamps)
+        batch.validate()
+        return batch
+
+    def validate(self):
+        for column in REQUIRED_COLUMNS:
+            if any(v != v for v in self.columns[column]):
+                raise ValueError('Missing parameter ({}): must be supplied for each coordinate.'.format(column))
+
+    def slice(self, start, stop):
+        columns = {c: values[start:stop] for c, values in self.columns.items()}
+        return CoordinateBatch(columns, self.timestamps[start:stop])
+
+    def take(self, indexes):
+        columns = {c: array('d', [values[i] for i in indexes]) for c, values in self.columns.items()}
+        timestamps = array('d', [self.timestamps[i] for i in indexes])
+        return CoordinateBatch(columns, timestamps)
+
+    def sorted_indexes(self):
+        return sorted(range(len(self)), key=self.timestamps.__getitem__)
+
+    def datetimes(self):
+        return [datetime.fromtimestamp(ts, pytz.utc) for ts in self.timestamps]
+
+    # yield one tuple per point in mobile_coordinates column order
+    # (see mobile.db.coordinates.COLUMNS) for the ORM ingest engine
+    def rows(self, survey_id, mobile_id):
+        values = []
+        for column in NUMERIC_COLUMNS:
+            cast = int if column in INT_COLUMNS else float
+            values.append([None if v != v else cast(v) for v in self.columns[column]])
+        size = len(self)
+        return zip([survey_id] * size, [mobile_id] * size, *(values + [self.datetimes()]))
+
+    # render the batch in PostgreSQL's COPY text format (tab-delimited, \N for
+    # NULL) one column at a time; an item_idx is written as a leading column
+    def copy_text(self, survey_id, mobile_id, item_idx=None):
+        size = len(self)
+        if not size:
+            return ''
+        text_columns = [[str(survey_id)] * size, [str(mobile_id)] * size]
+        if item_idx is not None:
+            text_columns.insert(0, [str(item_idx)] * size)
+        for column in NUMERIC_COLUMNS:
+            if column in INT_COLUMNS:
+                text_columns.append(['\\N' if v != v else '%d' % v for v in self.columns[column]])
+            else:
+                text_columns.append(['\\N' if v != v else repr(v) for v in self.columns[column]])
+        text_columns.append([dt.isoformat() for dt in self.datetimes()])
+        return '\n'.join(['\t'.join(row) for row in zip(*text_columns)]) + '\n'
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Kyle Fitzsimmons, 2018
+#
+# In-process caches shared by the mobile routes of a worker, sized from the
+# app config when the app is created
+from utils.cache import SingleFlight, TTLCache
+
+# /update responses keyed by Idempotency-Key or by a hash of the request body
+idempotent_responses = TTLCache()
+# device uuid -> UserContext of the ids and survey settings used by /update
+user_contexts = TTLCache()
+# lowercased survey names -> (survey id, modified_at) of their definition
+survey_names = TTLCache()
+# (survey id, modified_at) -> formatted survey definition for /create
+survey_definitions = TTLCache()
+# lowercased names that matched no survey
+unknown_survey_names = TTLCache()
+# coalesces concurrent definition loads for the same survey name
+survey_loads = SingleFlight()
+
+
+def init_app(app):
+    idempotent_responses.configure(app.config['IDEMPOTENCY_CACHE_SIZE'],
+                                   app.config['IDEMPOTENCY_CACHE_TTL'])
+    user_contexts.configure(app.config['USER_CONTEXT_CACHE_SIZE'],
+                            app.config['USER_CONTEXT_CACHE_TTL'])
+    survey_names.configure(app.config['SURVEY_CACHE_SIZE'],
+                           app.config['SURVEY_NAME_CACHE_TTL'])
+    survey_definitions.configure(app.config['SURVEY_CACHE_SIZE'],
+                                 app.config['SURVEY_CACHE_TTL'])
+    unknown_survey_names.configure(app.config['SURVEY_UNKNOWN_CACHE_SIZE'],
+                                   app.config['SURVEY_UNKNOWN_CACHE_TTL'])
+
+
+def clear():
+    idempotent_responses.clear()
+    user_contexts.clear()
+    survey_names.clear()
+    survey_definitions.clear()
+    unknown_survey_names.clear()
+
+
+def stats():
+    return {
+        'idempotent_responses': idempotent_responses.stats(),
+        'user_contexts': user_contexts.stats(),
+        'survey_names': survey_names.stats(),
+        'survey_definitions': survey_definitions.stats(),
+        'unknown_survey_names': unknown_survey_names.stats(),
+        'survey_loads': survey_loads.stats()
+    }
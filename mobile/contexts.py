@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Kyle Fitzsimmons, 2018
+#
+# Device contexts for /update: the user's ids and survey settings are loaded
+# with one query and cached by uuid, so an upload is stored from plain ids
+# without loading the user or its survey. A re-registration through /create
+# drops the entry in that worker; other workers pick up the change once their
+# entry expires.
+from mobile import caches
+from mobile.database import Database
+
+database = Database()
+
+
+def find_user_context(uuid):
+    context = caches.user_contexts.get(uuid)
+    if context is None:
+        context = database.user.find_context(uuid)
+        if context:
+            caches.user_contexts.set(uuid, context)
+    return context
+
+
+def invalidate_user_context(uuid):
+    caches.user_contexts.pop(uuid)
@@ -2,18 +2,92 @@
 # -*- coding: utf-8 -*-
 # Kyle Fitzsimmons, 2017-2018
 #
-# Mobile SQL database wrapper
+# Mobile SQL database wrapper. The action classes only write within the
+# session's transaction; a request collects all of its sections there as one
+# unit of work and commits it once with `commit`.
+from flask import g, has_request_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import Pool, QueuePool
+import time
+
 from models import db
-from mobile.db import cancelled_prompts, coordinates, prompts, survey, user
+from mobile.db import cancelled_prompts, coordinates, indexes, partitions, prompts, stats, survey, user
+from utils.metrics import metrics
+
+
+# every commit (including the flush it triggers) is counted and timed, and
+# counted per request as g.db_commits
+@event.listens_for(Session, 'before_commit')
+def _before_commit(session):
+    session.info['commit_started_at'] = time.time()
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    started_at = session.info.pop('commit_started_at', None)
+    metrics.incr('db.commits')
+    if started_at:
+        metrics.observe('db.commit', time.time() - started_at)
+    if has_request_context():
+        g.db_commits = g.get('db_commits', 0) + 1
+
+
+@event.listens_for(Pool, 'connect')
+def _connect(dbapi_connection, connection_record):
+    metrics.incr('db.pool.connects')
+
+
+# called once the app is configured; behind pgbouncer the statement timeout is
+# set locally in each transaction since no session setting survives it
+def configure_engine(app):
+    engine = db.get_engine(app)
+    timeout = app.config['DB_STATEMENT_TIMEOUT']
+    if timeout and app.config['DB_PGBOUNCER']:
+        sql = 'SET LOCAL statement_timeout = {:d}'.format(timeout)
+
+        @event.listens_for(engine, 'begin')
+        def _set_statement_timeout(connection):
+            connection.execute(sql)
+
+
+# connections of this worker's pool in use against its capacity; with
+# unlimited overflow (-1) only pool_size is considered
+def pool_stats(app):
+    pool = db.get_engine(app).pool
+    stats = {
+        'class': type(pool).__name__,
+        'pgbouncer': app.config['DB_PGBOUNCER'],
+        'pre_ping': app.config['DB_POOL_PRE_PING']
+    }
+    if isinstance(pool, QueuePool):
+        max_overflow = app.config['SQLALCHEMY_MAX_OVERFLOW']
+        capacity = pool.size() + max(max_overflow, 0)
+        stats.update({
+            'size': pool.size(),
+            'max_overflow': max_overflow,
+            'timeout': pool.timeout(),
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            'overflow': max(pool.overflow(), 0),
+            'saturation': pool.checkedout() / float(capacity) if capacity else None
+        })
+    return stats
 
 
 class Database:
     def __init__(self):
         self.cancelled_prompts = cancelled_prompts.MobileCancelledPromptsActions()
         self.coordinates = coordinates.MobileCoordinatesActions()
+        self.indexes = indexes.MobileIndexActions()
+        self.partitions = partitions.MobileCoordinatePartitionsActions()
         self.prompts = prompts.MobilePromptsActions()
+        self.stats = stats.MobileStatsActions()
         self.survey = survey.MobileSurveyActions()
         self.user = user.MobileUserActions()
 
     def commit(self):
         db.session.commit()
+
+    def rollback(self):
+        db.session.rollback()
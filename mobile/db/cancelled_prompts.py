@@ -1,37 +1,47 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 # Kyle Fitzsimmons, 2017
+from sqlalchemy import text
+from sqlalchemy.dialects import postgresql
+
 from models import db, CancelledPromptResponse
 import ciso8601
 
 
 class MobileCancelledPromptsActions:
+    delete_sql = text('DELETE FROM mobile_cancelled_prompt_responses WHERE prompt_uuid = ANY(:prompts_uuids)')
+
     def get(self, prompts_uuids):
         uuid_filters = CancelledPromptResponse.prompt_uuid.in_(prompts_uuids)
         return db.session.query(CancelledPromptResponse).filter(uuid_filters)        
 
-    def insert(self, user, cancelled_prompts):
-        bulk_rows = []
+    # inserts the cancelled prompts not already stored (e.g., resent by the app);
+    # returns the uuids of the rows inserted
+    def insert(self, survey_id, mobile_id, cancelled_prompts):
+        rows = []
         for prompt in cancelled_prompts:
             cancelled_at = prompt.get('cancelled_at')
             if cancelled_at:
                 cancelled_at = ciso8601.parse_datetime(cancelled_at)
 
-            c = CancelledPromptResponse(survey_id=user.survey.id,
-                                        mobile_id=user.id,
-                                        prompt_uuid=prompt['uuid'],
-                                        latitude=prompt['latitude'],
-                                        longitude=prompt['longitude'],
-                                        displayed_at=ciso8601.parse_datetime(prompt['displayed_at']),
-                                        cancelled_at=cancelled_at,
-                                        is_travelling=prompt.get('is_travelling'))
-            bulk_rows.append(c)
-        db.session.bulk_save_objects(bulk_rows)
-        db.session.commit()
-        return cancelled_prompts
+            rows.append({'survey_id': survey_id,
+                         'mobile_id': mobile_id,
+                         'prompt_uuid': prompt['uuid'],
+                         'latitude': prompt['latitude'],
+                         'longitude': prompt['longitude'],
+                         'displayed_at': ciso8601.parse_datetime(prompt['displayed_at']),
+                         'cancelled_at': cancelled_at,
+                         'is_travelling': prompt.get('is_travelling')})
+        if not rows:
+            return []
+        table = CancelledPromptResponse.__table__
+        statement = (postgresql.insert(table).values(rows)
+                     .on_conflict_do_nothing(index_elements=[table.c.prompt_uuid])
+                     .returning(table.c.prompt_uuid))
+        return [row.prompt_uuid for row in db.session.execute(statement)]
 
+    # returns the number of rows deleted
     def delete(self, prompts_uuids):
-        to_delete = self.get(prompts_uuids)
-        for prompt in to_delete:
-            db.session.delete(prompt)
-        db.session.commit()
+        if not prompts_uuids:
+            return 0
+        return db.session.execute(self.delete_sql, {'prompts_uuids': list(prompts_uuids)}).rowcount
@@ -1,46 +1,163 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 # Kyle Fitzsimmons, 2017
+from collections import Counter
+from flask import current_app
+import io
+import logging
+from sqlalchemy import text
+import time
+
 from models import db, MobileCoordinate
-import ciso8601
+from utils.metrics import metrics, peak_rss_kb
+
+logger = logging.getLogger(__name__)
+
+# column order shared by the COPY and ORM ingest engines
+COLUMNS = ('survey_id', 'mobile_id', 'latitude', 'longitude', 'altitude', 'speed',
+           'direction', 'h_accuracy', 'v_accuracy', 'acceleration_x', 'acceleration_y',
+           'acceleration_z', 'mode_detected', 'point_type', 'timestamp')
 
 
 class MobileCoordinatesActions:
+    copy_sql = 'COPY {table} ({columns}) FROM STDIN'.format(table=MobileCoordinate.__tablename__,
+                                                           columns=', '.join(COLUMNS))
+    # duplicates of an existing (mobile_id, timestamp) are skipped by COPYing into
+    # a transaction-scoped staging table and merging it with ON CONFLICT DO NOTHING;
+    # each staged row carries the index of its item so the stored rows are credited
+    # to the item they came from (the first one when items repeat a timestamp)
+    staging_table = 'mobile_coordinates_staging'
+    staging_sql = ('CREATE TEMPORARY TABLE IF NOT EXISTS {staging} ON COMMIT DROP AS '
+                   'SELECT 0 AS item_idx, {columns} FROM {table} WITH NO DATA').format(
+                       staging=staging_table,
+                       columns=', '.join(COLUMNS),
+                       table=MobileCoordinate.__tablename__)
+    staging_copy_sql = 'COPY {staging} (item_idx, {columns}) FROM STDIN'.format(staging=staging_table,
+                                                                               columns=', '.join(COLUMNS))
+    staging_insert_sql = text('INSERT INTO {staging} (item_idx, {columns}) VALUES (:item_idx, {values})'.format(
+        staging=staging_table,
+        columns=', '.join(COLUMNS),
+        values=', '.join(':' + c for c in COLUMNS)))
+    merge_sql = ('WITH source AS ('
+                 '  SELECT DISTINCT ON (mobile_id, timestamp) item_idx, {columns} FROM {staging}'
+                 '  ORDER BY mobile_id, timestamp, item_idx), '
+                 'inserted AS ('
+                 '  INSERT INTO {table} ({columns}) SELECT {columns} FROM source'
+                 '  ON CONFLICT DO NOTHING RETURNING mobile_id, timestamp) '
+                 'SELECT source.item_idx FROM inserted JOIN source USING (mobile_id, timestamp)').format(
+                     table=MobileCoordinate.__tablename__,
+                     columns=', '.join(COLUMNS),
+                     staging=staging_table)
+    dedupe_sql = text('DELETE FROM {table} WHERE id IN ('
+                      '  SELECT id FROM ('
+                      '    SELECT id, row_number() OVER (PARTITION BY mobile_id, timestamp ORDER BY id) AS n'
+                      '    FROM {table} WHERE mobile_id >= :first AND mobile_id < :last) AS d'
+                      '  WHERE d.n > 1)'.format(table=MobileCoordinate.__tablename__))
+
+    # COPY requires the raw psycopg2 connection; any other driver (e.g., sqlite
+    # in local testing) falls back to the ORM bulk insert
+    def _engine(self):
+        engine = current_app.config.get('COORDINATES_INGEST_ENGINE', 'copy')
+        if engine == 'copy':
+            dialect = db.session.connection().dialect
+            if dialect.name != 'postgresql' or dialect.driver != 'psycopg2':
+                engine = 'orm'
+        return engine
+
+    # split (survey_id, mobile_id, batch) items into chunks of at most n points
+    # as (item index, survey_id, mobile_id, piece); small batches from several
+    # devices are merged into the same chunk
     @staticmethod
-    def _chunks(iterable, n):
-        it = iter(iterable)
-        while True:
-            chunk = []
-            for i in range(n):
-                try:
-                    chunk.append(next(it))
-                except StopIteration:
+    def _chunks(batches, n):
+        chunk, size = [], 0
+        for idx, (survey_id, mobile_id, batch) in enumerate(batches):
+            offset = 0
+            while offset < len(batch):
+                piece = batch.slice(offset, offset + n - size)
+                chunk.append((idx, survey_id, mobile_id, piece))
+                offset += len(piece)
+                size += len(piece)
+                if size >= n:
                     yield chunk
-                    return
+                    chunk, size = [], 0
+        if chunk:
             yield chunk
 
-    def insert(self, user, coordinates):
-        survey_id, mobile_id = user.survey_id, user.id
+    # stream a chunk into COPY FROM STDIN using the connection already held by the
+    # session so the insert is committed (or rolled back) with the rest of the request
+    def _insert_copy(self, chunk, skip_duplicates):
+        cursor = db.session.connection().connection.cursor()
+        try:
+            if not skip_duplicates:
+                buf = io.StringIO(''.join([piece.copy_text(survey_id, mobile_id)
+                                           for _, survey_id, mobile_id, piece in chunk]))
+                cursor.copy_expert(self.copy_sql, buf)
+                return [(idx, len(piece)) for idx, _, _, piece in chunk]
+
+            buf = io.StringIO(''.join([piece.copy_text(survey_id, mobile_id, item_idx=idx)
+                                       for idx, survey_id, mobile_id, piece in chunk]))
+            cursor.execute(self.staging_sql)
+            cursor.copy_expert(self.staging_copy_sql, buf)
+            cursor.execute(self.merge_sql)
+            returned = [row[0] for row in cursor.fetchall()]
+            cursor.execute('TRUNCATE {}'.format(self.staging_table))
+        finally:
+            cursor.close()
+        return list(Counter(returned).items())
+
+    def _insert_orm(self, chunk, skip_duplicates):
+        if skip_duplicates and db.session.connection().dialect.name == 'postgresql':
+            rows = [dict(zip(COLUMNS, row), item_idx=idx)
+                    for idx, survey_id, mobile_id, piece in chunk
+                    for row in piece.rows(survey_id, mobile_id)]
+            db.session.execute(self.staging_sql)
+            db.session.execute(self.staging_insert_sql, rows)
+            returned = [row[0] for row in db.session.execute(self.merge_sql)]
+            db.session.execute('TRUNCATE {}'.format(self.staging_table))
+            return list(Counter(returned).items())
+
         bulk_rows = []
-        for chunk in self._chunks(coordinates, 5000):
-            for point in chunk:
-                coordinate = MobileCoordinate(
-                    survey_id=survey_id,
-                    mobile_id=mobile_id,
-                    latitude=point['latitude'],
-                    longitude=point['longitude'],
-                    altitude=point.get('altitude'),
-                    speed=point.get('speed'),
-                    direction=point.get('direction'),
-                    h_accuracy=point.get('h_accuracy'),
-                    v_accuracy=point.get('v_accuracy'),
-                    acceleration_x=point.get('acceleration_x'),
-                    acceleration_y=point.get('acceleration_y'),
-                    acceleration_z=point.get('acceleration_z'),
-                    mode_detected=point.get('mode_detected'),
-                    point_type=point.get('point_type'),
-                    timestamp=ciso8601.parse_datetime(point['timestamp'])
-                )
-                bulk_rows.append(coordinate)
+        for _, survey_id, mobile_id, piece in chunk:
+            for row in piece.rows(survey_id, mobile_id):
+                bulk_rows.append(MobileCoordinate(**dict(zip(COLUMNS, row))))
         db.session.bulk_save_objects(bulk_rows)
-        return bulk_rows
+        return [(idx, len(piece)) for idx, _, _, piece in chunk]
+
+    # coordinates are converted and flushed one chunk at a time so peak memory
+    # is bounded by the chunk size rather than the upload size; returns the
+    # number of rows inserted for each (survey_id, mobile_id, batch) item
+    def insert_batches(self, batches):
+        engine = self._engine()
+        chunk_size = current_app.config.get('COORDINATES_CHUNK_SIZE', 5000)
+        skip_duplicates = current_app.config.get('COORDINATES_SKIP_DUPLICATES', True)
+
+        start = time.time()
+        counts = [0] * len(batches)
+        for chunk in self._chunks(batches, chunk_size):
+            chunk_start = time.time()
+            if engine == 'copy':
+                inserted = self._insert_copy(chunk, skip_duplicates)
+            else:
+                inserted = self._insert_orm(chunk, skip_duplicates)
+            for idx, n in inserted:
+                counts[idx] += n
+            del chunk
+            metrics.observe('coordinates.insert.chunk', time.time() - chunk_start)
+        elapsed = time.time() - start
+        count = sum(counts)
+
+        metrics.throughput('coordinates.insert.' + engine, count, elapsed)
+        metrics.incr('coordinates.insert.skipped', sum(len(b) for _, _, b in batches) - count)
+        metrics.gauge('process.peak_rss_kb', peak_rss_kb())
+        logger.debug('Inserted {n} coordinates via {engine} ({rate:.0f} rows/s)'.format(
+            n=count, engine=engine, rate=count / elapsed if elapsed else 0.))
+        return counts
+
+    def insert(self, survey_id, mobile_id, batch):
+        return self.insert_batches([(survey_id, mobile_id, batch)])[0]
+
+    # delete all but the first stored row of each duplicated (mobile_id, timestamp)
+    # for users with first <= mobile_id < last; returns the number of rows removed
+    def delete_duplicates(self, first, last):
+        result = db.session.execute(self.dedupe_sql, {'first': first, 'last': last})
+        return result.rowcount
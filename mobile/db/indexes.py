@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Kyle Fitzsimmons, 2018
+#
+# Indexes built concurrently on live tables. A concurrent build that fails (e.g.,
+# on a duplicate key) leaves an INVALID index behind, which IF NOT EXISTS would
+# then keep; such an index is dropped and built again instead.
+from models import db
+
+
+class MobileIndexActions:
+    def is_valid(self, connection, name):
+        return connection.execute('SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)',
+                                  (name,)).scalar()
+
+    # builds the unique index `name` on `table` (`columns`) outside of the session's
+    # transaction; raises if the build fails, leaving the invalid index for a rerun
+    def create_unique_concurrently(self, name, table, columns):
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            if self.is_valid(connection, name) is False:
+                connection.execute('DROP INDEX CONCURRENTLY {name}'.format(name=name))
+            connection.execute('CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({columns})'.format(
+                name=name, table=table, columns=', '.join(columns)))
+            if not self.is_valid(connection, name):
+                raise RuntimeError('Index {} was not built.'.format(name))
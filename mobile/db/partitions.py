@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Kyle Fitzsimmons, 2018
+#
+# Lifecycle of the monthly mobile_coordinates partitions. Each partition is
+# named mobile_coordinates_yYYYYmMM and holds one UTC calendar month; rows
+# outside every monthly partition land in mobile_coordinates_default.
+from datetime import date, datetime
+import gzip
+import os
+
+from mobile.db.indexes import MobileIndexActions
+from models import db, MobileCoordinate
+
+PARENT = MobileCoordinate.__tablename__
+DEFAULT_PARTITION = PARENT + '_default'
+LEGACY_PARTITION = PARENT + '_legacy'
+# unique (id, timestamp) index of the old heap that becomes its primary key
+LEGACY_KEY = PARENT + '_id_timestamp_key'
+
+indexes = MobileIndexActions()
+
+
+def month_start(value):
+    return date(value.year, value.month, 1)
+
+
+def add_months(month, n):
+    months = month.year * 12 + month.month - 1 + n
+    return date(months // 12, months % 12 + 1, 1)
+
+
+def partition_name(month):
+    return '{parent}_y{year:04d}m{month:02d}'.format(parent=PARENT, year=month.year, month=month.month)
+
+
+def _bound(month):
+    return "'{:%Y-%m-%d} 00:00:00+00'".format(month)
+
+
+class MobileCoordinatePartitionsActions:
+    def is_partitioned(self):
+        relkind = db.session.execute("SELECT relkind FROM pg_class WHERE relname = :name "
+                                     "AND relnamespace = current_schema()::regnamespace",
+                                     {'name': PARENT}).scalar()
+        return relkind == 'p'
+
+    # attached partitions and detached (archivable) monthly tables with their sizes
+    def list(self):
+        rows = db.session.execute(
+            "SELECT c.relname, pg_total_relation_size(c.oid), i.inhrelid IS NOT NULL, "
+            "       pg_get_expr(c.relpartbound, c.oid) "
+            "FROM pg_class c "
+            "LEFT JOIN pg_inherits i ON i.inhrelid = c.oid AND i.inhparent = :parent ::regclass "
+            "WHERE c.relkind IN ('r', 'p') AND c.relname LIKE :pattern "
+            "AND c.relnamespace = current_schema()::regnamespace "
+            "ORDER BY c.relname",
+            {'parent': PARENT, 'pattern': PARENT + r'\_%'})
+        return [{'name': name, 'bytes': size, 'attached': attached, 'bounds': bounds}
+                for name, size, attached, bounds in rows]
+
+    # creates the partition for a month; rows already stored for that month in
+    # the default partition are moved into it before it is attached
+    def create(self, month):
+        month = month_start(month)
+        name = partition_name(month)
+        exists = db.session.execute('SELECT to_regclass(:name) IS NOT NULL', {'name': name}).scalar()
+        if exists:
+            return False
+
+        lower, upper = _bound(month), _bound(add_months(month, 1))
+        db.session.execute('CREATE TABLE {name} (LIKE {parent} INCLUDING DEFAULTS)'.format(name=name, parent=PARENT))
+        db.session.execute('WITH moved AS (DELETE FROM {default} WHERE timestamp >= {lower} AND timestamp < {upper} '
+                           '               RETURNING *) '
+                           'INSERT INTO {name} SELECT * FROM moved'.format(default=DEFAULT_PARTITION, name=name,
+                                                                           lower=lower, upper=upper))
+        db.session.execute('ALTER TABLE {parent} ATTACH PARTITION {name} FOR VALUES FROM ({lower}) TO ({upper})'.format(
+            parent=PARENT, name=name, lower=lower, upper=upper))
+        return True
+
+    # pre-creates the partitions from `start` (default: the current month) through
+    # `months_ahead` months later; returns the names of new partitions
+    def ensure(self, months_ahead=3, start=None):
+        start = month_start(start or datetime.utcnow())
+        created = []
+        for n in range(months_ahead + 1):
+            month = add_months(start, n)
+            if self.create(month):
+                created.append(partition_name(month))
+        return created
+
+    def detach(self, month):
+        name = partition_name(month_start(month))
+        db.session.execute('ALTER TABLE {parent} DETACH PARTITION {name}'.format(parent=PARENT, name=name))
+        return name
+
+    def is_attached(self, name):
+        return db.session.execute('SELECT EXISTS (SELECT 1 FROM pg_inherits '
+                                  '               WHERE inhrelid = to_regclass(:name) '
+                                  '               AND inhparent = :parent ::regclass)',
+                                  {'name': name, 'parent': PARENT}).scalar()
+
+    # writes a detached month to a gzipped COPY file in `directory` and drops it;
+    # returns the archive path. Months still attached are refused since their
+    # rows are visible through mobile_coordinates.
+    def archive(self, month, directory):
+        name = partition_name(month_start(month))
+        if self.is_attached(name):
+            raise ValueError('{} is still attached to {}; detach it before archiving.'.format(name, PARENT))
+        path = os.path.join(directory, name + '.copy.gz')
+        cursor = db.session.connection().connection.cursor()
+        try:
+            with open(path, 'wb') as f:
+                with gzip.GzipFile(fileobj=f, mode='wb') as compressed:
+                    cursor.copy_expert('COPY {name} TO STDOUT'.format(name=name), compressed)
+                f.flush()
+                os.fsync(f.fileno())
+        finally:
+            cursor.close()
+        db.session.execute('DROP TABLE {name}'.format(name=name))
+        return path
+
+    # Conversion of an existing unpartitioned table ============================
+    # Everything before `cutover` stays in the old heap, which is attached as a
+    # single partition. A validated CHECK constraint proves the range, so the
+    # attach does not rescan the table or hold long locks. The unique
+    # (mobile_id, timestamp) index must exist (manage.py coordinates unique_index);
+    # a unique (id, timestamp) index is built concurrently to become the old
+    # heap's primary key under the parent's. Rows without a timestamp cannot be
+    # partitioned and are only deleted when asked; returns the number deleted.
+    def prepare_conversion(self, cutover, delete_null_timestamps=False):
+        nulls = db.session.execute('SELECT count(*) FROM {parent} WHERE timestamp IS NULL'.format(
+            parent=PARENT)).scalar()
+        if nulls and not delete_null_timestamps:
+            raise ValueError('{n} rows of {parent} have no timestamp and cannot be partitioned; '
+                             'they must be deleted first.'.format(n=nulls, parent=PARENT))
+        indexes.create_unique_concurrently(LEGACY_KEY, PARENT, ['id', 'timestamp'])
+        deleted = 0
+        if nulls:
+            deleted = db.session.execute('DELETE FROM {parent} WHERE timestamp IS NULL'.format(
+                parent=PARENT)).rowcount
+        db.session.execute('ALTER TABLE {parent} ADD CONSTRAINT {legacy}_range '
+                           'CHECK (timestamp IS NOT NULL AND timestamp < {cutover}) NOT VALID'.format(
+                               parent=PARENT, legacy=LEGACY_PARTITION, cutover=_bound(cutover)))
+        return deleted
+
+    def validate_conversion(self):
+        db.session.execute('ALTER TABLE {parent} VALIDATE CONSTRAINT {legacy}_range'.format(
+            parent=PARENT, legacy=LEGACY_PARTITION))
+
+    def convert(self, cutover):
+        index_names = [index.name for index in MobileCoordinate.__table__.indexes]
+        statements = [
+            'ALTER TABLE {parent} ALTER COLUMN timestamp SET NOT NULL',
+            'ALTER TABLE {parent} RENAME TO {legacy}',
+            'ALTER TABLE {legacy} RENAME CONSTRAINT {parent}_pkey TO {legacy}_pkey',
+        ]
+        statements += ['ALTER INDEX {index} RENAME TO {index}_legacy'.format(index=name) for name in index_names]
+        statements += [
+            'CREATE TABLE {parent} (LIKE {legacy} INCLUDING DEFAULTS) PARTITION BY RANGE (timestamp)',
+            'ALTER SEQUENCE {parent}_id_seq OWNED BY {parent}.id',
+            'ALTER TABLE {parent} ATTACH PARTITION {legacy} FOR VALUES FROM (MINVALUE) TO ({cutover})',
+            'CREATE TABLE {default} PARTITION OF {parent} DEFAULT',
+            'ALTER TABLE {legacy} DROP CONSTRAINT {legacy}_pkey, '
+            'ADD CONSTRAINT {legacy}_pkey PRIMARY KEY USING INDEX {legacy_key}',
+            'ALTER TABLE {parent} ADD PRIMARY KEY (id, timestamp)'
+        ]
+        # matching indexes and foreign keys of the old heap are attached rather than rebuilt
+        for index in MobileCoordinate.__table__.indexes:
+            statements.append('CREATE {unique}INDEX {name} ON {{parent}} ({columns})'.format(
+                unique='UNIQUE ' if index.unique else '', name=index.name,
+                columns=', '.join(c.name for c in index.columns)))
+        for fk in MobileCoordinate.__table__.foreign_keys:
+            statements.append('ALTER TABLE {{parent}} ADD FOREIGN KEY ({column}) REFERENCES {table} ({target}) '
+                              'ON DELETE {ondelete}'.format(column=fk.parent.name, table=fk.column.table.name,
+                                                            target=fk.column.name, ondelete=fk.ondelete))
+        for statement in statements:
+            db.session.execute(statement.format(parent=PARENT, legacy=LEGACY_PARTITION, default=DEFAULT_PARTITION,
+                                                legacy_key=LEGACY_KEY, cutover=_bound(cutover)))
@@ -1,11 +1,13 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 # Kyle Fitzsimmons, 2017
-from datetime import datetime
-import pytz
+from sqlalchemy import func, literal_column
+from sqlalchemy.dialects import postgresql
 
 from models import db, PromptResponse
 
+UNIQUE_CONSTRAINT = 'mobile_prompt_responses_uuid_num_key'
+
 
 class MobilePromptsActions:
 
@@ -13,48 +15,46 @@ class MobilePromptsActions:
         prompts_filters = PromptResponse.prompt_uuid.in_(prompts_uuids)
         return db.session.query(PromptResponse).filter(prompts_filters)
 
-
-    # formats a prompts query to a lookup dictionary
-    # [p0, p1, p2] --> {p0_uuid: {p0_prompt_num: p0}, ...}
-    def create_lookup(self, prompts):
-        prompts_lookup = {}
-        for p in prompts:
-            prompts_lookup.setdefault(p.prompt_uuid, {})
-            prompts_lookup[p.prompt_uuid][p.prompt_num] = p
-        return prompts_lookup
-
-    def upsert(self, user, prompts):
-        prompts_uuids = {p['uuid'] for p in prompts}
-        existing_prompts = self.get(prompts_uuids)
-        existing_lookup = self.create_lookup(existing_prompts)
-
-        responses = []
+    # inserts new prompt answers and updates edited ones in a single statement;
+    # returns a row of (id, prompt_uuid, inserted) for each prompt written
+    def upsert(self, survey_id, mobile_id, prompts):
+        rows = {}
         for prompt in prompts:
             # gracefully handle change of 'timestamp' -> 'displayed_at'
             if 'timestamp' in prompt:
                 prompt['displayed_at'] = prompt.pop('timestamp')
 
-            uuid = prompt['uuid']
+            # a prompt repeated within the request is written once, as its last answer
             prompt_num = int(prompt['prompt_num'])
-            if uuid in existing_lookup:
-                response = existing_lookup[uuid][prompt_num]
-                response.response = prompt['answer']
-                response.recorded_at = prompt['recorded_at']
-                response.latitude = prompt['latitude']
-                response.longitude = prompt['longitude']
-                response.edited_at = datetime.now(pytz.utc)
-            else:
-                response = PromptResponse(
-                    survey_id=user.survey_id,
-                    mobile_id=user.id,
-                    prompt_uuid=uuid,
-                    prompt_num=prompt_num,
-                    response=prompt['answer'],
-                    displayed_at=prompt['displayed_at'],
-                    recorded_at=prompt['recorded_at'],
-                    latitude=prompt['latitude'],
-                    longitude=prompt['longitude'])
-            responses.append(response)
-        db.session.bulk_save_objects(responses)
-        db.session.commit()
-        return responses
+            rows[(prompt['uuid'], prompt_num)] = {
+                'survey_id': survey_id,
+                'mobile_id': mobile_id,
+                'prompt_uuid': prompt['uuid'],
+                'prompt_num': prompt_num,
+                'response': prompt['answer'],
+                'displayed_at': prompt['displayed_at'],
+                'recorded_at': prompt['recorded_at'],
+                'latitude': prompt['latitude'],
+                'longitude': prompt['longitude'],
+                'edited_at': func.now()
+            }
+        if not rows:
+            return []
+
+        table = PromptResponse.__table__
+        statement = postgresql.insert(table).values(list(rows.values()))
+        # edits only apply to the device's own answers
+        statement = statement.on_conflict_do_update(
+            constraint=UNIQUE_CONSTRAINT,
+            set_={
+                'response': statement.excluded.response,
+                'recorded_at': statement.excluded.recorded_at,
+                'latitude': statement.excluded.latitude,
+                'longitude': statement.excluded.longitude,
+                'edited_at': func.now()
+            },
+            where=(table.c.mobile_id == statement.excluded.mobile_id))
+        # xmax is only zero for a row version created by an insert
+        statement = statement.returning(table.c.id, table.c.prompt_uuid,
+                                        literal_column('xmax = 0').label('inserted'))
+        return db.session.execute(statement).fetchall()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Kyle Fitzsimmons, 2018
+#
+# Per-user statistics in statistics_mobile_users. Totals are incremented with
+# one upsert per /update in the same transaction as the inserted rows, and can
+# be recomputed from the data tables for a range of users with `rebuild`.
+# Survey totals in statistics_surveys are added to by the rollups flusher
+# (mobile/rollups.py) and recomputed from the per-user totals by `reconcile`;
+# both first lock the global statistics row so they are never interleaved.
+from sqlalchemy import func, text
+from sqlalchemy.dialects import postgresql
+
+from models import db, Stats, SurveyStats
+
+# statistics holds a single row of global totals
+STATS_ID = 1
+
+
+class MobileStatsActions:
+    # latest_coordinate is the user's newest point by timestamp; latest_prompt and
+    # latest_cancelled_prompt are the last rows stored by this request, looked
+    # up by their (indexed) prompt uuids
+    increment_sql = text('''
+        INSERT INTO statistics_mobile_users AS s
+            (survey_id, mobile_id, total_coordinates, total_prompts, total_cancelled_prompts,
+             latest_coordinate, latest_prompt, latest_cancelled_prompt)
+        VALUES (:survey_id, :mobile_id, :coordinates, :prompts, :cancelled_prompts,
+                CASE WHEN :coordinates > 0 THEN
+                    (SELECT id FROM mobile_coordinates WHERE mobile_id = :mobile_id
+                     ORDER BY timestamp DESC LIMIT 1) END,
+                (SELECT max(id) FROM mobile_prompt_responses
+                 WHERE prompt_uuid = ANY(:prompt_uuids) AND mobile_id = :mobile_id),
+                (SELECT max(id) FROM mobile_cancelled_prompt_responses
+                 WHERE prompt_uuid = ANY(:cancelled_prompt_uuids) AND mobile_id = :mobile_id))
+        ON CONFLICT (mobile_id) DO UPDATE SET
+            total_coordinates = coalesce(s.total_coordinates, 0) + excluded.total_coordinates,
+            total_prompts = coalesce(s.total_prompts, 0) + excluded.total_prompts,
+            total_cancelled_prompts = coalesce(s.total_cancelled_prompts, 0) + excluded.total_cancelled_prompts,
+            latest_coordinate = coalesce(excluded.latest_coordinate, s.latest_coordinate),
+            latest_prompt = coalesce(excluded.latest_prompt, s.latest_prompt),
+            latest_cancelled_prompt = coalesce(excluded.latest_cancelled_prompt, s.latest_cancelled_prompt)
+    ''')
+
+    # locking the existing rows first makes concurrent increments wait, so their
+    # rows are either counted here or added on top once this commits
+    lock_sql = text('SELECT 1 FROM statistics_mobile_users WHERE mobile_id >= :first AND mobile_id < :last '
+                    'FOR UPDATE')
+    rebuild_sql = text('''
+        INSERT INTO statistics_mobile_users
+            (survey_id, mobile_id, total_coordinates, total_prompts, total_cancelled_prompts,
+             latest_coordinate, latest_prompt, latest_cancelled_prompt)
+        SELECT u.survey_id, u.id, coalesce(c.total, 0), coalesce(p.total, 0), coalesce(cp.total, 0),
+               lc.id, p.latest, cp.latest
+        FROM mobile_users u
+        LEFT JOIN (SELECT mobile_id, count(*) AS total FROM mobile_coordinates
+                   WHERE mobile_id >= :first AND mobile_id < :last GROUP BY mobile_id) c ON c.mobile_id = u.id
+        LEFT JOIN (SELECT DISTINCT ON (mobile_id) mobile_id, id FROM mobile_coordinates
+                   WHERE mobile_id >= :first AND mobile_id < :last
+                   ORDER BY mobile_id, timestamp DESC) lc ON lc.mobile_id = u.id
+        LEFT JOIN (SELECT mobile_id, count(*) AS total, max(id) AS latest FROM mobile_prompt_responses
+                   WHERE mobile_id >= :first AND mobile_id < :last GROUP BY mobile_id) p ON p.mobile_id = u.id
+        LEFT JOIN (SELECT mobile_id, count(*) AS total, max(id) AS latest FROM mobile_cancelled_prompt_responses
+                   WHERE mobile_id >= :first AND mobile_id < :last GROUP BY mobile_id) cp ON cp.mobile_id = u.id
+        WHERE u.id >= :first AND u.id < :last
+        ON CONFLICT (mobile_id) DO UPDATE SET
+            survey_id = excluded.survey_id,
+            total_coordinates = excluded.total_coordinates,
+            total_prompts = excluded.total_prompts,
+            total_cancelled_prompts = excluded.total_cancelled_prompts,
+            latest_coordinate = excluded.latest_coordinate,
+            latest_prompt = excluded.latest_prompt,
+            latest_cancelled_prompt = excluded.latest_cancelled_prompt
+    ''')
+
+    def increment(self, survey_id, mobile_id, coordinates=0, prompt_uuids=None, cancelled_prompt_uuids=None,
+                  cancelled_prompts_deleted=0):
+        prompt_uuids = list(prompt_uuids or [])
+        cancelled_prompt_uuids = list(cancelled_prompt_uuids or [])
+        cancelled_prompts = len(cancelled_prompt_uuids) - cancelled_prompts_deleted
+        if not any([coordinates, prompt_uuids, cancelled_prompts, cancelled_prompt_uuids]):
+            return
+        db.session.execute(self.increment_sql, {
+            'survey_id': survey_id,
+            'mobile_id': mobile_id,
+            'coordinates': coordinates,
+            'prompts': len(prompt_uuids),
+            'cancelled_prompts': cancelled_prompts,
+            'prompt_uuids': prompt_uuids,
+            'cancelled_prompt_uuids': cancelled_prompt_uuids
+        })
+
+    # recomputes the stats of users with first <= mobile_id < last; returns the
+    # number of users written
+    def rebuild(self, first, last):
+        params = {'first': first, 'last': last}
+        db.session.execute(self.lock_sql, params)
+        return db.session.execute(self.rebuild_sql, params).rowcount
+
+    # adds {survey_id: {'coordinates': n, 'prompts': n, 'cancelled_prompts': n}}
+    # to the survey totals; rows are written in survey order so concurrent
+    # flushes from several workers cannot deadlock
+    def add_survey_totals(self, deltas):
+        table = SurveyStats.__table__
+        rows = [{'id': survey_id,
+                 'total_coordinates': delta['coordinates'],
+                 'total_prompts': delta['prompts'],
+                 'total_cancelled_prompts': delta['cancelled_prompts']}
+                for survey_id, delta in sorted(deltas.items())]
+        statement = postgresql.insert(table).values(rows)
+        statement = statement.on_conflict_do_update(index_elements=[table.c.id], set_={
+            column: func.coalesce(table.c[column], 0) + statement.excluded[column]
+            for column in ('total_coordinates', 'total_prompts', 'total_cancelled_prompts')
+        })
+        db.session.execute(statement)
+        self._touch(last_survey_stats_update=func.now(), last_mobile_stats_update=func.now())
+
+    # upserts the global statistics row to lock it until the transaction ends
+    lock_totals_sql = text('INSERT INTO statistics (id) VALUES (:id) ON CONFLICT (id) DO UPDATE SET id = excluded.id '
+                           'RETURNING extract(epoch FROM last_survey_reconcile)')
+
+    # locks the survey totals against a concurrent reconcile; returns the time of
+    # the last reconcile in epoch seconds (None if never reconciled)
+    def lock_survey_totals(self):
+        return db.session.execute(self.lock_totals_sql, {'id': STATS_ID}).scalar()
+
+    # the statement's start time is that of the per-user totals it sums
+    reconcile_sql = text('''
+        INSERT INTO statistics_surveys (id, total_coordinates, total_prompts, total_cancelled_prompts)
+        SELECT s.id, coalesce(sum(m.total_coordinates), 0), coalesce(sum(m.total_prompts), 0),
+               coalesce(sum(m.total_cancelled_prompts), 0)
+        FROM surveys s
+        LEFT JOIN statistics_mobile_users m ON m.survey_id = s.id
+        GROUP BY s.id
+        ON CONFLICT (id) DO UPDATE SET
+            total_coordinates = excluded.total_coordinates,
+            total_prompts = excluded.total_prompts,
+            total_cancelled_prompts = excluded.total_cancelled_prompts
+        RETURNING statement_timestamp()
+    ''')
+
+    # corrects drift in the survey totals (e.g., deltas lost with a worker) from
+    # the transactional per-user totals; returns the number of surveys written.
+    # Deltas still pending in the workers' rollups when it runs are skipped by
+    # their next flush.
+    def reconcile(self):
+        self.lock_survey_totals()
+        rows = db.session.execute(self.reconcile_sql).fetchall()
+        self._touch(total_surveys=db.session.execute('SELECT count(*) FROM surveys').scalar(),
+                    last_stats_update=func.now(),
+                    last_survey_stats_update=func.now(),
+                    last_survey_reconcile=rows[0][0] if rows else func.now())
+        return len(rows)
+
+    def _touch(self, **values):
+        statement = postgresql.insert(Stats.__table__).values(id=STATS_ID, **values)
+        db.session.execute(statement.on_conflict_do_update(index_elements=[Stats.__table__.c.id],
+                                                           set_=values))
@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 # Kyle Fitzsimmons, 2017
+from sqlalchemy.dialects import postgresql
+
 from models import (db, PromptQuestion, Survey, SurveyQuestion, SurveyResponse)
 
 from hardcoded_survey_questions import lookup, default_stack
@@ -10,10 +12,10 @@ DEFAULT_STACK_COLUMNS = [q['colName'] for q in default_stack]
 
 class MobileSurveyActions:
     @staticmethod
-    def _map_hardcoded_ints(survey, column, answer):
+    def _map_hardcoded_ints(survey_name, language, column, answer):
         # Intercept MTL Trajet 2018 and map their updated hardcoded modes.
         # TO DO: Remove this when hardcoded questions removed from platform.
-        if survey.name in ['mtlte2018', 'mtltf2018', 'mtlte2018ios', 'mtltf2018ios', 'mtlte2018cm', 'mtltf2018cm']:
+        if survey_name in ['mtlte2018', 'mtltf2018', 'mtlte2018ios', 'mtltf2018ios', 'mtlte2018cm', 'mtltf2018cm']:
             en_occupations = [
                 'A full-time worker',
                 'A part-time worker',
@@ -53,15 +55,15 @@ class MobileSurveyActions:
 
             choices = None
             if column == 'member_type':
-                if survey.language == 'en':
+                if language == 'en':
                     choices = en_occupations
-                elif survey.language == 'fr':
+                elif language == 'fr':
                     choices = fr_occupations
                 return choices[int(answer)]
             elif column in ['travel_mode_work', 'travel_mode_study']:
-                if survey.language == 'en':
+                if language == 'en':
                     choices = en_modes
-                elif survey.language == 'fr':
+                elif language == 'fr':
                     choices = fr_modes
                 # make sure answer is supplied as an iterable                
                 if not isinstance(answer, list):
@@ -72,9 +74,9 @@ class MobileSurveyActions:
                     selected_modes.append(text_answer)
                 return selected_modes
             elif column in ['travel_mode_alt_work', 'travel_mode_alt_study']:
-                if survey.language == 'en':
+                if language == 'en':
                     choices = ['No'] + en_modes
-                elif survey.language == 'fr':
+                elif language == 'fr':
                     choices = ['Non'] + fr_modes
                 # make sure answer is supplied as an iterable                
                 if not isinstance(answer, list):
@@ -86,7 +88,7 @@ class MobileSurveyActions:
                 return selected_modes
             elif column in DEFAULT_STACK_COLUMNS:
                 index = DEFAULT_STACK_COLUMNS.index(column)
-                if survey.language == 'en':
+                if language == 'en':
                     choices = default_stack[index]['fields'].get('choices')
                 else:
                     choices = default_stack[index]['fields'].get('choices_fr')
@@ -97,7 +99,7 @@ class MobileSurveyActions:
         # handle all other surveys as normal
         if column in DEFAULT_STACK_COLUMNS:
             index = DEFAULT_STACK_COLUMNS.index(column)
-            if survey.language == 'en':
+            if language == 'en':
                 choices = default_stack[index]['fields'].get('choices')
             else:
                 choices = default_stack[index]['fields'].get('choices_fr')
@@ -111,27 +113,24 @@ class MobileSurveyActions:
     def find_by_name(self, name):
         return Survey.query.filter(Survey.name.ilike(name)).one_or_none()
 
-    def upsert(self, user, answers):
-        survey = user.survey
+    # stores the user's mapped survey answers in a single statement; returns
+    # False without writing when the stored answers are the same
+    def upsert(self, survey_id, mobile_id, answers, survey_name, language):
         for column, answer in answers.items():
             # handle singular list responses--this conflicts with the sepcial
             # case handling for MTL Trajet 2018. This is reverted by the special case
             # function and should be handled better.
             if isinstance(answer, list) and len(answer) == 1:
                 answer = answer[0]
-            text_answer = self._map_hardcoded_ints(survey, column, answer)
+            text_answer = self._map_hardcoded_ints(survey_name, language, column, answer)
             answers[column] = text_answer
-        if user.survey_response.one_or_none():
-            response = user.survey_response
-            response.answers = answers
-        else:
-            response = SurveyResponse(
-                survey_id=survey.id,
-                mobile_id=user.id,
-                response=answers)
-            db.session.add(response)
-        db.session.commit()
-        return response
+        table = SurveyResponse.__table__
+        statement = postgresql.insert(table).values(survey_id=survey_id, mobile_id=mobile_id, response=answers)
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.mobile_id],
+            set_={'response': statement.excluded.response},
+            where=table.c.response.is_distinct_from(statement.excluded.response))
+        return db.session.execute(statement.returning(table.c.id)).first() is not None
 
     def formatted_survey_questions(self, survey):
         survey_json = []
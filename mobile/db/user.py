@@ -4,48 +4,72 @@
 import ciso8601
 from datetime import datetime
 import pytz
+from sqlalchemy import func
+from sqlalchemy.dialects import postgresql
 
-from models import db, MobileUser
+from models import db, MobileUser, Survey
+
+
+# The ids and survey settings needed to store a device's uploads
+class UserContext(object):
+    def __init__(self, uuid, mobile_id, survey_id, survey_name, language, gps_accuracy_threshold,
+                 coordinates_filter, coordinates_filter_max_speed):
+        self.uuid = uuid
+        self.mobile_id = mobile_id
+        self.survey_id = survey_id
+        self.survey_name = survey_name
+        self.language = language
+        self.gps_accuracy_threshold = gps_accuracy_threshold
+        self.coordinates_filter = coordinates_filter
+        self.coordinates_filter_max_speed = coordinates_filter_max_speed
 
 
 class MobileUserActions:
     def find_by_uuid(self, uuid):
         return MobileUser.query.filter_by(uuid=uuid).one_or_none()
 
+    def find_context(self, uuid):
+        row = (db.session.query(MobileUser.id, MobileUser.survey_id, Survey.name, Survey.language,
+                                Survey.gps_accuracy_threshold, Survey.coordinates_filter,
+                                Survey.coordinates_filter_max_speed)
+               .join(Survey, Survey.id == MobileUser.survey_id)
+               .filter(MobileUser.uuid == uuid)
+               .one_or_none())
+        if row:
+            return UserContext(uuid, *row)
+
     def _has_answered_survey(self, user):
         return user.survey_response.one_or_none()
 
-    def create(self, survey, user_data):
+    # registers a device, or updates the device details of a known uuid, in a
+    # single statement; returns the user's id
+    def create(self, survey_id, user_data):
         created_at = user_data.get('created_at')
         if created_at:
             created_at = ciso8601.parse_datetime(created_at)
         else:
             created_at = datetime.now(pytz.utc)
 
-        existing = self.find_by_uuid(uuid=user_data['uuid'])
-        if not existing:
-            user = MobileUser(
-                survey_id=survey.id,
-                uuid=user_data['uuid'],
-                model=user_data['model'],
-                itinerum_version=user_data['itinerum_version'],
-                os=user_data['os'],
-                os_version=user_data['os_version'],
-                created_at=created_at
-            )
-            db.session.add(user)
-            db.session.commit()
-            return user
-
+        table = MobileUser.__table__
+        statement = postgresql.insert(table).values(
+            survey_id=survey_id,
+            uuid=user_data['uuid'],
+            model=user_data['model'],
+            itinerum_version=user_data['itinerum_version'],
+            os=user_data['os'],
+            os_version=user_data['os_version'],
+            created_at=created_at)
         # TODO: disabled for testing but re-enable when we go live!
-        # (toggles wheter survey answers can be edited via phone)
-        # elif existing and not self._has_answered_survey(existing):
-        else:
-            existing.model = user_data['model']
-            existing.itinerum_version = user_data['itinerum_version'],
-            existing.os = user_data['os'],
-            existing.os_version = user_data['os_version'],
-            existing.created_at = created_at
-            db.session.add(existing)
-            db.session.commit()
-            return existing
+        # (toggles wheter survey answers can be edited via phone by only updating
+        # users without a survey response, see _has_answered_survey)
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.uuid],
+            set_={
+                'model': statement.excluded.model,
+                'itinerum_version': statement.excluded.itinerum_version,
+                'os': statement.excluded.os,
+                'os_version': statement.excluded.os_version,
+                'created_at': statement.excluded.created_at,
+                'modified_at': func.now()
+            })
+        return db.session.execute(statement.returning(table.c.id)).scalar()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Kyle Fitzsimmons, 2018
+#
+# Survey definitions served by /create. The formatted questions, prompts and
+# survey settings are built once per (survey id, modified_at) and cached in the
+# worker; survey names map to that key for a shorter time, after which one small
+# query revalidates it. Each worker therefore sees a modified survey within the
+# name TTL, and any other change within the definition TTL.
+#
+# Names matching no survey are remembered for a short time as well, and the
+# requests of a launch that all miss the cache at once share a single load.
+#
+# Each definition carries an ETag hashed from its serialized payload when it is
+# built. Clients that send a matching If-None-Match receive the short payload
+# without the large survey and prompt blocks. Both payloads are kept encoded so
+# a /create response only serializes the user's own fields.
+from flask import current_app
+import hashlib
+import json
+
+from mobile import caches
+from mobile.database import Database
+from utils.data import rename_json_keys, underscore_to_camelcase
+
+database = Database()
+
+# fields omitted from the /create response when the client's copy is current
+LARGE_FIELDS = ('survey', 'prompt', 'aboutText', 'termsOfService')
+
+
+class SurveyDefinition(object):
+    def __init__(self, survey_id, modified_at, payload):
+        self.survey_id = survey_id
+        self.modified_at = modified_at
+        # the camelCased /create response body, except for the user's fields
+        self.payload = payload
+        serialized = json.dumps(payload, sort_keys=True, separators=(',', ':')).encode('utf-8')
+        self.etag = hashlib.sha256(serialized).hexdigest()[:32]
+        self.short_payload = {k: v for k, v in payload.items() if k not in LARGE_FIELDS}
+        self.short_payload['surveyNotModified'] = True
+        self.encoded_payload = json.dumps(payload, separators=(',', ':'))
+        self.encoded_short_payload = json.dumps(self.short_payload, separators=(',', ':'))
+
+
+def get_default_avatar_path():
+    return '{base}/static/{avatar}'.format(base=current_app.config['ASSETS_ROUTE'],
+                                           avatar=current_app.config['DEFAULT_AVATAR_FILENAME'])
+
+
+def build_definition(survey):
+    survey_json = database.survey.formatted_survey_questions(survey)
+    prompts_json = database.survey.formatted_survey_prompts(survey)
+    # supply a default max_prompts value of 0 if no prompts are set instead of None
+    max_prompts = survey.max_prompts if len(prompts_json) > 0 else 0
+    payload = {
+        'contact_email': survey.contact_email,
+        'default_avatar': get_default_avatar_path(),
+        'avatar': survey.avatar_uri,
+        'survey': survey_json,
+        'prompt': {
+            'max_days': survey.max_survey_days,
+            'max_prompts': max_prompts,
+            'num_prompts': len(prompts_json),
+            'prompts': prompts_json
+        },
+        'lang': survey.language,
+        'about_text': survey.about_text,
+        'terms_of_service': survey.terms_of_service,
+        'survey_name': survey.pretty_name,
+        'record_acceleration': survey.record_acceleration,
+        'record_mode': survey.record_mode
+    }
+    return SurveyDefinition(survey.id, survey.modified_at, rename_json_keys(payload, underscore_to_camelcase))
+
+
+# returns the definition of the survey with the given (lowercased) name or None
+# when there is no such survey; concurrent misses for a name share one load
+def find_definition(name):
+    if caches.unknown_survey_names.get(name):
+        return None
+    key = caches.survey_names.get(name)
+    definition = caches.survey_definitions.get(key) if key else None
+    if definition is None:
+        definition = caches.survey_loads.do(name, lambda: _load_definition(name))
+    return definition
+
+
+def _load_definition(name):
+    survey = None
+    key = caches.survey_names.get(name)
+    if key is None:
+        survey = database.survey.find_by_name(name)
+        if not survey:
+            caches.unknown_survey_names.set(name, True)
+            return None
+        key = (survey.id, survey.modified_at)
+        caches.survey_names.set(name, key)
+
+    definition = caches.survey_definitions.get(key)
+    if definition is None:
+        survey = survey or database.survey.get(key[0])
+        if not survey:
+            caches.survey_names.pop(name)
+            return None
+        definition = build_definition(survey)
+        caches.survey_definitions.set(key, definition)
+    return definition
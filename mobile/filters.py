@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Kyle Fitzsimmons, 2018
+#
+# Ingest filter stage for uploaded coordinates. Points are rejected when their
+# horizontal accuracy is worse than the survey's gps_accuracy_threshold or when
+# they are an isolated jump that would require travelling faster than the
+# configured maximum speed both to reach the point and to leave it again.
+# Each test works column by column over a whole CoordinateBatch.
+from math import asin, cos, radians, sin, sqrt
+
+EARTH_RADIUS_M = 6371008.8
+
+
+# great-circle distances in metres between consecutive points of the given
+# latitude and longitude columns
+def consecutive_distances(latitudes, longitudes):
+    lats = [radians(v) for v in latitudes]
+    lngs = [radians(v) for v in longitudes]
+    cos_lats = [cos(v) for v in lats]
+    return [2 * EARTH_RADIUS_M * asin(min(1., sqrt(sin((lat2 - lat1) / 2) ** 2 +
+                                                   cos1 * cos2 * sin((lng2 - lng1) / 2) ** 2)))
+            for lat1, lat2, lng1, lng2, cos1, cos2 in zip(lats, lats[1:], lngs, lngs[1:],
+                                                          cos_lats, cos_lats[1:])]
+
+
+def _speeds(batch):
+    distances = consecutive_distances(batch.columns['latitude'], batch.columns['longitude'])
+    speeds = []
+    for distance, t1, t2 in zip(distances, batch.timestamps, batch.timestamps[1:]):
+        elapsed = t2 - t1
+        if elapsed > 0:
+            speeds.append(distance / elapsed)
+        else:
+            speeds.append(float('inf') if distance else 0.)
+    return speeds
+
+
+# indexes of points with an h_accuracy above the threshold; missing accuracies pass
+def inaccurate_points(batch, accuracy_threshold):
+    if not accuracy_threshold:
+        return []
+    return [i for i, v in enumerate(batch.columns['h_accuracy']) if v > accuracy_threshold]
+
+
+# indexes of interior points where both the speed from the previous point and
+# the speed to the next point exceed max_speed (m/s); `batch` must be in
+# timestamp order
+def speed_outliers(batch, max_speed):
+    if not max_speed or len(batch) < 3:
+        return []
+    speeds = _speeds(batch)
+    return [i + 1 for i, (speed_in, speed_out) in enumerate(zip(speeds, speeds[1:]))
+            if speed_in > max_speed and speed_out > max_speed]
+
+
+# returns the batch of accepted points (in timestamp order) and the number of
+# points rejected by each test
+def filter_coordinates(batch, accuracy_threshold=None, max_speed=None):
+    batch = batch.take(batch.sorted_indexes())
+    inaccurate = set(inaccurate_points(batch, accuracy_threshold))
+    if inaccurate:
+        batch = batch.take([i for i in range(len(batch)) if i not in inaccurate])
+    outliers = set(speed_outliers(batch, max_speed))
+    if outliers:
+        batch = batch.take([i for i in range(len(batch)) if i not in outliers])
+    return batch, {'accuracy': len(inaccurate), 'speed': len(outliers)}
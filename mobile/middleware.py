@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Kyle Fitzsimmons, 2018
+#
+# WSGI middleware for transparent decompression of gzip or deflate encoded
+# request bodies. The compressed body is inflated incrementally, at most
+# READ_SIZE bytes at a time, as the request stream is read: a sized read holds
+# no more than one extra chunk, while read() without a size (as Flask's
+# get_data does) returns the whole decompressed body. Decompression stops with
+# a 413 once the configured maximum size is exceeded.
+import zlib
+
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge, UnsupportedMediaType
+from werkzeug.wsgi import LimitedStream, get_content_length
+
+from utils.metrics import metrics
+
+# zlib window bits for each supported Content-Encoding; 32 + MAX_WBITS detects
+# either a gzip or zlib header
+WBITS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'x-gzip': 16 + zlib.MAX_WBITS,
+    'deflate': 32 + zlib.MAX_WBITS
+}
+READ_SIZE = 64 * 1024
+
+
+class DecompressingStream(object):
+    def __init__(self, stream, encoding, max_size):
+        self._stream = stream
+        self._encoding = encoding
+        self._decompressor = zlib.decompressobj(WBITS[encoding])
+        self._buffer = bytearray()
+        self._eof = False
+        self.max_size = max_size
+        self.compressed_size = 0
+        self.size = 0
+
+    def _inflate(self, data):
+        try:
+            # bound the output so a small input cannot expand past the limit; the
+            # rest of the input is kept in unconsumed_tail for the next call
+            out = self._decompressor.decompress(data, min(READ_SIZE, self.max_size - self.size + 1))
+        except zlib.error as e:
+            raise BadRequest('Invalid {} request body: {}'.format(self._encoding, e))
+        return self._counted(out)
+
+    def _counted(self, out):
+        self.size += len(out)
+        if self.size > self.max_size:
+            raise RequestEntityTooLarge('Decompressed request body exceeds {} bytes.'.format(self.max_size))
+        return out
+
+    def _fill(self, n):
+        while not self._eof and (n < 0 or len(self._buffer) < n):
+            if self._decompressor.unconsumed_tail:
+                self._buffer += self._inflate(self._decompressor.unconsumed_tail)
+                continue
+            chunk = self._stream.read(READ_SIZE)
+            if not chunk:
+                self._eof = True
+                self._buffer += self._counted(self._decompressor.flush())
+                metrics.observe('request.decompressed_bytes', self.size)
+                metrics.observe('request.compressed_bytes', self.compressed_size)
+                break
+            self.compressed_size += len(chunk)
+            self._buffer += self._inflate(chunk)
+
+    def read(self, n=-1):
+        if n is None:
+            n = -1
+        self._fill(n)
+        if n < 0:
+            data, self._buffer = bytes(self._buffer), bytearray()
+        else:
+            data = bytes(self._buffer[:n])
+            del self._buffer[:n]
+        return data
+
+    def readline(self, limit=-1):
+        while b'\n' not in self._buffer and not self._eof:
+            self._fill(len(self._buffer) + READ_SIZE)
+        end = self._buffer.find(b'\n') + 1 or len(self._buffer)
+        if limit is not None and limit >= 0:
+            end = min(end, limit)
+        data = bytes(self._buffer[:end])
+        del self._buffer[:end]
+        return data
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+
+class DecompressRequestMiddleware(object):
+    def __init__(self, wsgi_app, max_size):
+        self.wsgi_app = wsgi_app
+        self.max_size = max_size
+
+    def __call__(self, environ, start_response):
+        encoding = environ.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+        if encoding and encoding != 'identity':
+            if encoding not in WBITS:
+                error = UnsupportedMediaType('Unsupported Content-Encoding: {}'.format(encoding))
+                return error(environ, start_response)
+
+            stream = environ['wsgi.input']
+            content_length = get_content_length(environ)
+            if content_length is not None:
+                stream = LimitedStream(stream, content_length)
+            environ['wsgi.input'] = DecompressingStream(stream, encoding, self.max_size)
+            # the decompressed length is unknown until the body has been read
+            environ['wsgi.input_terminated'] = True
+            environ.pop('CONTENT_LENGTH', None)
+            environ.pop('HTTP_CONTENT_ENCODING', None)
+            metrics.incr('request.decompressed.' + encoding)
+        return self.wsgi_app(environ, start_response)
+
+    @classmethod
+    def init_app(cls, app):
+        app.wsgi_app = cls(app.wsgi_app, app.config['REQUEST_MAX_DECOMPRESSED_BYTES'])
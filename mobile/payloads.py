@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Kyle Fitzsimmons, 2018
+#
+# Alternate /update payload encodings that decode directly into a
+# CoordinateBatch without building a dict per point.
+#
+# Packed coordinates (Content-Type: application/vnd.itinerum.coordinates)
+# ------------------------------------------------------------------------
+# A little-endian binary layout for coordinate-only uploads:
+#
+#   header      4s  magic b'ITC1'
+#               B   format version (1)
+#               x   padding
+#               H   length of the uuid in bytes
+#               I   number of points (n)
+#               H   bitmask of the optional columns present (OPTIONAL_COLUMNS order)
+#   uuid        utf-8 bytes
+#   timestamp   q   first timestamp in epoch milliseconds, followed by
+#               i*n millisecond deltas from the previous point (the first is 0)
+#   latitude    i*n micro-degree deltas from the previous point (the first is
+#   longitude   i*n the absolute value)
+#   optional    f*n for each float column present (NaN when missing) and
+#               h*n for each integer column present (-32768 when missing)
+from array import array
+import struct
+import sys
+
+from mobile.batch import CoordinateBatch, INT_COLUMNS, NAN, NUMERIC_COLUMNS
+
+PACKED_COORDINATES_MIMETYPE = 'application/vnd.itinerum.coordinates'
+PACKED_MAGIC = b'ITC1'
+PACKED_VERSION = 1
+PACKED_HEADER = struct.Struct('<4sBxHIH')
+PACKED_TIMESTAMP = struct.Struct('<q')
+PACKED_INT_MISSING = -32768
+OPTIONAL_COLUMNS = tuple(c for c in NUMERIC_COLUMNS if c not in ('latitude', 'longitude'))
+
+
+def _array(typecode, data):
+    values = array(typecode, data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def _to_bytes(values):
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tostring() if sys.version_info[0] == 2 else values.tobytes()
+
+
+def _cumulative(deltas, base=0):
+    total, values = base, []
+    for delta in deltas:
+        total += delta
+        values.append(total)
+    return values
+
+
+def _deltas(values, base=0):
+    previous, deltas = base, []
+    for value in values:
+        deltas.append(value - previous)
+        previous = value
+    return deltas
+
+
+# returns the uuid and the CoordinateBatch of a packed payload; malformed
+# payloads raise ValueError
+def decode_packed_coordinates(data):
+    if len(data) < PACKED_HEADER.size:
+        raise ValueError('Packed coordinates payload is truncated.')
+    magic, version, uuid_length, size, present = PACKED_HEADER.unpack_from(data)
+    if magic != PACKED_MAGIC or version != PACKED_VERSION:
+        raise ValueError('Unsupported packed coordinates payload.')
+
+    optional = [c for i, c in enumerate(OPTIONAL_COLUMNS) if present & (1 << i)]
+    expected = (PACKED_HEADER.size + uuid_length + PACKED_TIMESTAMP.size + 12 * size +
+                sum(2 * size if c in INT_COLUMNS else 4 * size for c in optional))
+    if len(data) != expected:
+        raise ValueError('Packed coordinates payload length does not match its header.')
+
+    offset = PACKED_HEADER.size
+    uuid = data[offset:offset + uuid_length].decode('utf-8')
+    offset += uuid_length
+    base_ms = PACKED_TIMESTAMP.unpack_from(data, offset)[0]
+    offset += PACKED_TIMESTAMP.size
+
+    def read(typecode, itemsize):
+        start = offset
+        return _array(typecode, data[start:start + itemsize * size]), start + itemsize * size
+
+    timestamp_deltas, offset = read('i', 4)
+    latitude_deltas, offset = read('i', 4)
+    longitude_deltas, offset = read('i', 4)
+    columns = {
+        'latitude': array('d', [v / 1e6 for v in _cumulative(latitude_deltas)]),
+        'longitude': array('d', [v / 1e6 for v in _cumulative(longitude_deltas)])
+    }
+    for column in OPTIONAL_COLUMNS:
+        if column not in optional:
+            columns[column] = array('d', [NAN]) * size
+        elif column in INT_COLUMNS:
+            values, offset = read('h', 2)
+            columns[column] = array('d', [NAN if v == PACKED_INT_MISSING else v for v in values])
+        else:
+            values, offset = read('f', 4)
+            columns[column] = array('d', values)
+    timestamps = array('d', [ms / 1000. for ms in _cumulative(timestamp_deltas, base_ms)])
+
+    batch = CoordinateBatch(columns, timestamps)
+    batch.validate()
+    return uuid, batch
+
+
+def encode_packed_coordinates(uuid, batch):
+    size = len(batch)
+    optional = [c for c in OPTIONAL_COLUMNS if any(v == v for v in batch.columns[c])]
+    present = sum(1 << OPTIONAL_COLUMNS.index(c) for c in optional)
+    uuid = uuid.encode('utf-8')
+
+    timestamps_ms = [int(round(ts * 1000)) for ts in batch.timestamps]
+    base_ms = timestamps_ms[0] if timestamps_ms else 0
+    parts = [PACKED_HEADER.pack(PACKED_MAGIC, PACKED_VERSION, len(uuid), size, present),
+             uuid,
+             PACKED_TIMESTAMP.pack(base_ms),
+             _to_bytes(array('i', _deltas(timestamps_ms, base_ms))),
+             _to_bytes(array('i', _deltas([int(round(v * 1e6)) for v in batch.columns['latitude']]))),
+             _to_bytes(array('i', _deltas([int(round(v * 1e6)) for v in batch.columns['longitude']])))]
+    for column in optional:
+        values = batch.columns[column]
+        if column in INT_COLUMNS:
+            parts.append(_to_bytes(array('h', [PACKED_INT_MISSING if v != v else int(v) for v in values])))
+        else:
+            parts.append(_to_bytes(array('f', values)))
+    return b''.join(parts)
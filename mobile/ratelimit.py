@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Kyle Fitzsimmons, 2018
+#
+# Per-device token buckets for /update: one limits the requests and another the
+# coordinates a uuid may upload per minute, each allowing a burst up to its
+# capacity. Buckets live in a store selected by RATE_LIMIT_BACKEND: 'local'
+# keeps them in the worker process, 'database' shares them between workers
+# through the unlogged rate_limit_buckets table.
+from collections import OrderedDict
+import logging
+import math
+import threading
+import time
+
+from sqlalchemy import text
+
+from models import db
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+# Both stores answer take() with the seconds until `cost` tokens will be
+# available, or 0 once they have been taken from the bucket
+class LocalBucketStore(object):
+    def __init__(self, maxsize=100000):
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+        self.maxsize = maxsize
+
+    def take(self, key, cost, rate, capacity):
+        now = time.time()
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated_at) * rate)
+            wait = 0. if tokens >= cost else (cost - tokens) / rate
+            if not wait:
+                tokens -= cost
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class DatabaseBucketStore(object):
+    # the refill locks the bucket's row until the transaction ends, so the
+    # check and the deduction are atomic across workers
+    refill_sql = text('''
+        INSERT INTO rate_limit_buckets AS b (key, tokens, updated_at)
+        VALUES (:key, :capacity, now())
+        ON CONFLICT (key) DO UPDATE SET
+            tokens = least(:capacity, b.tokens + extract(epoch FROM now() - b.updated_at) * :rate),
+            updated_at = now()
+        RETURNING tokens
+    ''')
+    take_sql = text('UPDATE rate_limit_buckets SET tokens = tokens - :cost WHERE key = :key')
+
+    def take(self, key, cost, rate, capacity):
+        params = {'key': key, 'cost': cost, 'rate': rate, 'capacity': capacity}
+        with db.engine.begin() as connection:
+            tokens = connection.execute(self.refill_sql, params).scalar()
+            if tokens >= cost:
+                connection.execute(self.take_sql, params)
+                return 0.
+        return (cost - tokens) / rate
+
+    def clear(self):
+        with db.engine.begin() as connection:
+            connection.execute('DELETE FROM rate_limit_buckets')
+
+
+class RateLimiter(object):
+    def __init__(self):
+        self.enabled = False
+        self.store = LocalBucketStore()
+        self.requests_per_minute = 30
+        self.requests_burst = 20
+        self.points_per_minute = 10000
+        self.points_burst = 250000
+
+    def init_app(self, app):
+        self.enabled = app.config['RATE_LIMIT']
+        if app.config['RATE_LIMIT_BACKEND'] == 'database':
+            self.store = DatabaseBucketStore()
+        else:
+            self.store = LocalBucketStore(app.config['RATE_LIMIT_MAX_DEVICES'])
+        self.requests_per_minute = app.config['RATE_LIMIT_REQUESTS_PER_MINUTE']
+        self.requests_burst = app.config['RATE_LIMIT_REQUESTS_BURST']
+        self.points_per_minute = app.config['RATE_LIMIT_POINTS_PER_MINUTE']
+        self.points_burst = app.config['RATE_LIMIT_POINTS_BURST']
+        app.extensions['rate_limiter'] = self
+
+    # returns the whole seconds to wait before retrying when the bucket is empty
+    # and None otherwise; limiting fails open if the store is unavailable
+    def _take(self, bucket, uuid, cost, per_minute, burst):
+        if not self.enabled or not cost:
+            return None
+        try:
+            # an upload larger than the burst is admitted once the bucket is full
+            wait = self.store.take('{}:{}'.format(bucket, uuid), min(cost, burst), per_minute / 60., burst)
+        except Exception:
+            logger.exception('Rate limit store unavailable')
+            metrics.incr('ratelimit.errors')
+            return None
+        if not wait:
+            return None
+        metrics.incr('ratelimit.limited.' + bucket)
+        return int(math.ceil(wait))
+
+    def limit_request(self, uuid):
+        return self._take('requests', uuid, 1, self.requests_per_minute, self.requests_burst)
+
+    # requests without a device header are keyed by their client and body length
+    # before the body is read, so a device looping on one upload is still turned away
+    def limit_unidentified(self, key):
+        return self._take('unidentified', key, 1, self.requests_per_minute, self.requests_burst)
+
+    def limit_points(self, uuid, points):
+        return self._take('points', uuid, points, self.points_per_minute, self.points_burst)
+
+    def clear(self):
+        self.store.clear()
+
+
+rate_limiter = RateLimiter()
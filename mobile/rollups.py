@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Kyle Fitzsimmons, 2018
+#
+# Survey-wide rollups: each worker process sums the per-request deltas for a
+# survey in memory and a background thread periodically adds them to
+# statistics_surveys with one additive upsert. Additions commute, so any number
+# of gunicorn workers can flush independently; deltas of a failed flush are
+# kept for the next one. Deltas not yet flushed when a worker dies are lost,
+# which `manage.py reconcile-stats` corrects.
+#
+# Each delta is kept with the time it was added. Deltas older than the last
+# reconcile are already counted in the per-user totals it summed, so flushes
+# skip them. This assumes the workers' clocks are in sync with the database's.
+import atexit
+import logging
+import os
+import threading
+import time
+
+from mobile.database import Database
+from models import db
+from utils.metrics import metrics
+
+database = Database()
+logger = logging.getLogger(__name__)
+
+FIELDS = ('coordinates', 'prompts', 'cancelled_prompts')
+
+
+# sums (added_at, survey_id, delta) entries added at or after `since` (epoch
+# seconds) into {survey_id: {'coordinates': n, 'prompts': n, 'cancelled_prompts': n}}
+def sum_deltas(entries, since=None):
+    deltas = {}
+    for added_at, survey_id, delta in entries:
+        if since is not None and added_at < since:
+            continue
+        totals = deltas.setdefault(survey_id, dict.fromkeys(FIELDS, 0))
+        for field in FIELDS:
+            totals[field] += delta[field]
+    return deltas
+
+
+class SurveyRollups(object):
+    def __init__(self, flush=None, interval=10.):
+        self.app = None
+        self.enabled = False
+        self.flush_deltas = flush or self._flush_to_database
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._pending = []
+        self._thread = None
+        self._pid = None
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config['SURVEY_ROLLUPS']
+        self.interval = app.config['SURVEY_ROLLUPS_INTERVAL']
+        app.extensions['survey_rollups'] = self
+
+    # as with the write-behind flusher, the thread is started within each worker
+    def _ensure_started(self):
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pending = []
+            self._thread = threading.Thread(target=self._run, name='survey-rollups')
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def add(self, survey_id, coordinates=0, prompts=0, cancelled_prompts=0):
+        if not self.enabled or not any([coordinates, prompts, cancelled_prompts]):
+            return
+        self._ensure_started()
+        delta = {'coordinates': coordinates, 'prompts': prompts, 'cancelled_prompts': cancelled_prompts}
+        with self._lock:
+            self._pending.append((time.time(), survey_id, delta))
+
+    # swaps out the pending deltas and writes them; returns the number of surveys
+    # with deltas. Deltas are restored if the write fails.
+    def flush(self):
+        with self._lock:
+            entries, self._pending = self._pending, []
+        if not entries:
+            return 0
+        start = time.time()
+        try:
+            self.flush_deltas(entries)
+        except Exception:
+            logger.exception('Survey rollup flush of %d deltas failed', len(entries))
+            metrics.incr('rollups.failed_flushes')
+            with self._lock:
+                self._pending[:0] = entries
+            raise
+        metrics.incr('rollups.flushes')
+        metrics.observe('rollups.flush', time.time() - start)
+        return len(set(survey_id for _, survey_id, _ in entries))
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                pass
+
+    def _flush_to_database(self, entries):
+        with self.app.app_context():
+            try:
+                reconciled_at = database.stats.lock_survey_totals()
+                deltas = sum_deltas(entries, since=reconciled_at)
+                skipped = sum(1 for added_at, _, _ in entries
+                              if reconciled_at is not None and added_at < reconciled_at)
+                if skipped:
+                    metrics.incr('rollups.reconciled_deltas', skipped)
+                if deltas:
+                    database.stats.add_survey_totals(deltas)
+                database.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            finally:
+                db.session.remove()
+
+
+rollups = SurveyRollups()
+
+
+@atexit.register
+def _flush_on_exit():
+    if rollups.enabled and rollups._pid == os.getpid():
+        try:
+            rollups.flush()
+        except Exception:
+            pass
@@ -1,14 +1,56 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 # Kyle Fitzsimmons, 2017-2018
+from flask import current_app, g, request, Response
 from flask_restful import Resource
+import hashlib
+import json
+import logging
+from sqlalchemy.exc import OperationalError, TimeoutError as SQLAlchemyTimeoutError
 
+from mobile import caches
+from mobile.admission import admission
+from mobile.batch import CoordinateBatch
+from mobile.contexts import find_user_context
 from mobile.database import Database
+from mobile.filters import filter_coordinates
+from mobile.payloads import decode_packed_coordinates, PACKED_COORDINATES_MIMETYPE
+from mobile.ratelimit import rate_limiter
+from mobile.rollups import rollups
+from mobile.spool import spool, replayer, SpoolError
+from mobile.writebehind import write_behind, WriteBehindError
+from models import db
 from utils.data import rename_json_keys, camelcase_to_underscore
+from utils.metrics import metrics
 from utils.responses import Success, Error
-from utils.validators import validate_json, value_exists
+from utils.validators import validate_json, value_exists, InvalidJSONError
 
 database = Database()
+logger = logging.getLogger(__name__)
+
+# rate limited devices are answered with a prebuilt body, before any parsing
+RATE_LIMITED_BODY = json.dumps({
+    'status': 'error',
+    'type': 'MobileUpdateData',
+    'errors': ['Too many updates from this device, retry later.']
+}, separators=(',', ':'))
+
+
+# Replays a spooled /update payload inside a request context for the stored body.
+# Returns True once stored and False when the payload is rejected by validation
+# or for an unknown user; raises while the database remains unavailable.
+def replay_spooled_update(app, record):
+    with app.test_request_context(app.config['APP_ROOT_V1'] + '/update',
+                                  method='POST',
+                                  data=record.body,
+                                  content_type=record.content_type):
+        try:
+            response = MobileUpdateDataRoute().replay()
+        finally:
+            db.session.remove()
+    if response.status_code >= 500:
+        raise SpoolError('Replay of {!r} failed with status {}'.format(record, response.status_code))
+    return response.status_code < 400
 
 
 class MobileUpdateDataRoute(Resource):
@@ -23,9 +65,16 @@ class MobileUpdateDataRoute(Resource):
                              resource_type=self.resource_type,
                              errors=['Missing parameter (uuid): A prompt uuid must be supplied for each event.'])
 
-    # this route is modeled off the legacy PHP mobile api, API v2 should
-    # separate each call into a separate route
-    def post(self):
+    def _validate(self):
+        # packed binary uploads carry only a uuid and coordinates
+        if request.mimetype == PACKED_COORDINATES_MIMETYPE:
+            uuid, batch = decode_packed_coordinates(request.get_data())
+            if not value_exists(uuid):
+                raise ValueError('UUID must be supplied. No action taken.')
+            validated = {'uuid': uuid, 'survey_answers': None, 'coordinates': None,
+                         'prompts_answers': None, 'cancelled_prompts': None}
+            return validated, batch
+
         validations = [{
             'uuid': {
                 'key': 'uuid',
@@ -51,9 +100,171 @@ class MobileUpdateDataRoute(Resource):
             }
         }]
         validated = validate_json(validations, self.headers, self.resource_type)
-        user = database.user.find_by_uuid(validated['uuid'])
+
+        # parse coordinates into a columnar batch before any database work
+        batch = None
+        if validated['coordinates']:
+            # coordinates may be sent as a list of points or as an object of columns
+            if isinstance(validated['coordinates'], dict):
+                batch = CoordinateBatch.from_columns(validated['coordinates'])
+            else:
+                batch = CoordinateBatch.from_points(validated['coordinates'])
+        return validated, batch
+
+    # acknowledge a validated payload that will be written by the spool replayer
+    def _spool(self, validated):
+        spool.append(request.get_data(), content_type=request.content_type, uuid=validated['uuid'])
+        return Success(status_code=202,
+                       headers=self.headers,
+                       resource_type=self.resource_type,
+                       status='Warning (deprecated): API v1 will soon be phased out. Please refer to documentation for v2 calls.',
+                       body={'spooled': 'Update for {} accepted for processing.'.format(validated['uuid'])})
+
+    # this route is modeled off the legacy PHP mobile api, API v2 should
+    # separate each call into a separate route
+    def post(self):
+        # spooled payloads are replayed in the background by each worker
+        replayer.ensure_started()
+
+        # devices may identify themselves in a header so that a looping client is
+        # turned away without its body being read
+        header_uuid = request.headers.get('X-Itinerum-UUID')
+        retry_after = None
+        if header_uuid:
+            retry_after = rate_limiter.limit_request(header_uuid)
+        elif request.content_length:
+            retry_after = rate_limiter.limit_unidentified(self._unidentified_key())
+        if retry_after:
+            return self._rate_limited(retry_after)
+
+        # shed large uploads before their bodies are read while the worker is saturated
+        retry_after = admission.retry_after(size=request.content_length)
+        if retry_after:
+            return self._overloaded(retry_after)
+
+        try:
+            validated, batch = self._validate()
+        except ValueError as e:
+            return Error(status_code=400,
+                         headers=self.headers,
+                         resource_type=self.resource_type,
+                         errors=[str(e)])
+
+        # the body's uuid is charged as well unless the header named the same device,
+        # so a varying or forged header does not escape the device's bucket
+        if header_uuid != validated['uuid']:
+            retry_after = rate_limiter.limit_request(validated['uuid'])
+            if retry_after:
+                return self._rate_limited(retry_after)
+
+        # replays of an already processed request return the original response
+        # without touching the database
+        idempotency_key = self._idempotency_key(validated['uuid'])
+        cached = caches.idempotent_responses.get(idempotency_key)
+        if cached:
+            metrics.incr('update.idempotency.hits')
+            status_code, body = cached
+            return Success(status_code=status_code,
+                           headers=self.headers,
+                           resource_type=self.resource_type,
+                           status='Warning (deprecated): API v1 will soon be phased out. Please refer to documentation for v2 calls.',
+                           body=body)
+        metrics.incr('update.idempotency.misses')
+
+        # only points that will be written are charged, not those of a replay
+        if batch:
+            retry_after = rate_limiter.limit_points(validated['uuid'], len(batch))
+            if retry_after:
+                return self._rate_limited(retry_after)
+
+        # compressed bodies are checked again once their points are counted
+        points = len(batch) if batch else 0
+        retry_after = admission.retry_after(points=points)
+        if retry_after:
+            return self._overloaded(retry_after)
+
+        with admission.track(points):
+            if spool.enabled and spool.mode == 'always':
+                response = self._spool(validated)
+            else:
+                try:
+                    response = self._update(validated, batch)
+                except (OperationalError, SQLAlchemyTimeoutError) as e:
+                    db.session.rollback()
+                    if spool.enabled:
+                        logger.exception('Database unavailable, spooling update for %s', validated['uuid'])
+                        response = self._spool(validated)
+                    elif isinstance(e, SQLAlchemyTimeoutError):
+                        # without a spool, a saturated pool turns the client away
+                        # like the other overload checks
+                        response = self._overloaded(admission.backoff())
+                    else:
+                        raise
+        # commits made for this request (one per stored update)
+        metrics.observe('update.commits', g.get('db_commits', 0))
+
+        if 200 <= response.status_code < 300:
+            body = json.loads(response.get_data(as_text=True))['results']
+            caches.idempotent_responses.set(idempotency_key, (response.status_code, body))
+        return response
+
+    def _rate_limited(self, retry_after):
+        return Response(RATE_LIMITED_BODY, status=429, mimetype='application/json',
+                        headers={'Retry-After': str(retry_after)})
+
+    def _overloaded(self, retry_after):
+        return Error(status_code=429,
+                     headers={'Retry-After': str(retry_after)},
+                     resource_type=self.resource_type,
+                     errors=['Server is busy, retry this update in {} seconds.'.format(retry_after)])
+
+    # clients resending the same upload share an address, user agent and body length
+    def _unidentified_key(self):
+        client = request.access_route[0] if request.access_route else request.remote_addr
+        key = '{client}:{agent}:{length}'.format(client=client,
+                                                 agent=request.headers.get('User-Agent', ''),
+                                                 length=request.content_length)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    # a client-supplied Idempotency-Key takes precedence over the body hash
+    def _idempotency_key(self, uuid):
+        key = request.headers.get('Idempotency-Key')
+        if key:
+            return 'key:{uuid}:{key}'.format(uuid=uuid, key=key)
+        digest = hashlib.sha256(request.get_data()).hexdigest()
+        return 'body:{uuid}:{digest}'.format(uuid=uuid, digest=digest)
+
+    # apply a spooled payload (see replay_spooled_update) without spooling it again
+    def replay(self):
+        try:
+            validated, batch = self._validate()
+        except InvalidJSONError as e:
+            return Error(status_code=400,
+                         headers=self.headers,
+                         resource_type=self.resource_type,
+                         errors=e.errors)
+        except ValueError as e:
+            return Error(status_code=400,
+                         headers=self.headers,
+                         resource_type=self.resource_type,
+                         errors=[str(e)])
+        return self._update(validated, batch)
+
+    def _update(self, validated, batch):
+        admission.checkout(db.session)
+        user = find_user_context(validated['uuid'])
 
         if user:
+            # fail gracefully on older version of mobile app that do not provide a prompt
+            # uuid, before any section of the request is written
+            formatted_prompts = rename_json_keys(validated['prompts_answers'] or [], camelcase_to_underscore)
+            formatted_cancelled_prompts = rename_json_keys(validated['cancelled_prompts'] or [],
+                                                           camelcase_to_underscore)
+            error = (self._fail_on_deprecated_prompts(formatted_prompts) or
+                     self._fail_on_deprecated_prompts(formatted_cancelled_prompts))
+            if error:
+                return error
+
             survey_answers, coordinates, prompts_answers, cancelled_prompts = None, None, None, None
             response = {
                 'survey': 'No new survey data supplied.',
@@ -61,29 +272,66 @@ class MobileUpdateDataRoute(Resource):
                 'prompts': 'No new prompt answers supplied.',
                 'cancelledPrompts': 'No cancelled prompts supplied.'
             }
+            # drop inaccurate and implausible points before they are stored, or only
+            # count them in 'report' mode; surveys may override the API's settings
+            filtered = None
+            filter_mode = user.coordinates_filter
+            if filter_mode is None:
+                filter_mode = current_app.config['COORDINATES_FILTER']
+            # a maximum speed of 0 disables the speed test for the survey
+            max_speed = user.coordinates_filter_max_speed
+            if max_speed is None:
+                max_speed = current_app.config['COORDINATES_FILTER_MAX_SPEED']
+            if batch and filter_mode in ('drop', 'report'):
+                accepted, filtered = filter_coordinates(batch,
+                                                        accuracy_threshold=user.gps_accuracy_threshold,
+                                                        max_speed=max_speed)
+                for test, count in filtered.items():
+                    metrics.incr('coordinates.filtered.' + test, count)
+                if filter_mode == 'drop':
+                    batch = accepted
+
+            # with write-behind enabled coordinates are committed by the background
+            # flusher and the ticket is awaited before anything else is written, with
+            # the request's connection returned to the pool for the flusher to use
+            ticket = None
+            if batch and write_behind.enabled:
+                db.session.close()
+                ticket = write_behind.submit(user.survey_id, user.mobile_id, batch)
+                if ticket:
+                    try:
+                        coordinates = ticket.wait(write_behind.timeout)
+                    except WriteBehindError as e:
+                        return Error(status_code=503,
+                                     headers=self.headers,
+                                     resource_type=self.resource_type,
+                                     errors=['Coordinates could not be stored: {}'.format(e)])
+            if batch and not ticket:
+                coordinates = database.coordinates.insert(survey_id=user.survey_id,
+                                                          mobile_id=user.mobile_id,
+                                                          batch=batch)
+
             if validated['survey_answers']:
-                survey_answers = database.survey.upsert(user=user,
-                                                        answers=validated['survey_answers'])
+                survey_answers = database.survey.upsert(survey_id=user.survey_id,
+                                                        mobile_id=user.mobile_id,
+                                                        answers=validated['survey_answers'],
+                                                        survey_name=user.survey_name,
+                                                        language=user.language)
                 if survey_answers:
                     response['survey'] = 'Survey answer for {} upserted.'.format(user.uuid)
-            if validated['coordinates']:
-                coordinates = rename_json_keys(validated['coordinates'], camelcase_to_underscore)
-                coordinates = database.coordinates.insert(user=user,
-                                                          coordinates=coordinates)
-                if coordinates:
-                    response['coordinates'] = (
-                        'New coordinates for {} inserted.'.format(user.uuid))
-            
+                else:
+                    response['survey'] = 'Survey answer for {} is unchanged.'.format(user.uuid)
+
+            new_prompt_uuids, new_cancelled_prompt_uuids, cancelled_prompts_deleted = [], [], 0
+
             # upsert prompts answers and remove any existing conflicting cancelled prompt responses
             if validated['prompts_answers']:
-                formatted_prompts = rename_json_keys(validated['prompts_answers'], camelcase_to_underscore)
-                error = self._fail_on_deprecated_prompts(formatted_prompts)
-                if error:
-                    return error
-                prompts_answers = database.prompts.upsert(user=user,
+                prompts_answers = database.prompts.upsert(survey_id=user.survey_id,
+                                                          mobile_id=user.mobile_id,
                                                           prompts=formatted_prompts)
                 prompts_uuids = {p.prompt_uuid for p in prompts_answers}
-                database.cancelled_prompts.delete(prompts_uuids)
+                cancelled_prompts_deleted = database.cancelled_prompts.delete(prompts_uuids)
+                new_prompt_uuids = [p.prompt_uuid for p in prompts_answers if p.inserted]
 
                 if prompts_answers:
                     response['prompts'] = (
@@ -91,13 +339,6 @@ class MobileUpdateDataRoute(Resource):
 
             # filter cancelled prompts which conflict with a provided response by uuid and insert cancelled prompts
             if validated['cancelled_prompts']:
-                formatted_cancelled_prompts = rename_json_keys(validated['cancelled_prompts'], camelcase_to_underscore)
-
-                # fail gracefully on older version of mobile app that do not provide a prompt uuid
-                error = self._fail_on_deprecated_prompts(formatted_cancelled_prompts)
-                if error:
-                    return error
-
                 if validated['prompts_answers']:
                     answers_uuids = {p['uuid'] for p in validated['prompts_answers']}
                     filtered_cancelled_prompts = []
@@ -106,15 +347,45 @@ class MobileUpdateDataRoute(Resource):
                             filtered_cancelled_prompts.append(c)
                 else:
                     filtered_cancelled_prompts = formatted_cancelled_prompts
-                cancelled_prompts = database.cancelled_prompts.insert(user=user,
+                cancelled_prompts = database.cancelled_prompts.insert(survey_id=user.survey_id,
+                                                                      mobile_id=user.mobile_id,
                                                                       cancelled_prompts=filtered_cancelled_prompts)
+                new_cancelled_prompt_uuids = cancelled_prompts
                 if cancelled_prompts:
                     response['cancelledPrompts'] = (
                         'New cancelled prompts for {} inserted.'.format(user.uuid))
+                elif filtered_cancelled_prompts:
+                    response['cancelledPrompts'] = (
+                        'Cancelled prompts for {} were already stored.'.format(user.uuid))
+
+            if batch is not None:
+                response['coordinatesInserted'] = coordinates or 0
+                response['coordinatesSkipped'] = len(batch) - (coordinates or 0)
+            if filtered is not None:
+                response['coordinatesFiltered'] = filtered
+            if coordinates:
+                response['coordinates'] = (
+                    'New coordinates for {} inserted.'.format(user.uuid))
+            elif batch:
+                response['coordinates'] = (
+                    'Coordinates for {} were already stored.'.format(user.uuid))
 
+            # every section above was written in the session's transaction and is
+            # committed here at once, except for coordinates stored by the write-behind
+            # flusher which counted them in its own transaction
             status = None
+            counted_coordinates = 0 if ticket else coordinates or 0
             if any([survey_answers, coordinates, prompts_answers, cancelled_prompts]):
+                database.stats.increment(user.survey_id, user.mobile_id,
+                                         coordinates=counted_coordinates,
+                                         prompt_uuids=new_prompt_uuids,
+                                         cancelled_prompt_uuids=new_cancelled_prompt_uuids,
+                                         cancelled_prompts_deleted=cancelled_prompts_deleted)
                 database.commit()
+                rollups.add(user.survey_id,
+                            coordinates=counted_coordinates,
+                            prompts=len(new_prompt_uuids),
+                            cancelled_prompts=len(new_cancelled_prompt_uuids) - cancelled_prompts_deleted)
                 status = 201
             else:
                 status = 200
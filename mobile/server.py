@@ -1,15 +1,26 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 # Kyle Fitzsimmons, 2017-2018
-from flask import Flask, jsonify, make_response
+from flask import abort, Flask, jsonify, make_response, request
 from flask_restful import Api
+from functools import wraps
+import hmac
 import logging
 import os
 from raven.contrib.flask import Sentry
 
 import config
-from mobile import routes
+from mobile import caches, routes
+from mobile.admission import admission
+from mobile.database import configure_engine, pool_stats
+from mobile.middleware import DecompressRequestMiddleware
+from mobile.ratelimit import rate_limiter
+from mobile.rollups import rollups
+from mobile.routes.v1.mobile_update import replay_spooled_update
+from mobile.spool import spool, replayer
+from mobile.writebehind import write_behind
 from models import db
+from utils.metrics import metrics
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(config.MobileConfig.APP_NAME)
@@ -39,7 +50,16 @@ def create_app(testing=False):
     app = Flask(__name__)
     cfg = load_app_config(testing)
     app.config.from_object(cfg)
-    db.init_app(app)    
+    db.init_app(app)
+    configure_engine(app)
+    write_behind.init_app(app)
+    spool.init_app(app)
+    replayer.init_app(app, handler=lambda record: replay_spooled_update(app, record))
+    caches.init_app(app)
+    rollups.init_app(app)
+    admission.init_app(app)
+    rate_limiter.init_app(app)
+    DecompressRequestMiddleware.init_app(app)
 
     # Connect Sentry.io error reporting ========================================
     if app.config['CONF'] == 'production':
@@ -69,4 +89,36 @@ def create_app(testing=False):
         response = {'status': 0}
         return make_response(jsonify(response))
 
+    # Worker internals are only served to holders of the metrics token =========
+    def require_metrics_token(view):
+        @wraps(view)
+        def wrapped(*args, **kwargs):
+            token = app.config['METRICS_TOKEN']
+            if not token:
+                abort(404)
+            expected = 'Bearer {}'.format(token).encode('utf-8')
+            if not hmac.compare_digest(request.headers.get('Authorization', '').encode('utf-8'), expected):
+                abort(401)
+            return view(*args, **kwargs)
+        return wrapped
+
+    # Database connections in use by this worker's pool =======================
+    @app.route('/health/pool')
+    @require_metrics_token
+    def pool_health_check():
+        response = {'status': 0, 'pool': pool_stats(app)}
+        return make_response(jsonify(response))
+
+    # Expose in-process counters and timings for this worker ===================
+    @app.route('/metrics')
+    @require_metrics_token
+    def worker_metrics():
+        snapshot = metrics.snapshot()
+        snapshot['caches'] = caches.stats()
+        snapshot['admission'] = admission.stats()
+        snapshot['db_pool'] = pool_stats(app)
+        if spool.enabled:
+            snapshot['spool'] = spool.backlog()
+        return make_response(jsonify(snapshot))
+
     return app
@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Kyle Fitzsimmons, 2018
+#
+# Durable local spool for /update payloads that cannot be written to PostgreSQL
+# right away. Payloads are appended to segment files as length-prefixed records
+# with a crc32 checksum:
+#
+#   <uint32 length><uint32 crc32><length bytes: JSON header line + request body>
+#
+# Each worker process appends to its own `.open` segment, which is sealed
+# (renamed to `.log`) once it reaches the configured size. The replayer keeps
+# a `.offset` checkpoint next to each segment and removes sealed segments once
+# every record has been replayed. A `.open` segment whose worker has exited is
+# sealed by the next replay or compaction, so the spool directory must be local
+# to the host running the workers.
+#
+# Each worker runs a background replayer; a `replay.lock` file in the spool
+# directory lets a single process (worker or `manage.py spool replay`) replay
+# at a time.
+from contextlib import contextmanager
+import errno
+import fcntl
+import glob
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+RECORD_HEADER = struct.Struct('<II')
+FSYNC_POLICIES = ('always', 'interval', 'never')
+
+
+class SpoolError(Exception):
+    pass
+
+
+class SpoolRecord(object):
+    def __init__(self, segment, offset, next_offset, header, body):
+        self.segment = segment
+        self.offset = offset
+        self.next_offset = next_offset
+        self.header = header
+        self.body = body
+
+    @property
+    def content_type(self):
+        return self.header.get('content_type')
+
+    def __repr__(self):
+        return '<SpoolRecord %s@%d>' % (os.path.basename(self.segment), self.offset)
+
+
+class Spool(object):
+    def __init__(self, directory=None, mode='off', segment_bytes=64 * 1024 * 1024,
+                 fsync='always', fsync_interval=1.):
+        self._lock = threading.Lock()
+        self._segment = None
+        self._segment_path = None
+        self._pid = None
+        self._sequence = 0
+        self._last_fsync = 0.
+        self.configure(directory, mode, segment_bytes, fsync, fsync_interval)
+
+    def configure(self, directory, mode, segment_bytes, fsync, fsync_interval):
+        if fsync not in FSYNC_POLICIES:
+            raise SpoolError('Unknown spool fsync policy: {}'.format(fsync))
+        self.close()
+        self.directory = directory
+        self.mode = mode
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+
+    def init_app(self, app):
+        self.configure(directory=app.config['UPDATE_SPOOL_DIR'],
+                       mode=app.config['UPDATE_SPOOL_MODE'],
+                       segment_bytes=app.config['UPDATE_SPOOL_SEGMENT_BYTES'],
+                       fsync=app.config['UPDATE_SPOOL_FSYNC'],
+                       fsync_interval=app.config['UPDATE_SPOOL_FSYNC_INTERVAL'])
+        app.extensions['update_spool'] = self
+
+    @property
+    def enabled(self):
+        return self.mode in ('fallback', 'always') and bool(self.directory)
+
+    # Writing ==================================================================
+    def _open_segment(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self._sequence += 1
+        name = 'segment-{ts:013d}-{pid}-{seq:06d}.open'.format(ts=int(time.time() * 1000),
+                                                               pid=os.getpid(),
+                                                               seq=self._sequence)
+        self._segment_path = os.path.join(self.directory, name)
+        self._segment = open(self._segment_path, 'ab')
+        self._pid = os.getpid()
+
+    def _seal_segment(self):
+        self._fsync(force=True)
+        self._segment.close()
+        os.rename(self._segment_path, self._segment_path[:-len('.open')] + '.log')
+        self._segment, self._segment_path = None, None
+
+    def _fsync(self, force=False):
+        if self.fsync == 'never' and not force:
+            return
+        now = time.time()
+        if force or self.fsync == 'always' or now - self._last_fsync >= self.fsync_interval:
+            os.fsync(self._segment.fileno())
+            self._last_fsync = now
+
+    def append(self, body, **header):
+        header.setdefault('received_at', time.time())
+        payload = json.dumps(header).encode('utf-8') + b'\n' + body
+        record = RECORD_HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+        with self._lock:
+            # segments are never shared between forked workers
+            if self._segment is None or self._pid != os.getpid():
+                self._open_segment()
+            self._segment.write(record)
+            self._segment.flush()
+            self._fsync()
+            if self._segment.tell() >= self.segment_bytes:
+                self._seal_segment()
+        metrics.incr('spool.appended')
+        metrics.incr('spool.appended_bytes', len(record))
+
+    def close(self):
+        with self._lock:
+            if self._segment is not None and self._pid == os.getpid():
+                self._seal_segment()
+            self._segment, self._segment_path = None, None
+
+    # Reading ==================================================================
+    def segments(self):
+        if not self.directory or not os.path.isdir(self.directory):
+            return []
+        paths = glob.glob(os.path.join(self.directory, 'segment-*.log'))
+        paths += glob.glob(os.path.join(self.directory, 'segment-*.open'))
+        return sorted(paths, key=os.path.basename)
+
+    @staticmethod
+    def is_sealed(path):
+        return path.endswith('.log')
+
+    @staticmethod
+    def _is_running(pid):
+        try:
+            os.kill(pid, 0)
+        except OSError as e:
+            return e.errno != errno.ESRCH
+        return True
+
+    # seals the `.open` segments left by worker processes that are no longer
+    # running (with their checkpoints); returns the number sealed
+    def seal_abandoned(self):
+        sealed = 0
+        for path in self.segments():
+            if self.is_sealed(path):
+                continue
+            pid = int(os.path.basename(path).split('-')[2])
+            if pid == os.getpid() or self._is_running(pid):
+                continue
+            sealed_path = path[:-len('.open')] + '.log'
+            os.rename(path, sealed_path)
+            if os.path.exists(path + '.offset'):
+                os.rename(path + '.offset', sealed_path + '.offset')
+            sealed += 1
+        if sealed:
+            metrics.incr('spool.sealed_abandoned', sealed)
+        return sealed
+
+    @staticmethod
+    def read_checkpoint(path):
+        try:
+            with open(path + '.offset', 'r') as f:
+                return int(f.read().strip() or 0)
+        except (IOError, OSError):
+            return 0
+
+    @staticmethod
+    def write_checkpoint(path, offset):
+        tmp_path = path + '.offset.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(str(offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, path + '.offset')
+
+    # yields records from the given offset and stops at the end of the file or
+    # at the first incomplete or corrupt record (e.g., a write in progress)
+    def read(self, path, offset=0):
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            while True:
+                prefix = f.read(RECORD_HEADER.size)
+                if len(prefix) < RECORD_HEADER.size:
+                    return
+                length, crc = RECORD_HEADER.unpack(prefix)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+                    return
+                header, body = payload.split(b'\n', 1)
+                next_offset = offset + RECORD_HEADER.size + length
+                yield SpoolRecord(path, offset, next_offset, json.loads(header.decode('utf-8')), body)
+                offset = next_offset
+
+    # cheap summary of what is left to replay, without reading the records
+    def backlog(self):
+        segments, pending_bytes = 0, 0
+        for path in self.segments():
+            try:
+                pending_bytes += max(os.path.getsize(path) - self.read_checkpoint(path), 0)
+            except OSError:
+                # removed by a replay in the meantime
+                continue
+            segments += 1
+        return {'segments': segments, 'pending_bytes': pending_bytes}
+
+    def stats(self):
+        segments = []
+        for path in self.segments():
+            checkpoint = self.read_checkpoint(path)
+            pending = sum(1 for _ in self.read(path, checkpoint))
+            segments.append({
+                'segment': os.path.basename(path),
+                'sealed': self.is_sealed(path),
+                'bytes': os.path.getsize(path),
+                'checkpoint': checkpoint,
+                'pending': pending
+            })
+        return {
+            'directory': self.directory,
+            'segments': segments,
+            'pending': sum(s['pending'] for s in segments)
+        }
+
+    # Replay ===================================================================
+    # Drain spooled records through `handler`, which returns True once a record
+    # is stored, False when it is permanently rejected, and raises when the
+    # database is unavailable. Failures back off exponentially so a recovering
+    # database is not flooded; `max_rate` caps the records replayed per second.
+    def replay(self, handler, limit=None, max_rate=None, backoff=1., max_backoff=60.,
+               max_failures=5):
+        if not self.directory or not os.path.isdir(self.directory):
+            return 0, 0
+        with self._replay_lock():
+            return self._replay(handler, limit, max_rate, backoff, max_backoff, max_failures)
+
+    # raises SpoolError while another process holds the replay lock
+    @contextmanager
+    def _replay_lock(self):
+        with open(os.path.join(self.directory, 'replay.lock'), 'a') as f:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                raise SpoolError('The spool is being replayed by another process.')
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _replay(self, handler, limit, max_rate, backoff, max_backoff, max_failures):
+        replayed, rejected, failures = 0, 0, 0
+        delay = backoff
+        self.seal_abandoned()
+        for path in self.segments():
+            checkpoint = self.read_checkpoint(path)
+            for record in self.read(path, checkpoint):
+                if limit is not None and replayed + rejected >= limit:
+                    return replayed, rejected
+                while True:
+                    start = time.time()
+                    try:
+                        stored = handler(record)
+                        break
+                    except Exception:
+                        failures += 1
+                        metrics.incr('spool.replay_failures')
+                        logger.exception('Spool replay of %r failed (%d/%d), retrying in %.1fs',
+                                         record, failures, max_failures, delay)
+                        if failures >= max_failures:
+                            raise SpoolError('Giving up replay after {} consecutive failures.'.format(failures))
+                        time.sleep(delay)
+                        delay = min(delay * 2, max_backoff)
+                failures, delay = 0, backoff
+                if stored:
+                    replayed += 1
+                    metrics.incr('spool.replayed')
+                else:
+                    rejected += 1
+                    metrics.incr('spool.rejected')
+                    logger.warning('Spool record %r was rejected and has been dropped', record)
+                self.write_checkpoint(path, record.next_offset)
+                if max_rate:
+                    time.sleep(max(0., 1. / max_rate - (time.time() - start)))
+
+            if self.is_sealed(path) and not any(True for _ in self.read(path, self.read_checkpoint(path))):
+                self._remove(path)
+        return replayed, rejected
+
+    # Compaction ===============================================================
+    # Remove fully replayed sealed segments and rewrite partially replayed ones
+    # so only pending records remain; corrupt tails are dropped in the process.
+    def compact(self):
+        removed, rewritten = 0, 0
+        self.seal_abandoned()
+        for path in self.segments():
+            if not self.is_sealed(path):
+                continue
+            checkpoint = self.read_checkpoint(path)
+            end = checkpoint
+            for record in self.read(path, checkpoint):
+                end = record.next_offset
+            if end == checkpoint:
+                self._remove(path)
+                removed += 1
+            elif checkpoint > 0 or end < os.path.getsize(path):
+                tmp_path = path + '.compact'
+                with open(path, 'rb') as src, open(tmp_path, 'wb') as dst:
+                    src.seek(checkpoint)
+                    dst.write(src.read(end - checkpoint))
+                    dst.flush()
+                    os.fsync(dst.fileno())
+                # the checkpoint goes first: a crash before the rename then replays
+                # some records again rather than skipping pending ones afterwards
+                if os.path.exists(path + '.offset'):
+                    os.remove(path + '.offset')
+                os.rename(tmp_path, path)
+                rewritten += 1
+        return removed, rewritten
+
+    @staticmethod
+    def _remove(path):
+        os.remove(path)
+        if os.path.exists(path + '.offset'):
+            os.remove(path + '.offset')
+
+
+class SpoolReplayer(object):
+    def __init__(self, spool, handler=None, interval=10., max_rate=None):
+        self.spool = spool
+        self.handler = handler
+        self.enabled = False
+        self.interval = interval
+        self.max_rate = max_rate
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def init_app(self, app, handler):
+        self.handler = handler
+        self.enabled = app.config['UPDATE_SPOOL_REPLAY']
+        self.interval = app.config['UPDATE_SPOOL_REPLAY_INTERVAL']
+        self.max_rate = app.config['UPDATE_SPOOL_REPLAY_MAX_RATE'] or None
+        app.extensions['update_spool_replayer'] = self
+
+    # as with the write-behind flusher, the thread is started within each worker
+    def ensure_started(self):
+        if not (self.enabled and self.spool.enabled):
+            return
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='update-spool-replayer')
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = os.getpid()
+
+    # replays the spool unless another process is already replaying it; a database
+    # that is still unavailable is retried after the next interval
+    def replay(self):
+        if not self.spool.segments():
+            return 0, 0
+        try:
+            return self.spool.replay(self.handler, max_rate=self.max_rate)
+        except SpoolError as e:
+            logger.warning('Spool replay skipped: %s', e)
+            metrics.incr('spool.replay_skipped')
+            return 0, 0
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.replay()
+            except Exception:
+                logger.exception('Spool replay failed')
+
+
+spool = Spool()
+replayer = SpoolReplayer(spool)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Kyle Fitzsimmons, 2018
+#
+# Write-behind group commit for coordinate uploads: requests place their batch
+# on a bounded in-process queue and a background flusher merges the batches of
+# many devices into a single insert and commit. Each request waits on its
+# ticket so it is only acknowledged once its coordinates are durable.
+#
+# The devices' coordinate totals are incremented in the flusher's transaction,
+# so they stay consistent with the stored rows whatever becomes of the rest of
+# the request; the request's own transaction only counts its other sections.
+import logging
+import os
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from mobile.database import Database
+from mobile.rollups import rollups
+from models import db
+from utils.metrics import metrics
+
+database = Database()
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindError(Exception):
+    pass
+
+
+class WriteBehindTicket(object):
+    def __init__(self, survey_id, mobile_id, batch):
+        self.survey_id = survey_id
+        self.mobile_id = mobile_id
+        self.batch = batch
+        self.inserted = None
+        self.error = None
+        self._done = threading.Event()
+
+    def resolve(self, inserted=None, error=None):
+        self.inserted = inserted
+        self.error = error
+        self._done.set()
+
+    def wait(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise WriteBehindError('Timed out waiting for coordinates to be committed.')
+        if self.error:
+            raise WriteBehindError(str(self.error))
+        return self.inserted
+
+
+class CoordinateWriteBehind(object):
+    def __init__(self, flush=None, interval=0.05, max_rows=50000, queue_size=1000, timeout=30.):
+        self.app = None
+        self.enabled = False
+        self.flush = flush or self._flush_to_database
+        self.interval = interval
+        self.max_rows = max_rows
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._queue = None
+        self._thread = None
+        self._pid = None
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config['COORDINATES_WRITE_BEHIND']
+        self.interval = app.config['COORDINATES_WRITE_BEHIND_INTERVAL']
+        self.max_rows = app.config['COORDINATES_WRITE_BEHIND_MAX_ROWS']
+        self.queue_size = app.config['COORDINATES_WRITE_BEHIND_QUEUE_SIZE']
+        self.timeout = app.config['COORDINATES_WRITE_BEHIND_TIMEOUT']
+        app.extensions['coordinates_write_behind'] = self
+
+    # gunicorn forks workers after the app has been created so the flusher
+    # thread is started lazily within each worker process
+    def _ensure_started(self):
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._queue = queue.Queue(maxsize=self.queue_size)
+            self._thread = threading.Thread(target=self._run, name='coordinates-write-behind')
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = os.getpid()
+
+    # returns a ticket to wait on or None when the queue is full, in which case
+    # the caller should insert the batch itself
+    def submit(self, survey_id, mobile_id, batch):
+        self._ensure_started()
+        ticket = WriteBehindTicket(survey_id, mobile_id, batch)
+        try:
+            self._queue.put_nowait(ticket)
+        except queue.Full:
+            metrics.incr('coordinates.write_behind.queue_full')
+            return None
+        metrics.gauge('coordinates.write_behind.queue_depth', self._queue.qsize())
+        return ticket
+
+    # collect tickets until the interval has elapsed since the first one
+    # arrived or the merged size reaches max_rows
+    def _collect(self):
+        tickets = [self._queue.get()]
+        rows = len(tickets[0].batch)
+        deadline = time.time() + self.interval
+        while rows < self.max_rows:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                ticket = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            tickets.append(ticket)
+            rows += len(ticket.batch)
+        return tickets, rows
+
+    def _run(self):
+        while True:
+            tickets, rows = self._collect()
+            start = time.time()
+            try:
+                counts = self.flush(tickets)
+            except Exception as e:
+                logger.exception('Write-behind flush of %d coordinates failed', rows)
+                metrics.incr('coordinates.write_behind.failed_flushes')
+                for ticket in tickets:
+                    ticket.resolve(error=e)
+                continue
+            for ticket, count in zip(tickets, counts):
+                ticket.resolve(inserted=count)
+            metrics.incr('coordinates.write_behind.flushes')
+            metrics.gauge('coordinates.write_behind.batches_per_flush', len(tickets))
+            metrics.throughput('coordinates.write_behind', rows, time.time() - start)
+
+    def _flush_to_database(self, tickets):
+        with self.app.app_context():
+            try:
+                batches = [(t.survey_id, t.mobile_id, t.batch) for t in tickets]
+                counts = database.coordinates.insert_batches(batches)
+                totals = {}
+                for ticket, count in zip(tickets, counts):
+                    key = (ticket.mobile_id, ticket.survey_id)
+                    totals[key] = totals.get(key, 0) + (count or 0)
+                # rows are locked in mobile_id order so concurrent flushes cannot deadlock
+                for (mobile_id, survey_id), count in sorted(totals.items()):
+                    database.stats.increment(survey_id, mobile_id, coordinates=count)
+                database.commit()
+                for (mobile_id, survey_id), count in totals.items():
+                    rollups.add(survey_id, coordinates=count)
+                return counts
+            except Exception:
+                db.session.rollback()
+                raise
+            finally:
+                db.session.remove()
+
+
+write_behind = CoordinateWriteBehind()
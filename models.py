@@ -5,9 +5,32 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_security import UserMixin, RoleMixin, SQLAlchemyUserDatastore
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.ext.mutable import MutableDict
-
-
-db = SQLAlchemy()
+from sqlalchemy.pool import NullPool
+
+
+# Pool sizes, timeout and recycle are read by Flask-SQLAlchemy from the
+# SQLALCHEMY_POOL_* settings; the remaining engine options are added here.
+# psycopg2 never prepares statements on the server, so behind pgbouncer the
+# only session state to avoid is the statement timeout sent at connect; it is
+# set for each transaction by mobile.database.configure_engine instead.
+class PooledSQLAlchemy(SQLAlchemy):
+    def apply_driver_hacks(self, app, info, options):
+        super(PooledSQLAlchemy, self).apply_driver_hacks(app, info, options)
+        if not info.drivername.startswith('postgresql'):
+            return
+        if options.get('pool_size') == 0:
+            options['poolclass'] = NullPool
+            for key in ('pool_size', 'max_overflow', 'pool_timeout'):
+                options.pop(key, None)
+        options['pool_pre_ping'] = app.config['DB_POOL_PRE_PING']
+        connect_args = options.setdefault('connect_args', {})
+        connect_args['application_name'] = app.config['APP_NAME']
+        timeout = app.config['DB_STATEMENT_TIMEOUT']
+        if timeout and not app.config['DB_PGBOUNCER']:
+            connect_args['options'] = '-c statement_timeout={:d}'.format(timeout)
+
+
+db = PooledSQLAlchemy()
 
 
 # Web interface tables =========================================================
@@ -113,6 +136,11 @@ class Survey(Base):
     last_export = db.Column(MutableDict.as_mutable(JSONB))
     record_acceleration = db.Column(db.Boolean, default=True)
     record_mode = db.Column(db.Boolean, default=True)
+    # ingest filter settings of this survey's uploads; NULL uses the API's
+    # COORDINATES_FILTER and COORDINATES_FILTER_MAX_SPEED, a max speed of 0
+    # disables the speed test
+    coordinates_filter = db.Column(db.String(8))
+    coordinates_filter_max_speed = db.Column(db.Float)
 
     web_users = db.relationship('WebUser',
                                 backref='survey',
@@ -285,10 +313,13 @@ class MobileUser(Base):
         return '<MobileUser %d - %s>' % (self.id, self.uuid)
 
 
+# Partitioned by month of timestamp, so the partition key is part of the primary
+# key and of every unique index; rows outside the pre-created monthly partitions
+# (see manage.py partitions) are kept in the default partition
 class MobileCoordinate(db.Model):
     __tablename__ = 'mobile_coordinates'
 
-    id = db.Column(db.Integer, primary_key=True)
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     survey_id = db.Column(db.Integer, db.ForeignKey(Survey.id, ondelete='CASCADE'))
     mobile_id = db.Column(db.Integer, db.ForeignKey(MobileUser.id, ondelete='CASCADE'))
     latitude = db.Column(db.Numeric(precision=10, scale=7))
@@ -303,18 +334,23 @@ class MobileCoordinate(db.Model):
     acceleration_z = db.Column(db.Numeric(precision=10, scale=6))
     mode_detected = db.Column(db.Integer)
     point_type = db.Column(db.Integer)
-    timestamp = db.Column(db.DateTime(timezone=True))
+    timestamp = db.Column(db.DateTime(timezone=True), primary_key=True)
 
     __table_args__ = (
         db.Index('mobile_coordinates_timestamp_idx', timestamp),
         db.Index('mobile_coordinates_survey_timestamp_idx', survey_id, timestamp),
-        db.Index('mobile_coordinates_user_timestamp_idx', mobile_id, timestamp)
+        db.Index('mobile_coordinates_user_timestamp_idx', mobile_id, timestamp, unique=True),
+        {'postgresql_partition_by': 'RANGE (timestamp)'}
     )
 
     def __repr__(self):
         return '<MobileCoordinate %d>' % self.id
 
 
+db.event.listen(MobileCoordinate.__table__, 'after_create',
+                db.DDL('CREATE TABLE mobile_coordinates_default PARTITION OF mobile_coordinates DEFAULT'))
+
+
 class SurveyResponse(db.Model):
     __tablename__ = 'mobile_survey_responses'
 
@@ -351,6 +387,11 @@ class PromptResponse(db.Model):
     latitude = db.Column(db.Numeric(precision=16, scale=10))
     longitude = db.Column(db.Numeric(precision=16, scale=10))
 
+    # target of the prompt upsert (see manage.py prompts unique_constraint)
+    __table_args__ = (
+        db.UniqueConstraint('prompt_uuid', 'prompt_num', name='mobile_prompt_responses_uuid_num_key'),
+    )
+
     def __repr__(self):
         return '<PromptResponse id=%d survey_id=%s uuid=%s>' % (self.id,
                                                                 self.survey_id,
@@ -389,6 +430,8 @@ class Stats(db.Model):
     last_stats_update = db.Column(db.DateTime(timezone=True))
     last_survey_stats_update = db.Column(db.DateTime(timezone=True))
     last_mobile_stats_update = db.Column(db.DateTime(timezone=True))
+    # set by `manage.py reconcile-stats`; older rollup deltas are skipped
+    last_survey_reconcile = db.Column(db.DateTime(timezone=True))
     total_surveys = db.Column(db.Integer)
 
     def __repr__(self):
@@ -413,8 +456,9 @@ class MobileUserStats(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     survey_id = db.Column(db.Integer, db.ForeignKey(Survey.id, ondelete='CASCADE'))
     mobile_id = db.Column(db.Integer, db.ForeignKey(MobileUser.id, ondelete='CASCADE'), unique=True)
-    latest_coordinate = db.Column(db.Integer,
-                                  db.ForeignKey(MobileCoordinate.id, ondelete='SET NULL'))
+    # mobile_coordinates.id alone is not unique across partitions, so it cannot
+    # be the target of a foreign key
+    latest_coordinate = db.Column(db.Integer)
     latest_prompt = db.Column(db.Integer,
                               db.ForeignKey(PromptResponse.id, ondelete='SET NULL'))
     latest_cancelled_prompt = db.Column(db.Integer,
@@ -425,3 +469,18 @@ class MobileUserStats(db.Model):
 
     def __repr__(self):
         return '<MobileUserStats %d>' % self.mobile_id
+
+
+# Rate limiting tables =========================================================
+# token buckets shared by all workers when IT_RATE_LIMIT_BACKEND is 'database';
+# unlogged since the buckets are disposable
+class RateLimitBucket(db.Model):
+    __tablename__ = 'rate_limit_buckets'
+    __table_args__ = {'prefixes': ['UNLOGGED']}
+
+    key = db.Column(db.String, primary_key=True)
+    tokens = db.Column(db.Float, nullable=False)
+    updated_at = db.Column(db.DateTime(timezone=True), nullable=False)
+
+    def __repr__(self):
+        return '<RateLimitBucket %s>' % self.key
@@ -10,6 +10,8 @@ import pytest
 
 from .admin_prepopulate_survey import prepopulate
 from config import MobileTestingConfig
+from mobile import caches
+from mobile.ratelimit import rate_limiter
 from models import user_datastore, WebUser, WebUserRole
 from mobile.server import create_app
 from mobile.database import db as _db
@@ -68,6 +70,9 @@ def session(db, request):
         transaction.rollback()
         connection.close()
         session.remove()
+        # cached entries would refer to rows rolled back above
+        caches.clear()
+        rate_limiter.clear()
 
     request.addfinalizer(teardown)
     return session
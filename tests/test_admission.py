@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2018
+from flask import url_for
+import json
+from sqlalchemy import create_engine
+
+from mobile.admission import admission, AdmissionControl
+from models import db
+from utils.metrics import metrics
+from tests.test_mobile_create import test_create_mobile_user as create_mobile_user
+
+
+def make_coordinates(n):
+    return [{
+        'latitude': '45.5088872928',
+        'longitude': '-73.6289835571',
+        'timestamp': '2018-04-24T{:02d}:{:02d}:{:02d}-04:00'.format(second // 3600, second // 60 % 60, second % 60)
+    } for second in range(n)]
+
+
+def test_admission_sheds_only_large_requests():
+    control = AdmissionControl()
+    control.enabled = True
+    control.max_in_flight, control.max_pending_points = 1, 1000
+    control.small_request_bytes, control.small_request_points = 1024, 10
+    assert control.retry_after(size=10 ** 6) is None
+
+    with control.track(points=600):
+        assert control.retry_after(size=100, points=10) is None
+        assert 1 <= control.retry_after(size=10 ** 6) <= control.max_retry_after
+    assert control.in_flight == 0 and control.pending_points == 0
+    assert control.retry_after(points=600) is None
+
+    with control.track(points=600):
+        control.max_in_flight = 2
+        # the estimated drain time of the excess points at the observed throughput
+        control.points_per_second = 100.
+        assert 2 <= control.retry_after(points=600) <= 3
+
+    for _ in range(10):
+        control.observe_checkout(2.)
+    assert control.retry_after(points=600) >= 4
+    control.max_retry_after = 3
+    assert control.retry_after(points=600) == 3
+
+
+def test_overloaded_worker_rejects_large_updates(app, client, session):
+    response = create_mobile_user(app, client, session)
+    uuid = response.get_json()['results']['uuid']
+    url = url_for('api.update_v1')
+
+    admission.max_in_flight = 0
+    try:
+        large = json.dumps({'uuid': uuid, 'coordinates': make_coordinates(1000)})
+        r = client.post(url, data=large, content_type='application/json')
+        assert r.status_code == 429
+        assert 1 <= int(r.headers['Retry-After']) <= admission.max_retry_after
+
+        small = json.dumps({'uuid': uuid, 'coordinates': make_coordinates(5)})
+        r = client.post(url, data=small, content_type='application/json')
+        assert r.status_code == 201
+    finally:
+        admission.init_app(app)
+        admission.reset()
+
+
+def test_pool_timeout_is_observed_and_answered_with_429(app, client, session):
+    response = create_mobile_user(app, client, session)
+    uuid = response.get_json()['results']['uuid']
+    url = url_for('api.update_v1')
+
+    # the only connection of a one-connection pool is held elsewhere
+    engine = create_engine(app.config['SQLALCHEMY_DATABASE_URI'], pool_size=1, max_overflow=0, pool_timeout=0.2)
+    held = engine.connect()
+    db.session = db.create_scoped_session(options={'bind': engine, 'binds': {}})
+    admission.pool_timeout = 0.5
+    timeouts = metrics.counters.get('admission.checkout_timeouts', 0)
+    try:
+        small = json.dumps({'uuid': uuid, 'coordinates': make_coordinates(5)})
+        r = client.post(url, data=small, content_type='application/json')
+        assert r.status_code == 429
+        assert 1 <= int(r.headers['Retry-After']) <= admission.max_retry_after
+        assert metrics.counters['admission.checkout_timeouts'] == timeouts + 1
+        assert metrics.timings['db.checkout']['max'] >= 0.5
+        assert admission.checkout_wait() > 0
+    finally:
+        db.session.remove()
+        db.session = session
+        held.close()
+        engine.dispose()
+        admission.init_app(app)
+        admission.reset()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2018
+import pytest
+import threading
+import time
+
+from utils.cache import SingleFlight, TTLCache
+
+
+def test_ttl_cache_expires_and_evicts():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2, ttl=0.01)
+    time.sleep(0.02)
+    assert cache.get('b') is None
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert (cache.get('a'), cache.get('b'), cache.get('c')) == (1, None, 3)
+
+
+def test_single_flight_shares_one_call():
+    flights = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def load():
+        calls.append(None)
+        started.set()
+        release.wait(5)
+        return len(calls)
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flights.do('test', load)))
+    leader.start()
+    started.wait(5)
+    waiters = [threading.Thread(target=lambda: results.append(flights.do('test', load))) for _ in range(5)]
+    for t in waiters:
+        t.start()
+    while flights.shared < 5:
+        time.sleep(0.001)
+    release.set()
+    for t in [leader] + waiters:
+        t.join(5)
+    assert results == [1] * 6
+    assert len(calls) == 1
+
+    # errors reach the caller and the key can be loaded again afterwards
+    def fail():
+        raise KeyError('test')
+    with pytest.raises(KeyError):
+        flights.do('test', fail)
+    assert flights.do('test', lambda: 2) == 2
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2018
+from flask import url_for
+import json
+import pytest
+
+from mobile.batch import CoordinateBatch
+from mobile.database import Database
+from mobile.filters import consecutive_distances, filter_coordinates
+from models import Survey
+from tests.test_mobile_create import test_create_mobile_user as create_mobile_user
+from tests.test_pool import metrics_headers
+
+
+database = Database()
+
+
+def make_points(track):
+    return [{
+        'latitude': lat,
+        'longitude': lng,
+        'hAccuracy': accuracy,
+        'timestamp': '2018-04-24T00:25:{:02d}-04:00'.format(second)
+    } for second, (lat, lng, accuracy) in enumerate(track)]
+
+
+def test_consecutive_distances():
+    # one thousandth of a degree of latitude is ~111 m
+    distances = consecutive_distances([45.5, 45.501, 45.501], [-73.6, -73.6, -73.6])
+    assert distances[0] == pytest.approx(111.2, abs=0.1)
+    assert distances[1] == 0
+
+
+def test_filter_drops_inaccurate_points_and_jumps():
+    track = [(45.5, -73.6, 10), (45.5001, -73.6, 10), (45.6, -73.6, 10),
+             (45.5002, -73.6, 80), (45.5003, -73.6, None), (45.5004, -73.6, 10)]
+    accepted, filtered = filter_coordinates(CoordinateBatch.from_points(make_points(track)),
+                                            accuracy_threshold=50, max_speed=90)
+    assert filtered == {'accuracy': 1, 'speed': 1}
+    assert [round(v, 4) for v in accepted.columns['latitude']] == [45.5, 45.5001, 45.5003, 45.5004]
+
+    # a survey without a threshold only filters on speed
+    accepted, filtered = filter_coordinates(CoordinateBatch.from_points(make_points(track)),
+                                            accuracy_threshold=0, max_speed=90)
+    assert filtered == {'accuracy': 0, 'speed': 1}
+
+
+def test_update_filters_coordinates(app, client, session):
+    response = create_mobile_user(app, client, session)
+    uuid = response.get_json()['results']['uuid']
+
+    track = [(45.5, -73.6, 10), (45.6, -73.6, 10), (45.5001, -73.6, 10), (45.5002, -73.6, 500)]
+    test_data = {'uuid': uuid, 'coordinates': make_points(track)}
+    app.config['COORDINATES_FILTER'] = 'drop'
+    try:
+        r = client.post(url_for('api.update_v1'), data=json.dumps(test_data), content_type='application/json')
+    finally:
+        app.config['COORDINATES_FILTER'] = 'off'
+    assert r.status_code == 201
+    results = r.get_json()['results']
+    assert results['coordinatesFiltered'] == {'accuracy': 1, 'speed': 1}
+    assert results['coordinatesInserted'] == 2
+    assert database.user.find_by_uuid(uuid).mobile_coordinates.count() == 2
+
+    counters = client.get('/metrics', headers=metrics_headers(app)).get_json()['counters']
+    assert counters['coordinates.filtered.speed'] >= 1
+
+
+def test_survey_overrides_filter_settings(app, client, session):
+    response = create_mobile_user(app, client, session)
+    uuid = response.get_json()['results']['uuid']
+    survey = Survey.query.get(database.user.find_by_uuid(uuid).survey_id)
+    survey.coordinates_filter = 'report'
+    survey.coordinates_filter_max_speed = 50000.
+    session.commit()
+
+    # the jump is within the survey's maximum speed and the inaccurate point is kept
+    track = [(45.5, -73.6, 10), (45.6, -73.6, 10), (45.5001, -73.6, 10), (45.5002, -73.6, 500)]
+    test_data = {'uuid': uuid, 'coordinates': make_points(track)}
+    r = client.post(url_for('api.update_v1'), data=json.dumps(test_data), content_type='application/json')
+    assert r.status_code == 201
+    results = r.get_json()['results']
+    assert results['coordinatesFiltered'] == {'accuracy': 1, 'speed': 0}
+    assert results['coordinatesInserted'] == 4
+
+
+def test_survey_max_speed_of_zero_disables_speed_test(app, client, session):
+    response = create_mobile_user(app, client, session)
+    uuid = response.get_json()['results']['uuid']
+    survey = Survey.query.get(database.user.find_by_uuid(uuid).survey_id)
+    survey.coordinates_filter = 'drop'
+    survey.coordinates_filter_max_speed = 0.
+    session.commit()
+
+    track = [(45.5, -73.6, 10), (45.6, -73.6, 10), (45.5001, -73.6, 10)]
+    test_data = {'uuid': uuid, 'coordinates': make_points(track)}
+    r = client.post(url_for('api.update_v1'), data=json.dumps(test_data), content_type='application/json')
+    assert r.status_code == 201
+    results = r.get_json()['results']
+    assert results['coordinatesFiltered'] == {'accuracy': 0, 'speed': 0}
+    assert results['coordinatesInserted'] == 3
@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2018
+import pytest
+from sqlalchemy.exc import IntegrityError
+
+from mobile.database import Database
+
+
+database = Database()
+
+
+def test_invalid_index_is_rebuilt(db):
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        connection.execute('CREATE TABLE index_test (a integer)')
+        try:
+            connection.execute('INSERT INTO index_test VALUES (1), (1), (2)')
+            # the failed build leaves an invalid index behind
+            with pytest.raises(IntegrityError):
+                database.indexes.create_unique_concurrently('index_test_a_key', 'index_test', ['a'])
+            assert database.indexes.is_valid(connection, 'index_test_a_key') is False
+
+            connection.execute('DELETE FROM index_test WHERE ctid = (SELECT max(ctid) FROM index_test WHERE a = 1)')
+            database.indexes.create_unique_concurrently('index_test_a_key', 'index_test', ['a'])
+            assert database.indexes.is_valid(connection, 'index_test_a_key') is True
+        finally:
+            connection.execute('DROP TABLE index_test')
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2018
+from flask import url_for
+import gzip
+import io
+import json
+import pytest
+from werkzeug.exceptions import RequestEntityTooLarge
+import zlib
+
+from mobile.database import Database
+from mobile.middleware import DecompressingStream, READ_SIZE
+from tests.test_mobile_create import test_create_mobile_user as create_mobile_user
+
+
+database = Database()
+
+
+def gzipped(data):
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def test_gzip_update_is_decompressed(app, client, session):
+    response = create_mobile_user(app, client, session)
+    uuid = response.get_json()['results']['uuid']
+
+    coordinates = [{
+        'latitude': '45.5088872928',
+        'longitude': '-73.6289835571',
+        'timestamp': '2018-04-24T00:25:{:02d}-04:00'.format(second)
+    } for second in range(30)]
+    body = gzipped(json.dumps({'uuid': uuid, 'coordinates': coordinates}).encode('utf-8'))
+    r = client.post(url_for('api.update_v1'), data=body, content_type='application/json',
+                    headers={'Content-Encoding': 'gzip'})
+    assert r.status_code == 201
+    assert database.user.find_by_uuid(uuid).mobile_coordinates.count() == 30
+
+
+def test_deflate_body_over_limit_is_rejected(app, client, session):
+    max_size = app.config['REQUEST_MAX_DECOMPRESSED_BYTES']
+    body = zlib.compress(b' ' * (max_size + 1))
+    r = client.post(url_for('api.update_v1'), data=body, content_type='application/json',
+                    headers={'Content-Encoding': 'deflate'})
+    assert r.status_code == 413
+
+
+def test_invalid_or_unsupported_encoding_is_rejected(app, client, session):
+    r = client.post(url_for('api.update_v1'), data=b'not gzip', content_type='application/json',
+                    headers={'Content-Encoding': 'gzip'})
+    assert r.status_code == 400
+
+    r = client.post(url_for('api.update_v1'), data=b'{}', content_type='application/json',
+                    headers={'Content-Encoding': 'br'})
+    assert r.status_code == 415
+
+
+def test_decompressing_stream_reads_incrementally():
+    data = b'\n'.join([str(i).encode('utf-8') for i in range(100000)])
+    stream = DecompressingStream(io.BytesIO(gzipped(data)), 'gzip', max_size=len(data))
+    assert stream.readline() == b'0\n'
+    assert stream.read(4) == b'1\n2\n'
+    assert stream.size < len(data)
+    assert b'0\n1\n2\n' + stream.read() == data
+
+
+def test_decompressing_stream_buffers_at_most_one_chunk():
+    # a highly compressible body inflates to many times its compressed size
+    data = b'0' * (READ_SIZE * 20)
+    stream = DecompressingStream(io.BytesIO(gzipped(data)), 'gzip', max_size=len(data))
+    read = b''
+    while True:
+        chunk = stream.read(1024)
+        assert len(stream._buffer) <= READ_SIZE
+        if not chunk:
+            break
+        read += chunk
+    assert read == data
+
+
+def test_decompressing_stream_limits_flushed_output():
+    class FlushingDecompressor(object):
+        unconsumed_tail = b''
+
+        def flush(self):
+            return b'0123'
+
+    stream = DecompressingStream(io.BytesIO(b''), 'gzip', max_size=3)
+    stream._decompressor = FlushingDecompressor()
+    with pytest.raises(RequestEntityTooLarge):
+        stream.read()
@@ -4,6 +4,11 @@ from flask import url_for
 import json
 import logging
 import pytest
+from sqlalchemy import event
+
+from mobile import caches
+from mobile.definitions import find_definition
+from models import db, MobileUser, Survey
 
 
 logging.basicConfig(level=logging.INFO)
@@ -47,6 +52,9 @@ def test_create_duplicate_mobile_user(app, client, session):
     test_create_mobile_user(app, client, session)
     test_create_mobile_user(app, client, session)
 
+    user = MobileUser.query.filter_by(uuid='7077a34e-afe5-4c22-bd96-119256b7dc51').one()
+    assert (user.itinerum_version, user.os, user.os_version) == ('12c', 'ios', '80.23')
+
 
 # create new user with underscores in variable names
 def test_create_mobile_user_legacy(app, client, session):
@@ -93,3 +101,90 @@ def test_create_mobile_user_with_bad_survey_name(app, client, session):
     url = url_for('api.create_v1')
     r = client.post(url, data=json.dumps(new_user_payload))
     assert r.status_code == 410
+
+
+def test_create_mobile_user_uses_cached_survey(app, client, session):
+    first = test_create_mobile_user(app, client, session)
+
+    statements = []
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        second = test_create_mobile_user(app, client, session)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+    assert second.get_json()['results'] == first.get_json()['results']
+    # only the user is looked up and written
+    assert statements
+    assert all('mobile_users' in s for s in statements)
+
+    # a modified survey is picked up once its name is revalidated
+    survey = Survey.query.filter_by(name='test').one()
+    survey.about_text = 'Updated'
+    survey.modified_at = db.func.now() + db.text("interval '1 second'")
+    session.commit()
+    r = test_create_mobile_user(app, client, session)
+    assert r.get_json()['results']['aboutText'] != 'Updated'
+    caches.survey_names.clear()
+    r = test_create_mobile_user(app, client, session)
+    assert r.get_json()['results']['aboutText'] == 'Updated'
+
+
+def test_create_mobile_user_with_current_survey_etag(app, client, session):
+    r = test_create_mobile_user(app, client, session)
+    etag = r.headers['ETag']
+    assert etag
+
+    new_user_payload = {
+        'lang': 'en',
+        'surveyName': 'test',
+        'user': {
+            'uuid': '7077a34e-afe5-4c22-bd96-119256b7dc51',
+            'itinerumVersion': '12c',
+            'osVersion': '80.23',
+            'model': 'iPhone 4s',
+            'os': 'ios'
+        }
+    }
+    url = url_for('api.create_v1')
+    r = client.post(url, data=json.dumps(new_user_payload), headers={'If-None-Match': etag})
+    assert r.status_code == 201
+    assert r.headers['ETag'] == etag
+    results = r.get_json()['results']
+    assert results['surveyNotModified'] is True
+    assert results['uuid'] == new_user_payload['user']['uuid']
+    assert results['surveyName'] == 'test'
+    assert not {'survey', 'prompt', 'aboutText', 'termsOfService'} & set(results)
+
+    r = client.post(url, data=json.dumps(new_user_payload), headers={'If-None-Match': '"stale"'})
+    assert len(r.get_json()['results']['survey']) == 16
+
+
+def test_unknown_survey_name_is_cached(app, client, session):
+    test_create_mobile_user_with_bad_survey_name(app, client, session)
+
+    statements = []
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        test_create_mobile_user_with_bad_survey_name(app, client, session)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+    assert statements == []
+
+
+def test_create_mobile_user_splices_encoded_survey(app, client, session):
+    compact = test_create_mobile_user(app, client, session)
+    # the cached definition is spliced into the compact body as encoded
+    definition = find_definition('test')
+    assert compact.get_data(as_text=True).endswith(',' + definition.encoded_payload[1:] + '}')
+
+    app.config['JSONIFY_PRETTYPRINT_REGULAR'] = True
+    try:
+        pretty = test_create_mobile_user(app, client, session)
+    finally:
+        app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
+    assert b'\n' in pretty.get_data()
+    assert pretty.get_json() == compact.get_json()
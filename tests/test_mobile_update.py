@@ -10,11 +10,16 @@ import logging
 import pytest
 import pytz
 import random
+from sqlalchemy import event
 
+from mobile import caches
 from mobile.database import Database
+from models import db
 from tests.hardcoded_survey_questions import default_stack
 from tests.test_mobile_create import test_create_mobile_user as create_mobile_user
+from tests.test_pool import metrics_headers
 from utils.data import camelcase_to_underscore, rename_json_keys, isclose
+from utils.metrics import metrics
 
 
 database = Database()
@@ -191,6 +196,157 @@ def test_add_mobile_user_coordinates_legacy(app, client, session):
         assert_request_data_matches_db_record(coordinates[idx], db_coordinate, api_version=1)
 
 
+def test_add_mobile_user_coordinates_orm_engine(app, client, session):
+    response = create_mobile_user(app, client, session)
+    response_json = response.get_json()
+    uuid = response_json['results']['uuid']
+
+    coordinates = [{
+        'latitude': '45.5088872928',
+        'longitude': '-73.6289835571',
+        'speed': 17.37400388436377,
+        'hAccuracy': 16,
+        'vAccuracy': 25,
+        'modeDetected': 1,
+        'pointType': 8,
+        'timestamp': '2018-04-24T00:25:13-04:00'
+    }]
+
+    # the ORM fallback must store the same columns as the default COPY engine
+    app.config['COORDINATES_INGEST_ENGINE'] = 'orm'
+    try:
+        test_data = {'uuid': uuid, 'coordinates': coordinates}
+        url = url_for('api.update_v1')
+        r = client.post(url, data=json.dumps(test_data), content_type='application/json')
+        assert r.status_code == 201
+    finally:
+        app.config['COORDINATES_INGEST_ENGINE'] = 'copy'
+
+    user = database.user.find_by_uuid(uuid)
+    assert user.mobile_coordinates.count() == 1
+    assert_request_data_matches_db_record(coordinates[0], user.mobile_coordinates.one(), api_version=2)
+
+    counters = client.get('/metrics', headers=metrics_headers(app)).get_json()['counters']
+    assert counters['coordinates.insert.orm.rows'] >= 1
+
+
+def test_error_add_coordinates_missing_latitude(app, client, session):
+    response = create_mobile_user(app, client, session)
+    response_json = response.get_json()
+    uuid = response_json['results']['uuid']
+
+    coordinates = [{
+        'longitude': '-73.6289835571',
+        'timestamp': '2018-04-24T00:25:13-04:00'
+    }]
+    test_data = {'uuid': uuid, 'coordinates': coordinates}
+    url = url_for('api.update_v1')
+    r = client.post(url, data=json.dumps(test_data), content_type='application/json')
+    assert r.status_code == 400
+
+    user = database.user.find_by_uuid(uuid)
+    assert user.mobile_coordinates.count() == 0
+
+
+def test_resent_update_is_not_stored_twice(app, client, session):
+    response = create_mobile_user(app, client, session)
+    response_json = response.get_json()
+    uuid = response_json['results']['uuid']
+
+    coordinates = [{
+        'latitude': '45.5088872928',
+        'longitude': '-73.6289835571',
+        'timestamp': '2018-04-24T00:25:13-04:00'
+    }]
+    test_data = json.dumps({'uuid': uuid, 'coordinates': coordinates})
+    url = url_for('api.update_v1')
+    first = client.post(url, data=test_data, content_type='application/json')
+    resent = client.post(url, data=test_data, content_type='application/json')
+    assert first.status_code == resent.status_code == 201
+    assert first.get_json() == resent.get_json()
+
+    user = database.user.find_by_uuid(uuid)
+    assert user.mobile_coordinates.count() == 1
+
+    # a client-supplied Idempotency-Key identifies a retry regardless of the body
+    headers = {'Idempotency-Key': 'a1d2c3'}
+    coordinates[0]['timestamp'] = '2018-04-24T00:25:28-04:00'
+    client.post(url, data=json.dumps({'uuid': uuid, 'coordinates': coordinates}),
+                content_type='application/json', headers=headers)
+    coordinates[0]['timestamp'] = '2018-04-24T00:25:43-04:00'
+    r = client.post(url, data=json.dumps({'uuid': uuid, 'coordinates': coordinates}),
+                    content_type='application/json', headers=headers)
+    assert r.status_code == 201
+
+    user = database.user.find_by_uuid(uuid)
+    assert user.mobile_coordinates.count() == 2
+
+    counters = client.get('/metrics', headers=metrics_headers(app)).get_json()['counters']
+    assert counters['update.idempotency.hits'] >= 2
+
+
+@pytest.mark.parametrize('engine', ['copy', 'orm'])
+def test_overlapping_coordinates_are_skipped(app, client, session, engine):
+    response = create_mobile_user(app, client, session)
+    response_json = response.get_json()
+    uuid = response_json['results']['uuid']
+
+    coordinates = [{
+        'latitude': '45.5088872928',
+        'longitude': '-73.6289835571',
+        'timestamp': '2018-04-24T00:25:{:02d}-04:00'.format(second)
+    } for second in (13, 28, 28)]
+    url = url_for('api.update_v1')
+
+    app.config['COORDINATES_INGEST_ENGINE'] = engine
+    try:
+        r = client.post(url, data=json.dumps({'uuid': uuid, 'coordinates': coordinates}),
+                        content_type='application/json')
+        assert r.status_code == 201
+        results = r.get_json()['results']
+        assert (results['coordinatesInserted'], results['coordinatesSkipped']) == (2, 1)
+
+        # a later upload overlapping the first is only partially stored
+        coordinates[2]['timestamp'] = '2018-04-24T00:25:43-04:00'
+        r = client.post(url, data=json.dumps({'uuid': uuid, 'coordinates': coordinates}),
+                        content_type='application/json')
+        results = r.get_json()['results']
+        assert (results['coordinatesInserted'], results['coordinatesSkipped']) == (1, 2)
+    finally:
+        app.config['COORDINATES_INGEST_ENGINE'] = 'copy'
+
+    user = database.user.find_by_uuid(uuid)
+    assert user.mobile_coordinates.count() == 3
+
+
+@pytest.mark.parametrize('engine', ['copy', 'orm'])
+def test_coordinates_are_inserted_in_chunks(app, client, session, engine):
+    response = create_mobile_user(app, client, session)
+    uuid = response.get_json()['results']['uuid']
+
+    # the last point repeats the first, which is stored by an earlier chunk
+    coordinates = [{
+        'latitude': '45.5088872928',
+        'longitude': '-73.6289835571',
+        'timestamp': '2018-04-24T00:25:{:02d}-04:00'.format(second)
+    } for second in (13, 28, 43, 58, 59, 13)]
+    chunks = metrics.timings.get('coordinates.insert.chunk', {}).get('count', 0)
+
+    chunk_size = app.config['COORDINATES_CHUNK_SIZE']
+    app.config.update(COORDINATES_INGEST_ENGINE=engine, COORDINATES_CHUNK_SIZE=2)
+    try:
+        r = client.post(url_for('api.update_v1'), data=json.dumps({'uuid': uuid, 'coordinates': coordinates}),
+                        content_type='application/json')
+        assert r.status_code == 201
+        results = r.get_json()['results']
+        assert (results['coordinatesInserted'], results['coordinatesSkipped']) == (5, 1)
+    finally:
+        app.config.update(COORDINATES_INGEST_ENGINE='copy', COORDINATES_CHUNK_SIZE=chunk_size)
+
+    assert metrics.timings['coordinates.insert.chunk']['count'] == chunks + 3
+    assert database.user.find_by_uuid(uuid).mobile_coordinates.count() == 5
+
+
 def test_add_mobile_user_cancelled_prompts(app, client, session):
     response = create_mobile_user(app, client, session)
     response_json = response.get_json()
@@ -570,3 +726,182 @@ def test_empty_update_is_200(app, client, session):
     url = url_for('api.update_v1')
     r = client.post(url, data=json.dumps(test_data), content_type='application/json')
     assert r.status_code == 200
+
+
+def test_update_uses_cached_user_context(app, client, session):
+    response = create_mobile_user(app, client, session)
+    uuid = response.get_json()['results']['uuid']
+    url = url_for('api.update_v1')
+
+    def post(second):
+        test_data = {
+            'uuid': uuid,
+            'coordinates': [{
+                'latitude': '45.5088872928',
+                'longitude': '-73.6289835571',
+                'timestamp': '2018-04-24T00:25:{:02d}-04:00'.format(second)
+            }]
+        }
+        r = client.post(url, data=json.dumps(test_data), content_type='application/json')
+        assert r.status_code == 201
+
+    post(13)
+    assert caches.user_contexts.get(uuid).mobile_id == database.user.find_by_uuid(uuid).id
+
+    statements = []
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        post(14)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+    assert not [s for s in statements if 'FROM mobile_users' in s or 'FROM surveys' in s]
+
+    # registering again drops the cached context
+    create_mobile_user(app, client, session)
+    assert caches.user_contexts.get(uuid) is None
+
+
+def test_update_commits_once(app, client, session):
+    response = create_mobile_user(app, client, session)
+    uuid = response.get_json()['results']['uuid']
+    test_data = {
+        'uuid': uuid,
+        'survey': {'location_home': {'latitude': 45.5, 'longitude': -73.6}},
+        'coordinates': [{
+            'latitude': '45.5088872928',
+            'longitude': '-73.6289835571',
+            'timestamp': '2018-04-24T00:25:13-04:00'
+        }],
+        'prompts': [{
+            'answer': ['Work'],
+            'displayedAt': '2018-04-25T18:02:35-04:00',
+            'latitude': '45.5396452179',
+            'longitude': '-73.6304455045',
+            'promptNum': 0,
+            'recordedAt': '2018-04-25T18:04:37-04:00',
+            'uuid': '53add9eb-d149-37a9-55e9-039df262b88e'
+        }],
+        'cancelledPrompts': [{
+            'cancelledAt': None,
+            'displayedAt': '2018-04-25T13:52:27-04:00',
+            'isTravelling': True,
+            'latitude': '45.5381202',
+            'longitude': '-73.6146599',
+            'uuid': '2ac7de0c-4a31-48c1-b65e-d93b6d5bd9f6'
+        }]
+    }
+    commits = metrics.snapshot()['counters'].get('db.commits', 0)
+    r = client.post(url_for('api.update_v1'), data=json.dumps(test_data), content_type='application/json')
+    assert r.status_code == 201
+    assert metrics.snapshot()['counters']['db.commits'] == commits + 1
+
+    user = database.user.find_by_uuid(uuid)
+    assert user.survey_response.count() == 1
+    assert user.mobile_coordinates.count() == 1
+    assert user.prompt_responses.count() == 1
+    assert user.cancelled_prompts.count() == 1
+
+
+def test_deprecated_prompts_store_nothing(app, client, session):
+    response = create_mobile_user(app, client, session)
+    uuid = response.get_json()['results']['uuid']
+    test_data = {
+        'uuid': uuid,
+        'coordinates': [{
+            'latitude': '45.5088872928',
+            'longitude': '-73.6289835571',
+            'timestamp': '2018-04-24T00:25:13-04:00'
+        }],
+        'cancelledPrompts': [{
+            'displayedAt': '2018-04-25T13:52:27-04:00',
+            'latitude': '45.5381202',
+            'longitude': '-73.6146599'
+        }]
+    }
+    r = client.post(url_for('api.update_v1'), data=json.dumps(test_data), content_type='application/json')
+    assert r.status_code == 400
+    assert database.user.find_by_uuid(uuid).mobile_coordinates.count() == 0
+
+
+def test_add_prompt_num_to_known_prompt(app, client, session):
+    response = create_mobile_user(app, client, session)
+    uuid = response.get_json()['results']['uuid']
+    url = url_for('api.update_v1')
+
+    def prompt(prompt_num, answer):
+        return {
+            'answer': [answer],
+            'displayedAt': '2018-04-25T18:02:35-04:00',
+            'latitude': '45.5396452179',
+            'longitude': '-73.6304455045',
+            'promptNum': prompt_num,
+            'recordedAt': '2018-04-25T18:04:37-04:00',
+            'uuid': '72be2e8e-7ee8-f1b0-f175-84bf034111d5'
+        }
+
+    r = client.post(url, data=json.dumps({'uuid': uuid, 'prompts': [prompt(0, 'Work')]}),
+                    content_type='application/json')
+    assert r.status_code == 201
+    # a second answer to a known prompt and a repeated edit in the same request
+    test_data = {'uuid': uuid, 'prompts': [prompt(0, 'Home'), prompt(1, 'Great'), prompt(1, 'Good')]}
+    r = client.post(url, data=json.dumps(test_data), content_type='application/json')
+    assert r.status_code == 201
+
+    user = database.user.find_by_uuid(uuid)
+    answers = {p.prompt_num: p.response for p in user.prompt_responses}
+    assert answers == {0: ['Home'], 1: ['Good']}
+
+
+def test_resent_cancelled_prompts_are_skipped(app, client, session):
+    response = create_mobile_user(app, client, session)
+    uuid = response.get_json()['results']['uuid']
+    url = url_for('api.update_v1')
+
+    def cancelled_prompt(prompt_uuid):
+        return {
+            'cancelledAt': None,
+            'displayedAt': '2018-04-25T13:52:27-04:00',
+            'isTravelling': True,
+            'latitude': '45.5381202',
+            'longitude': '-73.6146599',
+            'uuid': prompt_uuid
+        }
+
+    first = cancelled_prompt('2ac7de0c-4a31-48c1-b65e-d93b6d5bd9f6')
+    second = cancelled_prompt('610e66d8-8505-c081-c55c-5f6274e50fdb')
+    r = client.post(url, data=json.dumps({'uuid': uuid, 'cancelledPrompts': [first]}),
+                    content_type='application/json')
+    assert r.status_code == 201
+
+    r = client.post(url, data=json.dumps({'uuid': uuid, 'cancelledPrompts': [first, second, second]}),
+                    content_type='application/json')
+    assert r.status_code == 201
+    user = database.user.find_by_uuid(uuid)
+    assert user.cancelled_prompts.count() == 2
+
+    r = client.post(url, data=json.dumps({'uuid': uuid, 'cancelledPrompts': [second]}),
+                    content_type='application/json')
+    assert r.status_code == 200
+    assert 'already stored' in r.get_json()['results']['cancelledPrompts']
+
+
+def test_unchanged_survey_response_is_not_written(app, client, session):
+    response = create_mobile_user(app, client, session)
+    uuid = response.get_json()['results']['uuid']
+    url = url_for('api.update_v1')
+    test_data = {'uuid': uuid, 'survey': {'member_type': 2, 'survey_number': 6057}}
+
+    r = client.post(url, data=json.dumps(test_data), content_type='application/json')
+    assert r.status_code == 201
+    r = client.post(url, data=json.dumps(test_data), content_type='application/json',
+                    headers={'Idempotency-Key': 'resend'})
+    assert r.status_code == 200
+    assert 'unchanged' in r.get_json()['results']['survey']
+
+    test_data['survey']['survey_number'] = 6058
+    r = client.post(url, data=json.dumps(test_data), content_type='application/json')
+    assert r.status_code == 201
+    user = database.user.find_by_uuid(uuid)
+    assert user.survey_response.one().response['survey_number'] == 6058
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2018
+from datetime import date
+from flask import url_for
+import json
+import pytest
+
+from mobile.database import Database
+from mobile.db.partitions import add_months, partition_name
+from tests.test_mobile_create import test_create_mobile_user as create_mobile_user
+
+
+database = Database()
+
+
+def test_partition_helpers():
+    assert add_months(date(2018, 11, 1), 2) == date(2019, 1, 1)
+    assert add_months(date(2018, 1, 1), -1) == date(2017, 12, 1)
+    assert partition_name(date(2018, 4, 1)) == 'mobile_coordinates_y2018m04'
+
+
+def test_created_partition_takes_rows_from_default(app, client, session):
+    response = create_mobile_user(app, client, session)
+    uuid = response.get_json()['results']['uuid']
+    coordinates = [{
+        'latitude': '45.5088872928',
+        'longitude': '-73.6289835571',
+        'timestamp': timestamp
+    } for timestamp in ('2018-04-24T00:25:13-04:00', '2018-05-01T00:25:13-04:00')]
+    r = client.post(url_for('api.update_v1'), data=json.dumps({'uuid': uuid, 'coordinates': coordinates}),
+                    content_type='application/json')
+    assert r.status_code == 201
+
+    assert database.partitions.is_partitioned()
+    assert database.partitions.ensure(months_ahead=1, start=date(2018, 4, 1)) == [
+        'mobile_coordinates_y2018m04', 'mobile_coordinates_y2018m05']
+    assert database.partitions.create(date(2018, 4, 15)) is False
+
+    counts = dict(session.execute('SELECT tableoid::regclass::text, count(*) FROM mobile_coordinates '
+                                  'GROUP BY 1').fetchall())
+    assert counts == {'mobile_coordinates_y2018m04': 1, 'mobile_coordinates_y2018m05': 1}
+    assert database.user.find_by_uuid(uuid).mobile_coordinates.count() == 2
+
+    # an attached month is not archived
+    with pytest.raises(ValueError):
+        database.partitions.archive(date(2018, 5, 1), '/nonexistent')
+
+    database.partitions.detach(date(2018, 5, 1))
+    partitions = {p['name']: p['attached'] for p in database.partitions.list()}
+    assert partitions['mobile_coordinates_y2018m04'] is True
+    assert partitions['mobile_coordinates_y2018m05'] is False
+    assert database.user.find_by_uuid(uuid).mobile_coordinates.count() == 1
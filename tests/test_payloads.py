@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2018
+from flask import url_for
+import json
+import pytest
+
+from mobile.batch import CoordinateBatch
+from mobile.database import Database
+from mobile.payloads import decode_packed_coordinates, encode_packed_coordinates, PACKED_COORDINATES_MIMETYPE
+from tests.test_mobile_create import test_create_mobile_user as create_mobile_user
+
+
+database = Database()
+
+
+def make_points(n):
+    return [{
+        'latitude': 45.5088872 + i * 1e-5,
+        'longitude': -73.6289835 - i * 1e-5,
+        'hAccuracy': 16.5,
+        'modeDetected': 1 if i % 2 else None,
+        'timestamp': '2018-04-24T00:25:{:02d}.250-04:00'.format(i)
+    } for i in range(n)]
+
+
+def test_packed_coordinates_round_trip():
+    batch = CoordinateBatch.from_points(make_points(5))
+    uuid, decoded = decode_packed_coordinates(encode_packed_coordinates('abc-123', batch))
+    assert uuid == 'abc-123'
+    assert list(decoded.timestamps) == list(batch.timestamps)
+    for column in ('latitude', 'longitude'):
+        assert list(decoded.columns[column]) == pytest.approx(list(batch.columns[column]), abs=1e-6)
+    assert list(decoded.columns['h_accuracy']) == [16.5] * 5
+    assert [v == v for v in decoded.columns['mode_detected']] == [False, True, False, True, False]
+    assert all(v != v for v in decoded.columns['speed'])
+
+
+def test_malformed_packed_coordinates_are_rejected():
+    data = encode_packed_coordinates('abc-123', CoordinateBatch.from_points(make_points(2)))
+    for malformed in (data[:10], data[:-1], b'XXXX' + data[4:]):
+        with pytest.raises(ValueError):
+            decode_packed_coordinates(malformed)
+
+
+def test_add_packed_coordinates(app, client, session):
+    response = create_mobile_user(app, client, session)
+    uuid = response.get_json()['results']['uuid']
+    url = url_for('api.update_v1')
+
+    data = encode_packed_coordinates(uuid, CoordinateBatch.from_points(make_points(3)))
+    r = client.post(url, data=data, content_type=PACKED_COORDINATES_MIMETYPE)
+    assert r.status_code == 201
+    assert r.get_json()['results']['coordinatesInserted'] == 3
+
+    coordinates = database.user.find_by_uuid(uuid).mobile_coordinates.order_by('timestamp').all()
+    assert float(coordinates[0].latitude) == pytest.approx(45.5088872)
+    assert coordinates[1].mode_detected == 1
+
+    r = client.post(url, data=data[:-1], content_type=PACKED_COORDINATES_MIMETYPE)
+    assert r.status_code == 400
+
+
+def test_add_columnar_coordinates(app, client, session):
+    response = create_mobile_user(app, client, session)
+    uuid = response.get_json()['results']['uuid']
+    url = url_for('api.update_v1')
+
+    points = make_points(3)
+    columns = {key: [p[key] for p in points] for key in points[0]}
+    r = client.post(url, data=json.dumps({'uuid': uuid, 'coordinates': columns}),
+                    content_type='application/json')
+    assert r.status_code == 201
+    assert r.get_json()['results']['coordinatesInserted'] == 3
+    coordinates = database.user.find_by_uuid(uuid).mobile_coordinates.order_by('timestamp').all()
+    assert [c.mode_detected for c in coordinates] == [None, 1, None]
+
+    columns['latitude'].pop()
+    r = client.post(url, data=json.dumps({'uuid': uuid, 'coordinates': columns}),
+                    content_type='application/json')
+    assert r.status_code == 400
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2018
+from flask import Flask
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import NullPool
+
+import config
+from mobile.database import configure_engine
+from models import PooledSQLAlchemy
+
+
+def metrics_headers(app):
+    return {'Authorization': 'Bearer {}'.format(app.config['METRICS_TOKEN'])}
+
+
+def engine_options(**settings):
+    app = Flask(__name__)
+    app.config.from_object(config.MobileTestingConfig)
+    app.config.update(settings)
+    sa = PooledSQLAlchemy(app)
+    options = {}
+    sa.apply_pool_defaults(app, options)
+    sa.apply_driver_hacks(app, make_url(app.config['SQLALCHEMY_DATABASE_URI']), options)
+    return options
+
+
+def test_engine_options_from_config():
+    options = engine_options(SQLALCHEMY_POOL_SIZE=3, SQLALCHEMY_MAX_OVERFLOW=2, DB_STATEMENT_TIMEOUT=5000)
+    assert options['pool_size'] == 3 and options['max_overflow'] == 2
+    assert options['pool_pre_ping'] is True
+    assert options['connect_args']['options'] == '-c statement_timeout=5000'
+
+    # no startup options behind pgbouncer and no pool when it is sized 0
+    options = engine_options(SQLALCHEMY_POOL_SIZE=0, DB_PGBOUNCER=True, DB_STATEMENT_TIMEOUT=5000)
+    assert options['poolclass'] is NullPool
+    assert 'pool_size' not in options and 'options' not in options['connect_args']
+
+
+def test_pgbouncer_mode_sets_timeout_per_transaction(db):
+    app = Flask(__name__)
+    app.config.from_object(config.MobileTestingConfig)
+    app.config.update(DB_PGBOUNCER=True, DB_STATEMENT_TIMEOUT=1234)
+    db.init_app(app)
+    configure_engine(app)
+    engine = db.get_engine(app)
+    try:
+        with engine.begin() as connection:
+            assert connection.execute('SHOW statement_timeout').scalar() == '1234ms'
+        with engine.connect() as connection:
+            assert connection.execute('SHOW statement_timeout').scalar() == '0'
+    finally:
+        engine.dispose()
+
+
+def test_pool_health_reports_saturation(app, client, db):
+    r = client.get('/health/pool', headers=metrics_headers(app))
+    assert r.status_code == 200
+    pool = r.get_json()['pool']
+    assert pool['class'] == 'QueuePool'
+    assert pool['size'] == app.config['SQLALCHEMY_POOL_SIZE']
+    assert 0 <= pool['saturation'] <= 1
+
+    with db.engine.connect():
+        held = client.get('/health/pool', headers=metrics_headers(app)).get_json()['pool']
+    assert held['checked_out'] == pool['checked_out'] + 1
+    assert held['saturation'] > pool['saturation']
+
+
+def test_worker_internals_require_the_metrics_token(app, client, db):
+    for path in ('/health/pool', '/metrics'):
+        assert client.get(path).status_code == 401
+        assert client.get(path, headers={'Authorization': 'Bearer wrong'}).status_code == 401
+        assert client.get(path, headers=metrics_headers(app)).status_code == 200
+
+    # neither is served unless a token is configured
+    token, app.config['METRICS_TOKEN'] = app.config['METRICS_TOKEN'], None
+    try:
+        assert client.get('/metrics').status_code == 404
+        assert client.get('/health/pool').status_code == 404
+    finally:
+        app.config['METRICS_TOKEN'] = token
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2018
+from flask import url_for
+import json
+
+from mobile.ratelimit import DatabaseBucketStore, LocalBucketStore, rate_limiter
+from tests.test_mobile_create import test_create_mobile_user as create_mobile_user
+
+
+def check_bucket_store(store):
+    # 2 tokens of capacity refilled at 1 token per minute
+    rate = 1 / 60.
+    assert store.take('requests:a', 1, rate, 2) == 0
+    assert store.take('requests:a', 1, rate, 2) == 0
+    assert 55 < store.take('requests:a', 1, rate, 2) <= 60
+    assert store.take('requests:b', 2, rate, 2) == 0
+    assert 115 < store.take('requests:b', 2, rate, 2) <= 120
+
+
+def test_local_bucket_store():
+    check_bucket_store(LocalBucketStore())
+
+
+def test_database_bucket_store(db):
+    store = DatabaseBucketStore()
+    try:
+        check_bucket_store(store)
+    finally:
+        store.clear()
+
+
+def test_looping_device_is_rate_limited(app, client, session):
+    response = create_mobile_user(app, client, session)
+    uuid = response.get_json()['results']['uuid']
+    url = url_for('api.update_v1')
+    test_data = {
+        'uuid': uuid,
+        'coordinates': [{
+            'latitude': '45.5088872928',
+            'longitude': '-73.6289835571',
+            'timestamp': '2018-04-24T00:25:13-04:00'
+        }]
+    }
+
+    rate_limiter.requests_burst = 2
+    try:
+        for _ in range(2):
+            r = client.post(url, data=json.dumps(test_data), content_type='application/json',
+                            headers={'X-Itinerum-UUID': uuid})
+            assert r.status_code in (200, 201)
+
+        # the body is not parsed once a device identified by its header is limited
+        r = client.post(url, data='not json', content_type='application/json',
+                        headers={'X-Itinerum-UUID': uuid})
+        assert r.status_code == 429
+        assert 1 <= int(r.headers['Retry-After']) <= 2
+        assert r.get_json()['errors'] == ['Too many updates from this device, retry later.']
+
+        # without the header the uuid is taken from the body
+        r = client.post(url, data=json.dumps(test_data), content_type='application/json')
+        assert r.status_code == 429
+
+        # a header naming another device still charges the body's uuid
+        r = client.post(url, data=json.dumps(test_data), content_type='application/json',
+                        headers={'X-Itinerum-UUID': 'forged-uuid'})
+        assert r.status_code == 429
+    finally:
+        rate_limiter.init_app(app)
+
+
+def test_replayed_update_is_not_charged_points(app, client, session):
+    response = create_mobile_user(app, client, session)
+    uuid = response.get_json()['results']['uuid']
+    url = url_for('api.update_v1')
+    coordinates = [{
+        'latitude': '45.5088872928',
+        'longitude': '-73.6289835571',
+        'timestamp': '2018-04-24T00:25:{:02d}-04:00'.format(second)
+    } for second in range(3)]
+    test_data = json.dumps({'uuid': uuid, 'coordinates': coordinates})
+
+    # the bucket only holds the points of one upload
+    rate_limiter.points_burst = 3
+    rate_limiter.points_per_minute = 1
+    try:
+        r = client.post(url, data=test_data, content_type='application/json')
+        assert r.status_code == 201
+        # a retry of the same upload is answered from the idempotency cache
+        r = client.post(url, data=test_data, content_type='application/json')
+        assert r.status_code == 201
+
+        coordinates[0]['timestamp'] = '2018-04-24T00:26:00-04:00'
+        r = client.post(url, data=json.dumps({'uuid': uuid, 'coordinates': coordinates}),
+                        content_type='application/json')
+        assert r.status_code == 429
+    finally:
+        rate_limiter.init_app(app)
+
+
+def test_looping_device_without_header_is_limited_before_parsing(app, client, session):
+    response = create_mobile_user(app, client, session)
+    uuid = response.get_json()['results']['uuid']
+    url = url_for('api.update_v1')
+    test_data = json.dumps({'uuid': uuid, 'prompts': []})
+
+    rate_limiter.requests_burst = 2
+    try:
+        for _ in range(2):
+            r = client.post(url, data=test_data, content_type='application/json')
+            assert r.status_code == 200
+
+        # the same client resending a body of the same length is turned away unread
+        r = client.post(url, data='x' * len(test_data), content_type='application/json')
+        assert r.status_code == 429
+        assert r.get_json()['errors'] == ['Too many updates from this device, retry later.']
+        # while a body of another length is read and parsed as usual
+        r = client.post(url, data='x' * (len(test_data) + 1), content_type='application/json')
+        assert r.status_code == 400
+    finally:
+        rate_limiter.init_app(app)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2018
+from flask import url_for
+import json
+import os
+import pytest
+import time
+
+from mobile.database import Database
+from mobile.routes.v1.mobile_update import replay_spooled_update
+from mobile.spool import Spool, SpoolError, SpoolReplayer, spool as app_spool
+from tests.test_mobile_create import test_create_mobile_user as create_mobile_user
+
+
+database = Database()
+
+
+def test_spool_append_and_replay(tmpdir):
+    spool = Spool(directory=str(tmpdir), mode='fallback', segment_bytes=100)
+    for i in range(3):
+        spool.append(json.dumps({'n': i}).encode('utf-8'), content_type='application/json')
+    spool.close()
+    assert spool.stats()['pending'] == 3
+
+    seen = []
+    replayed, rejected = spool.replay(lambda r: seen.append(json.loads(r.body.decode('utf-8'))['n']) or True)
+    assert (replayed, rejected) == (3, 0)
+    assert seen == [0, 1, 2]
+    # fully replayed sealed segments are removed
+    assert spool.segments() == []
+
+
+def test_spool_replay_resumes_from_checkpoint(tmpdir):
+    spool = Spool(directory=str(tmpdir), mode='fallback')
+    for i in range(4):
+        spool.append(str(i).encode('utf-8'))
+    spool.close()
+
+    assert spool.replay(lambda r: True, limit=2) == (2, 0)
+    seen = []
+    assert spool.replay(lambda r: seen.append(r.body) or True) == (2, 0)
+    assert seen == [b'2', b'3']
+
+
+def test_spool_replay_backs_off_and_gives_up(tmpdir):
+    spool = Spool(directory=str(tmpdir), mode='fallback')
+    spool.append(b'{}')
+    spool.close()
+
+    def unavailable(record):
+        raise RuntimeError('database unavailable')
+
+    with pytest.raises(SpoolError):
+        spool.replay(unavailable, backoff=0, max_failures=2)
+    # the record is kept for the next replay
+    assert spool.stats()['pending'] == 1
+
+
+def test_spool_ignores_truncated_tail_and_compacts(tmpdir):
+    spool = Spool(directory=str(tmpdir), mode='fallback')
+    spool.append(b'first')
+    spool.append(b'second')
+    spool.close()
+    path = spool.segments()[0]
+    with open(path, 'ab') as f:
+        f.write(b'\x10\x00\x00\x00partial')
+
+    assert spool.replay(lambda r: True, limit=1) == (1, 0)
+    assert spool.compact() == (0, 1)
+    records = list(spool.read(path))
+    assert [r.body for r in records] == [b'second']
+    # the replayed record and the corrupt tail were both dropped
+    assert records[-1].next_offset == os.path.getsize(path)
+
+
+@pytest.mark.parametrize('step', ['remove', 'rename'])
+def test_spool_interrupted_compaction_keeps_pending_records(tmpdir, monkeypatch, step):
+    spool = Spool(directory=str(tmpdir), mode='fallback')
+    for i in range(3):
+        spool.append(str(i).encode('utf-8'))
+    spool.close()
+    assert spool.replay(lambda r: True, limit=1) == (1, 0)
+
+    # the process is killed at the given step of the rewrite
+    original = getattr(os, step)
+    def crash(path, *args):
+        if path.endswith(('.offset', '.compact')):
+            raise OSError('killed')
+        return original(path, *args)
+    monkeypatch.setattr('mobile.spool.os.' + step, crash)
+    with pytest.raises(OSError):
+        spool.compact()
+    monkeypatch.undo()
+
+    # the replayed record may be replayed again but no pending one is skipped
+    seen = []
+    spool.replay(lambda r: seen.append(r.body) or True)
+    assert seen[-2:] == [b'1', b'2']
+
+
+def test_spool_seals_segments_of_exited_workers(tmpdir):
+    spool = Spool(directory=str(tmpdir), mode='fallback')
+    spool.append(b'first')
+    spool.append(b'second')
+    path = spool._segment_path
+    spool._segment.close()
+    spool.replay(lambda r: True, limit=1)
+    # the segment is left open by a worker that has since exited
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0)
+    os.waitpid(pid, 0)
+    dead_path = path.replace('-{}-'.format(os.getpid()), '-{}-'.format(pid))
+    os.rename(path, dead_path)
+    os.rename(path + '.offset', dead_path + '.offset')
+    spool._segment, spool._segment_path = None, None
+
+    assert spool.compact() == (0, 1)
+    assert [os.path.basename(p)[-4:] for p in spool.segments()] == ['.log']
+    assert spool.replay(lambda r: r.body == b'second') == (1, 0)
+    assert os.listdir(str(tmpdir)) == ['replay.lock']
+
+
+def test_spool_is_replayed_by_one_process_at_a_time(tmpdir):
+    spool = Spool(directory=str(tmpdir), mode='fallback')
+    spool.append(b'first')
+    spool.close()
+
+    replayer = SpoolReplayer(spool, handler=lambda r: True)
+    with spool._replay_lock():
+        with pytest.raises(SpoolError):
+            spool.replay(lambda r: True)
+        # the worker's replayer leaves the spool to the process holding the lock
+        assert replayer.replay() == (0, 0)
+    assert spool.backlog()['segments'] == 1
+    assert replayer.replay() == (1, 0)
+    assert spool.backlog() == {'segments': 0, 'pending_bytes': 0}
+
+
+def test_spool_replayer_drains_the_spool_in_the_background(tmpdir):
+    spool = Spool(directory=str(tmpdir), mode='fallback')
+    for i in range(3):
+        spool.append(str(i).encode('utf-8'))
+    spool.close()
+    assert spool.backlog()['pending_bytes'] == os.path.getsize(spool.segments()[0])
+
+    seen = []
+    replayer = SpoolReplayer(spool, handler=lambda r: seen.append(r.body) or True, interval=0.01)
+    replayer.enabled = True
+    replayer.ensure_started()
+    deadline = time.time() + 5
+    while spool.segments() and time.time() < deadline:
+        time.sleep(0.01)
+    assert seen == [b'0', b'1', b'2']
+    assert spool.segments() == []
+    # the daemon thread outlives the test
+    replayer.interval = 3600
+
+
+def test_spooled_update_is_replayed(app, client, session, tmpdir):
+    response = create_mobile_user(app, client, session)
+    uuid = response.get_json()['results']['uuid']
+
+    app.config.update(UPDATE_SPOOL_MODE='always', UPDATE_SPOOL_DIR=str(tmpdir))
+    app_spool.init_app(app)
+    try:
+        coordinates = [{
+            'latitude': '45.5088872928',
+            'longitude': '-73.6289835571',
+            'timestamp': '2018-04-24T00:25:13-04:00'
+        }]
+        test_data = {'uuid': uuid, 'coordinates': coordinates}
+        r = client.post(url_for('api.update_v1'), data=json.dumps(test_data), content_type='application/json')
+        assert r.status_code == 202
+        assert database.user.find_by_uuid(uuid).mobile_coordinates.count() == 0
+
+        app_spool.close()
+        assert app_spool.replay(lambda record: replay_spooled_update(app, record)) == (1, 0)
+        assert database.user.find_by_uuid(uuid).mobile_coordinates.count() == 1
+    finally:
+        app.config.update(UPDATE_SPOOL_MODE='off')
+        app_spool.init_app(app)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2018
+from flask import url_for
+import json
+import pytest
+
+from mobile.database import Database
+from mobile.rollups import rollups, sum_deltas, SurveyRollups
+from models import MobileUserStats, SurveyStats
+from tests.test_mobile_create import test_create_mobile_user as create_mobile_user
+
+
+database = Database()
+
+
+def make_prompt(uuid, prompt_num, displayed_at='2018-04-25T18:02:35-04:00'):
+    return {
+        'answer': ['Work'],
+        'displayedAt': displayed_at,
+        'latitude': '45.5396452179',
+        'longitude': '-73.6304455045',
+        'promptNum': prompt_num,
+        'recordedAt': '2018-04-25T18:04:37-04:00',
+        'uuid': uuid
+    }
+
+
+def make_cancelled_prompt(uuid):
+    return {
+        'cancelledAt': None,
+        'displayedAt': '2018-04-25T13:52:27-04:00',
+        'isTravelling': True,
+        'latitude': '45.5381202',
+        'longitude': '-73.6146599',
+        'uuid': uuid
+    }
+
+
+def get_stats(user):
+    return MobileUserStats.query.filter_by(mobile_id=user.id).one()
+
+
+def test_update_increments_user_stats(app, client, session):
+    response = create_mobile_user(app, client, session)
+    uuid = response.get_json()['results']['uuid']
+    url = url_for('api.update_v1')
+
+    test_data = {
+        'uuid': uuid,
+        'coordinates': [{
+            'latitude': '45.5088872928',
+            'longitude': '-73.6289835571',
+            'timestamp': '2018-04-24T00:25:{:02d}-04:00'.format(second)
+        } for second in (13, 28)],
+        'prompts': [make_prompt('53add9eb-d149-37a9-55e9-039df262b88e', n) for n in (0, 1)],
+        'cancelledPrompts': [make_cancelled_prompt('2ac7de0c-4a31-48c1-b65e-d93b6d5bd9f6'),
+                             make_cancelled_prompt('610e66d8-8505-c081-c55c-5f6274e50fdb')]
+    }
+    r = client.post(url, data=json.dumps(test_data), content_type='application/json')
+    assert r.status_code == 201
+
+    user = database.user.find_by_uuid(uuid)
+    stats = get_stats(user)
+    assert (stats.total_coordinates, stats.total_prompts, stats.total_cancelled_prompts) == (2, 2, 2)
+    latest = user.mobile_coordinates.order_by('timestamp').all()[-1]
+    assert stats.latest_coordinate == latest.id
+    assert stats.latest_prompt == max(p.id for p in user.prompt_responses)
+
+    # answering a cancelled prompt replaces it; edits and skipped points add nothing
+    test_data = {
+        'uuid': uuid,
+        'coordinates': test_data['coordinates'],
+        'prompts': [make_prompt('53add9eb-d149-37a9-55e9-039df262b88e', 0),
+                    make_prompt('610e66d8-8505-c081-c55c-5f6274e50fdb', 0)]
+    }
+    r = client.post(url, data=json.dumps(test_data), content_type='application/json')
+    assert r.status_code == 201
+    session.expire_all()
+    stats = get_stats(user)
+    assert (stats.total_coordinates, stats.total_prompts, stats.total_cancelled_prompts) == (2, 3, 1)
+
+    # a rebuild from the stored rows agrees with the incremental totals
+    stats.total_coordinates, stats.latest_coordinate = 1000, None
+    session.commit()
+    assert database.stats.rebuild(user.id, user.id + 1) == 1
+    session.expire_all()
+    stats = get_stats(user)
+    assert (stats.total_coordinates, stats.total_prompts, stats.total_cancelled_prompts) == (2, 3, 1)
+    assert stats.latest_coordinate == latest.id
+
+
+def test_survey_rollups_keep_deltas_of_failed_flushes():
+    flushed = []
+
+    def flush(entries):
+        if not flushed:
+            flushed.append(None)
+            raise IOError('database unavailable')
+        flushed.append(sum_deltas(entries))
+
+    survey_rollups = SurveyRollups(flush=flush, interval=3600)
+    survey_rollups.enabled = True
+    survey_rollups.add(1, coordinates=10, prompts=1)
+    survey_rollups.add(2, cancelled_prompts=1)
+    survey_rollups.add(2, prompts=0)
+    with pytest.raises(IOError):
+        survey_rollups.flush()
+
+    survey_rollups.add(1, coordinates=5, cancelled_prompts=-1)
+    assert survey_rollups.flush() == 2
+    assert flushed[-1] == {1: {'coordinates': 15, 'prompts': 1, 'cancelled_prompts': -1},
+                           2: {'coordinates': 0, 'prompts': 0, 'cancelled_prompts': 1}}
+    assert survey_rollups.flush() == 0
+
+
+def test_update_adds_survey_rollups(app, client, session):
+    response = create_mobile_user(app, client, session)
+    uuid = response.get_json()['results']['uuid']
+    user = database.user.find_by_uuid(uuid)
+    before = SurveyStats.query.get(user.survey_id)
+    before = (before.total_coordinates or 0, before.total_prompts or 0) if before else (0, 0)
+
+    test_data = {
+        'uuid': uuid,
+        'coordinates': [{
+            'latitude': '45.5088872928',
+            'longitude': '-73.6289835571',
+            'timestamp': '2018-04-24T00:25:{:02d}-04:00'.format(second)
+        } for second in (13, 28, 43)],
+        'prompts': [make_prompt('53add9eb-d149-37a9-55e9-039df262b88e', 0)]
+    }
+    rollups.enabled, rollups.interval = True, 3600
+    try:
+        r = client.post(url_for('api.update_v1'), data=json.dumps(test_data), content_type='application/json')
+        assert r.status_code == 201
+        assert rollups.flush() == 1
+    finally:
+        rollups.enabled = app.config['SURVEY_ROLLUPS']
+    session.expire_all()
+    stats = SurveyStats.query.get(user.survey_id)
+    assert (stats.total_coordinates, stats.total_prompts) == (before[0] + 3, before[1] + 1)
+
+    # reconciliation recomputes the totals from the per-user statistics
+    stats.total_coordinates = 1000
+    session.commit()
+    assert database.stats.reconcile() >= 1
+    session.expire_all()
+    stats = SurveyStats.query.get(user.survey_id)
+    assert (stats.total_coordinates, stats.total_prompts) == (before[0] + 3, before[1] + 1)
+
+
+def test_reconcile_skips_deltas_pending_in_rollups(app, client, session):
+    response = create_mobile_user(app, client, session)
+    user = database.user.find_by_uuid(response.get_json()['results']['uuid'])
+    coordinates = [{
+        'latitude': '45.5088872928',
+        'longitude': '-73.6289835571',
+        'timestamp': '2018-04-24T00:25:{:02d}-04:00'.format(second)
+    } for second in (13, 28)]
+
+    rollups.enabled, rollups.interval = True, 3600
+    try:
+        r = client.post(url_for('api.update_v1'), data=json.dumps({'uuid': user.uuid, 'coordinates': coordinates}),
+                        content_type='application/json')
+        assert r.status_code == 201
+        # the update's delta is still pending in the worker when totals are reconciled
+        database.stats.reconcile()
+        reconciled = SurveyStats.query.get(user.survey_id).total_coordinates
+
+        coordinates[1]['timestamp'] = '2018-04-24T00:25:43-04:00'
+        r = client.post(url_for('api.update_v1'), data=json.dumps({'uuid': user.uuid, 'coordinates': coordinates}),
+                        content_type='application/json')
+        assert r.status_code == 201
+        assert rollups.flush() == 1
+    finally:
+        rollups.enabled = app.config['SURVEY_ROLLUPS']
+    session.expire_all()
+    # only the delta added after the reconcile is added to its totals
+    assert SurveyStats.query.get(user.survey_id).total_coordinates == reconciled + 1
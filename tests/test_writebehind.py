@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2018
+from flask import url_for
+import json
+import pytest
+from sqlalchemy import create_engine
+import threading
+import time
+
+from mobile.batch import CoordinateBatch
+from mobile.database import Database
+from mobile.writebehind import CoordinateWriteBehind, WriteBehindTicket, WriteBehindError, write_behind
+from models import db, MobileUserStats
+from tests.test_mobile_create import test_create_mobile_user as create_mobile_user
+
+database = Database()
+
+
+def make_points(n):
+    return [{'latitude': 45.5, 'longitude': -73.6, 'timestamp': '2018-04-24T00:25:{:02d}-04:00'.format(i)}
+            for i in range(n)]
+
+
+def make_batch(n):
+    return CoordinateBatch.from_points(make_points(n))
+
+
+def test_write_behind_merges_batches_from_many_devices():
+    flushes = []
+
+    def flush(tickets):
+        flushes.append([t.mobile_id for t in tickets])
+        return [len(t.batch) for t in tickets]
+
+    write_behind = CoordinateWriteBehind(flush=flush, interval=0.2, max_rows=1000)
+    tickets = [write_behind.submit(1, mobile_id, make_batch(3)) for mobile_id in range(5)]
+    assert [t.wait(timeout=5) for t in tickets] == [3] * 5
+    assert flushes == [[0, 1, 2, 3, 4]]
+
+
+def test_write_behind_flushes_when_max_rows_reached():
+    flushes = []
+
+    def flush(tickets):
+        flushes.append(len(tickets))
+        return [len(t.batch) for t in tickets]
+
+    write_behind = CoordinateWriteBehind(flush=flush, interval=5, max_rows=4)
+    start = time.time()
+    tickets = [write_behind.submit(1, mobile_id, make_batch(2)) for mobile_id in range(2)]
+    for t in tickets:
+        t.wait(timeout=5)
+    assert time.time() - start < 5
+    assert flushes == [2]
+
+
+def test_write_behind_failed_flush_is_reported_to_every_request():
+    def flush(tickets):
+        raise RuntimeError('database unavailable')
+
+    write_behind = CoordinateWriteBehind(flush=flush, interval=0.05)
+    ticket = write_behind.submit(1, 1, make_batch(1))
+    with pytest.raises(WriteBehindError) as e:
+        ticket.wait(timeout=5)
+    assert 'database unavailable' in str(e.value)
+
+
+def test_write_behind_full_queue_falls_back_to_caller():
+    release = threading.Event()
+
+    def flush(tickets):
+        release.wait(5)
+        return [len(t.batch) for t in tickets]
+
+    write_behind = CoordinateWriteBehind(flush=flush, interval=0, queue_size=1)
+    first = write_behind.submit(1, 1, make_batch(1))
+    # wait for the flusher to take the first ticket so the queue is empty
+    while write_behind._queue.qsize():
+        time.sleep(0.01)
+    assert write_behind.submit(1, 2, make_batch(1)) is not None
+    assert write_behind.submit(1, 3, make_batch(1)) is None
+    release.set()
+    assert first.wait(timeout=5) == 1
+
+
+def test_write_behind_flush_counts_coordinates_in_its_transaction(app, client, session):
+    response = create_mobile_user(app, client, session)
+    user = database.user.find_by_uuid(response.get_json()['results']['uuid'])
+    survey_id, mobile_id = user.survey_id, user.id
+
+    write_behind = CoordinateWriteBehind()
+    write_behind.app = app
+    tickets = [WriteBehindTicket(survey_id, mobile_id, make_batch(3)),
+               WriteBehindTicket(survey_id, mobile_id, make_batch(5))]
+    # the second batch repeats the first three timestamps
+    assert write_behind._flush_to_database(tickets) == [3, 2]
+    stats = MobileUserStats.query.filter_by(mobile_id=mobile_id).one()
+    assert stats.total_coordinates == 5
+
+
+@pytest.mark.parametrize('engine', ['copy', 'orm'])
+def test_write_behind_flush_credits_rows_to_their_ticket(app, client, session, engine):
+    response = create_mobile_user(app, client, session)
+    user = database.user.find_by_uuid(response.get_json()['results']['uuid'])
+    survey_id, mobile_id = user.survey_id, user.id
+    database.coordinates.insert(survey_id, mobile_id, make_batch(3))
+
+    write_behind = CoordinateWriteBehind()
+    write_behind.app = app
+    # the first ticket only repeats stored rows, so every new row is the second's
+    tickets = [WriteBehindTicket(survey_id, mobile_id, make_batch(3)),
+               WriteBehindTicket(survey_id, mobile_id, make_batch(5))]
+    app.config['COORDINATES_INGEST_ENGINE'] = engine
+    try:
+        assert write_behind._flush_to_database(tickets) == [0, 2]
+    finally:
+        app.config['COORDINATES_INGEST_ENGINE'] = 'copy'
+
+
+def test_write_behind_request_releases_its_connection_to_the_flusher(app, client, session):
+    # a single pooled connection is shared by the request and the flusher, so
+    # the rows are committed for real and removed afterwards
+    engine = create_engine(app.config['SQLALCHEMY_DATABASE_URI'], pool_size=1, max_overflow=0, pool_timeout=2)
+    db.session = db.create_scoped_session(options={'bind': engine, 'binds': {}})
+    write_behind.enabled = True
+    write_behind.timeout = 5
+    uuid = None
+    try:
+        response = create_mobile_user(app, client, session)
+        uuid = response.get_json()['results']['uuid']
+        payload = {'uuid': uuid, 'coordinates': make_points(3)}
+        r = client.post(url_for('api.update_v1'), data=json.dumps(payload), content_type='application/json')
+        assert r.status_code == 201
+        assert r.get_json()['results']['coordinatesInserted'] == 3
+    finally:
+        db.session.remove()
+        db.session = session
+        if uuid:
+            with engine.begin() as connection:
+                mobile_id = connection.execute('SELECT id FROM mobile_users WHERE uuid = %s', (uuid,)).scalar()
+                for table in ('mobile_coordinates', 'mobile_survey_responses', 'statistics_mobile_users'):
+                    connection.execute('DELETE FROM {} WHERE mobile_id = %s'.format(table), (mobile_id,))
+                connection.execute('DELETE FROM mobile_users WHERE id = %s', (mobile_id,))
+        engine.dispose()
+        write_behind.init_app(app)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Kyle Fitzsimmons, 2018
+#
+# Utils: in-process counters and timings for the running worker
+from contextlib import contextmanager
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class Metrics(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.timings = {}
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def observe(self, name, seconds):
+        with self._lock:
+            timing = self.timings.setdefault(name, {'count': 0, 'total': 0., 'max': 0.})
+            timing['count'] += 1
+            timing['total'] += seconds
+            timing['max'] = max(timing['max'], seconds)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start)
+
+    # record the throughput of a bulk operation as a counter of rows, a timing
+    # and a gauge of the most recent rows/sec figure
+    def throughput(self, name, rows, seconds):
+        self.incr(name + '.rows', rows)
+        self.observe(name, seconds)
+        if seconds > 0:
+            self.gauge(name + '.rows_per_sec', rows / seconds)
+
+    def snapshot(self):
+        with self._lock:
+            timings = {}
+            for name, timing in self.timings.items():
+                timings[name] = dict(timing, mean=timing['total'] / timing['count'])
+            return {
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'timings': timings
+            }
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.timings.clear()
+
+
+# peak resident set size of this process in kilobytes (None where unsupported)
+def peak_rss_kb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux reports kilobytes
+    if sys.platform == 'darwin':
+        peak = peak // 1024
+    return peak
+
+
+metrics = Metrics()
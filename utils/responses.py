@@ -16,10 +16,14 @@ class JSONResponse(ResponseBase):
         self.status_code = status_code
 
     @staticmethod
-    def _jsonify(data):
+    def _pretty():
+        return current_app.config['JSONIFY_PRETTYPRINT_REGULAR'] or current_app.debug
+
+    @classmethod
+    def _jsonify(cls, data):
         indent = None
         separators = (',', ':')
-        if current_app.config['JSONIFY_PRETTYPRINT_REGULAR'] or current_app.debug:
+        if cls._pretty():
             indent = 2
             separators = (', ', ': ')
         return json.dumps(data, indent=indent, separators=separators)
@@ -29,7 +33,9 @@ class Success(JSONResponse):
     headers = {}
     res_dict = {}
 
-    def __init__(self, status_code, headers, resource_type, body, status=None):
+    # `encoded_body` is a JSON object encoded ahead of time (e.g., cached) whose
+    # members are added to the results after those of `body`
+    def __init__(self, status_code, headers, resource_type, body, status=None, encoded_body=None):
         super(Success, self).__init__('success', status_code)
         self.res_dict['status'] = status or 'success'
         self.res_dict['type'] = resource_type
@@ -47,7 +53,15 @@ class Success(JSONResponse):
                             route=value)
                 self.headers[key] = value
 
-        self.set_data(self._jsonify(self.res_dict))
+        if encoded_body is None:
+            self.set_data(self._jsonify(self.res_dict))
+        elif self._pretty():
+            self.res_dict['results'] = dict(body, **json.loads(encoded_body))
+            self.set_data(self._jsonify(self.res_dict))
+        else:
+            results = self._jsonify(body)[:-1] + ',' + encoded_body[1:] if body else encoded_body
+            envelope = self._jsonify({'status': self.res_dict['status'], 'type': resource_type})
+            self.set_data(envelope[:-1] + ',"results":' + results + '}')
         assert 200 <= status_code < 300
 
 